@@ -22,6 +22,7 @@ deep_learning_folder = [
 data_prep_scripts_folder = [
     "CreateTensorHap",
     "CreateTensor",
+    "CreateCandidateTensor",
     "ExtractVariantCandidates",
     "GetTruth",
     "PairWithNonVariants",
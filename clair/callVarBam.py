@@ -16,46 +16,59 @@ from shared.command_options import (
     command_option_from
 )
 from shared.utils import file_path_from, executable_command_string_from, subprocess_popen
+from shared.tensor_ring import create_tensor_ring, remove_tensor_ring, DEFAULT_NO_OF_TENSOR_RING_SLOTS
 
 
 class InstancesClass(object):
     def __init__(self):
+        # no extract_variant_candidate if create_tensor is the fused CreateCandidateTensor
         self.extract_variant_candidate = None
         self.create_tensor = None
         self.call_variant = None
 
+    def processes(self):
+        return [
+            process for process in [self.extract_variant_candidate, self.create_tensor, self.call_variant]
+            if process is not None
+        ]
+
     def poll(self):
-        self.extract_variant_candidate.poll()
-        self.create_tensor.poll()
-        self.call_variant.poll()
+        for process in self.processes():
+            process.poll()
+
+    def kill_all_except(self, process_to_keep):
+        for process in self.processes():
+            if process is not process_to_keep:
+                process.kill()
+
+    def terminate(self):
+        for process in [self.call_variant, self.create_tensor, self.extract_variant_candidate]:
+            if process is not None:
+                process.terminate()
 
 
 c = InstancesClass()
 
 
+def is_exited_with_exceptions(process):
+    return process is not None and process.returncode != None and process.returncode != 0
+
+
 def check_return_code(signum, frame):
     c.poll()
-    #print >> sys.stderr, c.extract_variant_candidate.returncode, c.create_tensor.returncode, c.call_variant.returncode
-    if c.extract_variant_candidate.returncode != None and c.extract_variant_candidate.returncode != 0:
-        c.create_tensor.kill()
-        c.call_variant.kill()
+    if is_exited_with_exceptions(c.extract_variant_candidate):
+        c.kill_all_except(c.extract_variant_candidate)
         sys.exit("ExtractVariantCandidates.py or GetTruth.py exited with exceptions. Exiting...")
 
-    if c.create_tensor.returncode != None and c.create_tensor.returncode != 0:
-        c.extract_variant_candidate.kill()
-        c.call_variant.kill()
-        sys.exit("CreateTensor.py exited with exceptions. Exiting...")
+    if is_exited_with_exceptions(c.create_tensor):
+        c.kill_all_except(c.create_tensor)
+        sys.exit("CreateTensor.py or CreateCandidateTensor.py exited with exceptions. Exiting...")
 
-    if c.call_variant.returncode != None and c.call_variant.returncode != 0:
-        c.extract_variant_candidate.kill()
-        c.create_tensor.kill()
+    if is_exited_with_exceptions(c.call_variant):
+        c.kill_all_except(c.call_variant)
         sys.exit("call_variant.py exited with exceptions. Exiting...")
 
-    if (
-        c.extract_variant_candidate.returncode == None or
-        c.create_tensor.returncode == None or
-        c.call_variant.returncode == None
-    ):
+    if any(process.returncode == None for process in c.processes()):
         signal.alarm(5)
 
 
@@ -64,6 +77,7 @@ def Run(args):
     EVCBin = basedir + "/../clair.py ExtractVariantCandidates"
     GTBin = basedir + "/../clair.py GetTruth"
     CTBin = basedir + "/../clair.py CreateTensor"
+    CCTBin = basedir + "/../clair.py CreateCandidateTensor"
     CVBin = basedir + "/../clair.py call_var"
 
     pypyBin = executable_command_string_from(args.pypy, exit_on_not_found=True)
@@ -87,12 +101,24 @@ def Run(args):
     stop_consider_left_edge = command_option_from(args.stop_consider_left_edge, 'stop_consider_left_edge')
     log_path = command_option_from(args.log_path, 'log_path', option_value=args.log_path)
     pysam_for_all_indel_bases = command_option_from(args.pysam_for_all_indel_bases, 'pysam_for_all_indel_bases')
+    pysam_for_reading_bam = command_option_from(args.pysam_for_reading_bam, 'pysam_for_reading_bam')
+    # pysam is installed for python only (not pypy), the scripts reading the BAM with pysam are run with python
+    bamReadingBin = "python" if args.pysam_for_reading_bam else pypyBin
     haploid_precision_mode = command_option_from(args.haploid_precision, 'haploid_precision')
     haploid_sensitive_mode = command_option_from(args.haploid_sensitive, 'haploid_sensitive')
     output_for_ensemble = command_option_from(args.output_for_ensemble, 'output_for_ensemble')
     debug = command_option_from(args.debug, 'debug')
     qual = command_option_from(args.qual, 'qual', option_value=args.qual)
     fast_plotting = command_option_from(args.fast_plotting, 'fast_plotting')
+    # GetTruth only outputs text candidates
+    candidate_format = CommandOption('can_format', "binary" if args.binary_candidate_stream and vcf_fn is None else None)
+    # tensors in a shared memory ring, with the metadata of each slot passed as binary blocks
+    tensor_ring_fn = create_tensor_ring(DEFAULT_NO_OF_TENSOR_RING_SLOTS) if args.shared_memory_tensor_stream else None
+    if tensor_ring_fn is not None:
+        tensor_format = CommandOption('tensor_format', "shared_memory")
+    else:
+        tensor_format = CommandOption('tensor_format', "binary" if args.binary_tensor_stream else None)
+    tensor_ring = CommandOption('tensor_ring_fn', tensor_ring_fn)
 
     ctgStart = None
     ctgEnd = None
@@ -120,7 +146,7 @@ def Run(args):
         sleep(delay)
 
     extract_variant_candidate_command_options = [
-        pypyBin,
+        bamReadingBin,
         EVCBin,
         CommandOption('bam_fn', bam_fn),
         CommandOption('ref_fn', ref_fn),
@@ -130,7 +156,9 @@ def Run(args):
         ctgEnd,
         CommandOption('threshold', af_threshold),
         CommandOption('minCoverage', minCoverage),
-        CommandOption('samtools', samtoolsBin)
+        CommandOption('samtools', samtoolsBin),
+        pysam_for_reading_bam,
+        candidate_format,
     ]
     get_truth_command_options = [
         pypyBin,
@@ -143,7 +171,7 @@ def Run(args):
     ]
 
     create_tensor_command_options = [
-        pypyBin,
+        bamReadingBin,
         CTBin,
         CommandOption('bam_fn', bam_fn),
         CommandOption('ref_fn', ref_fn),
@@ -152,7 +180,30 @@ def Run(args):
         ctgEnd,
         stop_consider_left_edge,
         CommandOption('samtools', samtoolsBin),
-        CommandOption('dcov', dcov)
+        CommandOption('dcov', dcov),
+        pysam_for_reading_bam,
+        candidate_format,
+        tensor_format,
+        tensor_ring,
+    ]
+
+    # candidates and their tensors in one process reading the BAM once, same tensors as the two processes
+    create_candidate_tensor_command_options = [
+        bamReadingBin,
+        CCTBin,
+        CommandOption('bam_fn', bam_fn),
+        CommandOption('ref_fn', ref_fn),
+        CommandOption('bed_fn', bed_fn),
+        CommandOption('ctgName', ctgName),
+        ctgStart,
+        ctgEnd,
+        CommandOption('threshold', af_threshold),
+        CommandOption('minCoverage', minCoverage),
+        CommandOption('samtools', samtoolsBin),
+        CommandOption('dcov', dcov),
+        pysam_for_reading_bam,
+        tensor_format,
+        tensor_ring,
     ]
 
     call_variant_command_options = [
@@ -169,7 +220,9 @@ def Run(args):
         haploid_sensitive_mode,
         output_for_ensemble,
         qual,
-        debug
+        debug,
+        tensor_format,
+        tensor_ring,
     ]
     call_variant_with_activation_command_options = [
         CommandOptionWithNoValue('activation_only'),
@@ -181,17 +234,24 @@ def Run(args):
     ] if args.activation_only else []
 
     is_true_variant_call = vcf_fn is not None
+    # the fused process considers the left edge only
+    is_single_pass = args.single_pass_tensor and not is_true_variant_call and not args.stop_consider_left_edge
     try:
-        c.extract_variant_candidate = subprocess_popen(
-            shlex.split(command_string_from(
-                get_truth_command_options if is_true_variant_call else extract_variant_candidate_command_options
-            ))
-        )
-
-        c.create_tensor = subprocess_popen(
-            shlex.split(command_string_from(create_tensor_command_options)),
-            stdin=c.extract_variant_candidate.stdout
-        )
+        if is_single_pass:
+            c.create_tensor = subprocess_popen(
+                shlex.split(command_string_from(create_candidate_tensor_command_options))
+            )
+        else:
+            c.extract_variant_candidate = subprocess_popen(
+                shlex.split(command_string_from(
+                    get_truth_command_options if is_true_variant_call else extract_variant_candidate_command_options
+                ))
+            )
+
+            c.create_tensor = subprocess_popen(
+                shlex.split(command_string_from(create_tensor_command_options)),
+                stdin=c.extract_variant_candidate.stdout
+            )
 
         c.call_variant = subprocess_popen(
             shlex.split(command_string_from(
@@ -201,6 +261,8 @@ def Run(args):
         )
     except Exception as e:
         print(e, file=sys.stderr)
+        if tensor_ring_fn is not None:
+            remove_tensor_ring(tensor_ring_fn)
         sys.exit("Failed to start required processes. Exiting...")
 
     signal.signal(signal.SIGALRM, check_return_code)
@@ -210,14 +272,13 @@ def Run(args):
         c.call_variant.wait()
         c.create_tensor.stdout.close()
         c.create_tensor.wait()
-        c.extract_variant_candidate.stdout.close()
-        c.extract_variant_candidate.wait()
+        if c.extract_variant_candidate is not None:
+            c.extract_variant_candidate.stdout.close()
+            c.extract_variant_candidate.wait()
     except KeyboardInterrupt as e:
         print("KeyboardInterrupt received when waiting at CallVarBam, terminating all scripts.")
         try:
-            c.call_variant.terminate()
-            c.create_tensor.terminate()
-            c.extract_variant_candidate.terminate()
+            c.terminate()
         except Exception as e:
             print(e)
 
@@ -226,13 +287,14 @@ def Run(args):
         print("Exception received when waiting at CallVarBam, terminating all scripts.")
         print(e)
         try:
-            c.call_variant.terminate()
-            c.create_tensor.terminate()
-            c.extract_variant_candidate.terminate()
+            c.terminate()
         except Exception as e:
             print(e)
 
         raise e
+    finally:
+        if tensor_ring_fn is not None:
+            remove_tensor_ring(tensor_ring_fn)
 
 
 def main():
@@ -299,6 +361,21 @@ def main():
     parser.add_argument('--pysam_for_all_indel_bases', action='store_true',
                         help="Always using pysam for outputting indel bases, optional")
 
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam in ExtractVariantCandidates and CreateTensor instead of using 'samtools view', these are then run with python instead of pypy, optional")
+
+    parser.add_argument('--binary_candidate_stream', action='store_true',
+                        help="Pass candidates from ExtractVariantCandidates to CreateTensor as binary records instead of text, optional")
+
+    parser.add_argument('--binary_tensor_stream', action='store_true',
+                        help="Pass tensors from CreateTensor to call_var as binary records instead of text, optional")
+
+    parser.add_argument('--shared_memory_tensor_stream', action='store_true',
+                        help="Pass tensors from CreateTensor to call_var in a ring of shared memory slots (%d batches of tensors), with only their metadata through the pipe, overrides --binary_tensor_stream, optional" % (DEFAULT_NO_OF_TENSOR_RING_SLOTS))
+
+    parser.add_argument('--single_pass_tensor', action='store_true',
+                        help="Extract candidates and create their tensors in one process (CreateCandidateTensor) reading the BAM and the reference once, not used with --vcf_fn or --stop_consider_left_edge, optional")
+
     parser.add_argument('--haploid_precision', action='store_true',
                         help="call haploid instead of diploid (output homo-variant only)")
     parser.add_argument('--haploid_sensitive', action='store_true',
@@ -10,6 +10,7 @@ from shared.command_options import (
     command_option_from
 )
 from shared.interval_tree import bed_tree_from, is_region_in
+from shared.bam_index import bam_index_from
 from shared.utils import file_path_from, executable_command_string_from
 
 major_contigs = {"chr"+str(a) for a in list(range(1, 23))+["X", "Y"]}.union({str(a) for a in list(range(1, 23))+["X", "Y"]})
@@ -45,6 +46,11 @@ def Run(args):
     stop_consider_left_edge = command_option_from(args.stop_consider_left_edge, 'stop_consider_left_edge')
     log_path = command_option_from(args.log_path, 'log_path', option_value=args.log_path)
     pysam_for_all_indel_bases = command_option_from(args.pysam_for_all_indel_bases, 'pysam_for_all_indel_bases')
+    pysam_for_reading_bam = command_option_from(args.pysam_for_reading_bam, 'pysam_for_reading_bam')
+    binary_candidate_stream = command_option_from(args.binary_candidate_stream, 'binary_candidate_stream')
+    binary_tensor_stream = command_option_from(args.binary_tensor_stream, 'binary_tensor_stream')
+    shared_memory_tensor_stream = command_option_from(args.shared_memory_tensor_stream, 'shared_memory_tensor_stream')
+    single_pass_tensor = command_option_from(args.single_pass_tensor, 'single_pass_tensor')
     haploid_precision_mode = command_option_from(args.haploid_precision, 'haploid_precision')
     haploid_sensitive_mode = command_option_from(args.haploid_sensitive, 'haploid_sensitive')
     output_for_ensemble = command_option_from(args.output_for_ensemble, 'output_for_ensemble')
@@ -70,6 +76,11 @@ def Run(args):
         stop_consider_left_edge,
         debug,
         pysam_for_all_indel_bases,
+        pysam_for_reading_bam,
+        binary_candidate_stream,
+        binary_tensor_stream,
+        shared_memory_tensor_stream,
+        single_pass_tensor,
         haploid_precision_mode,
         haploid_sensitive_mode,
         output_for_ensemble,
@@ -85,6 +96,9 @@ def Run(args):
     ] if args.activation_only else []
 
     is_bed_file_provided = bed_fn is not None
+    # regions without reads by the BAM index get no command
+    bam_index = bam_index_from(bam_fn)
+    no_of_regions_skipped_by_index = 0
     command_string = command_string_from(call_var_bam_command_options + activation_only_command_options)
 
     with open(fai_fn, 'r') as fai_fp:
@@ -108,6 +122,9 @@ def Run(args):
                 need_output_command = not is_bed_file_provided or is_region_in_bed
                 if not need_output_command:
                     continue
+                if bam_index is not None and not bam_index.has_reads_in(contig_name, region_start, region_end):
+                    no_of_regions_skipped_by_index += 1
+                    continue
 
                 additional_command_options = [
                     CommandOption('ctgName', contig_name),
@@ -118,6 +135,9 @@ def Run(args):
                 ]
                 print(command_string + " " + command_string_from(additional_command_options))
 
+    if no_of_regions_skipped_by_index > 0:
+        print("[INFO] %d regions skipped without reads by the BAM index" % (no_of_regions_skipped_by_index), file=sys.stderr)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -180,6 +200,21 @@ def main():
     parser.add_argument('--pysam_for_all_indel_bases', action='store_true',
                         help="Always using pysam for outputting indel bases, optional")
 
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam in ExtractVariantCandidates and CreateTensor instead of using 'samtools view', these are then run with python instead of pypy, optional")
+
+    parser.add_argument('--binary_candidate_stream', action='store_true',
+                        help="Pass candidates from ExtractVariantCandidates to CreateTensor as binary records instead of text, optional")
+
+    parser.add_argument('--binary_tensor_stream', action='store_true',
+                        help="Pass tensors from CreateTensor to call_var as binary records instead of text, optional")
+
+    parser.add_argument('--shared_memory_tensor_stream', action='store_true',
+                        help="Pass tensors from CreateTensor to call_var in a ring of shared memory slots, with only their metadata through the pipe, optional")
+
+    parser.add_argument('--single_pass_tensor', action='store_true',
+                        help="Extract candidates and create their tensors in one process reading the BAM and the reference once, optional")
+
     parser.add_argument('--haploid_precision', action='store_true',
                         help="call haploid instead of diploid (output homo-variant only)")
     parser.add_argument('--haploid_sensitive', action='store_true',
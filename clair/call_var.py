@@ -21,6 +21,7 @@ from clair.task.gt21 import (
 from clair.task.genotype import Genotype, genotype_string_from, genotype_enum_from, genotype_enum_for_task
 from clair.task.variant_length import VariantLength
 from shared.utils import IUPAC_base_to_num_dict as BASE2NUM, IUPAC_base_to_ACGT_base_dict as BASE2ACGT, BASIC_BASES
+from shared.tensor_ring import DEFAULT_NO_OF_TENSOR_RING_SLOTS
 import shared.param as param
 
 
@@ -1244,7 +1245,10 @@ def log_activation(args, m):
     if summary_writer is None:
         return
 
-    tensor_generator = utils.tensor_generator_from(args.tensor_fn, param.predictBatchSize)
+    tensor_ring = utils.tensor_ring_reader_from(args)
+    tensor_generator = utils.tensor_generator_from(
+        args.tensor_fn, param.predictBatchSize, args.tensor_format, tensor_ring=tensor_ring
+    )
     logging.info("Plotting activations ...")
 
     num_plotted = 0
@@ -1269,7 +1273,11 @@ def log_activation(args, m):
         )
         for summary in summaries:
             summary_writer.add_summary(summary)
+        if tensor_ring is not None:
+            tensor_ring.release_earliest_batch()
         num_plotted += min(batch_size, args.max_plot - num_plotted if args.max_plot >= 0 else batch_size)
+    if tensor_ring is not None:
+        tensor_ring.close()
     print("Finished plotting %d" % num_plotted)
 
 
@@ -1312,7 +1320,10 @@ def call_variants_with_probabilities_input(args, output_config, output_utilities
 def call_variants(args, m, output_config, output_utilities):
     output_utilities.output_header()
 
-    tensor_generator = utils.tensor_generator_from(args.tensor_fn, param.predictBatchSize)
+    tensor_ring = utils.tensor_ring_reader_from(args)
+    tensor_generator = utils.tensor_generator_from(
+        args.tensor_fn, param.predictBatchSize, args.tensor_format, tensor_ring=tensor_ring
+    )
     logging.info("Calling variants ...")
     variant_call_start_time = time()
 
@@ -1330,12 +1341,14 @@ def call_variants(args, m, output_config, output_utilities):
 
     while True:
         thread_pool = []
+        is_mini_batch_output = False
 
         if len(mini_batches_to_output) > 0:
             mini_batch = mini_batches_to_output.pop(0)
             thread_pool.append(Thread(
                 target=batch_output_method, args=(mini_batch, m.prediction, output_config, output_utilities)
             ))
+            is_mini_batch_output = True
 
         if len(mini_batches_to_predict) > 0:
             mini_batch = mini_batches_to_predict.pop(0)
@@ -1351,6 +1364,10 @@ def call_variants(args, m, output_config, output_utilities):
         for t in thread_pool:
             t.join()
 
+        # mini batches are output in the order loaded, the tensors of the one output are not used anymore
+        if is_mini_batch_output and tensor_ring is not None:
+            tensor_ring.release_earliest_batch()
+
         is_finish_loaded_all_mini_batches = len(mini_batches_loaded) == 0
         while len(mini_batches_loaded) > 0:
             mini_batch = mini_batches_loaded.pop(0)
@@ -1361,6 +1378,8 @@ def call_variants(args, m, output_config, output_utilities):
         )
         if is_finish_loaded_all_mini_batches and is_nothing_to_predict_and_output:
             break
+    if tensor_ring is not None:
+        tensor_ring.close()
 
     logging.info("Total time elapsed: %.2f s" % (time() - variant_call_start_time))
 
@@ -1373,6 +1392,15 @@ def main():
     parser.add_argument('--tensor_fn', type=str, default="PIPE",
                         help="Tensor input, use PIPE for standard input")
 
+    parser.add_argument('--tensor_format', type=str, default="text", choices=["text", "binary", "shared_memory"],
+                        help="Tensor input format, binary for the fixed-width records of CreateTensor, shared_memory for tensors in the slots of --tensor_ring_fn, default: %(default)s")
+
+    parser.add_argument('--tensor_ring_fn', type=str, default=None,
+                        help="Tensor ring (shared memory file with a release FIFO, as created by callVarBam) for the shared_memory tensor format, optional")
+
+    parser.add_argument('--tensor_ring_slots', type=int, default=DEFAULT_NO_OF_TENSOR_RING_SLOTS,
+                        help="The number of slots in the tensor ring, default: %(default)s")
+
     parser.add_argument('--chkpnt_fn', type=str, default=None,
                         help="Input a checkpoint for testing")
 
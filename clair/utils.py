@@ -2,7 +2,6 @@ from __future__ import print_function
 
 import sys
 import gc
-import shlex
 import logging
 import pickle
 import numpy as np
@@ -13,8 +12,10 @@ from collections import namedtuple
 
 from clair.task.main import output_labels_from_reference, output_labels_from_vcf_columns
 import shared.param as param
-from shared.interval_tree import bed_tree_from, is_region_in
-from shared.utils import subprocess_popen, IUPAC_base_to_num_dict as BASE2NUM, IUPAC_base_to_ACGT_base_dict as BASE2ACGT, BASIC_BASES
+from shared.interval_tree import bed_tree_from, IntervalSweeper
+from shared.utils import gzip_input_from, IUPAC_base_to_num_dict as BASE2NUM, IUPAC_base_to_ACGT_base_dict as BASE2ACGT, BASIC_BASES
+from shared.binary_format import tensor_blocks_from, haplotype_tensor_blocks_from, NO_OF_HAPLOTYPE_CHANNELS
+from shared.tensor_ring import TensorRingReader
 
 PREFIX_CHAR_STR = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
@@ -69,40 +70,92 @@ no_of_positions, matrix_row, matrix_num = 2 * param.flankingBaseNum + 1, param.m
 input_tensor_size = no_of_positions * matrix_row * matrix_num
 
 
-def tensor_generator_from(tensor_file_path, batch_size):
-    if tensor_file_path != "PIPE":
-        f = subprocess_popen(shlex.split("gzip -fdc %s" % (tensor_file_path)))
-        fo = f.stdout
-    else:
-        fo = sys.stdin
-
-    processed_tensors = 0
-
+def text_tensor_batches_from(fo, batch_size):
     def item_from(row):
         columns = row.split()
         return (columns[:-input_tensor_size], np.array(columns[-input_tensor_size:], dtype=np.float32))
 
     for batch in batches_from(fo, item_from=item_from, batch_size=batch_size):
-        tensors = np.empty((batch_size, input_tensor_size), dtype=np.float32)
-        non_tensor_infos = []
-        for non_tensor_info, tensor in batch:
-            _, _, sequence = non_tensor_info
-            if sequence[param.flankingBaseNum] not in BASE2NUM:
-                continue
-            tensors[len(non_tensor_infos)] = tensor
-            non_tensor_infos.append(non_tensor_info)
+        tensors = np.empty((len(batch), input_tensor_size), dtype=np.float32)
+        for index, (_, tensor) in enumerate(batch):
+            tensors[index] = tensor
+        yield [non_tensor_info for non_tensor_info, _ in batch], tensors
+
+
+def binary_tensor_batches_from(fo, batch_size):
+    for ctg_name, records in tensor_blocks_from(fo):
+        for batch_start in range(0, len(records), batch_size):
+            batch = records[batch_start:batch_start + batch_size]
+            non_tensor_infos = [
+                [ctg_name, str(position), sequence.decode("ascii")]
+                for position, sequence in zip(batch["position"].tolist(), batch["reference_sequence"].tolist())
+            ]
+            yield non_tensor_infos, batch["tensor"].reshape((len(batch), input_tensor_size)).astype(np.float32)
+
+
+def shared_memory_tensor_batches_from(fo, tensor_ring):
+    # the tensors stay in the slots of the tensor ring, batches are of the slot size (predictBatchSize) at most
+    for ctg_name, records, tensors in tensor_ring.batches_from(fo):
+        non_tensor_infos = [
+            [ctg_name, str(position), sequence.decode("ascii")]
+            for position, sequence in zip(records["position"].tolist(), records["reference_sequence"].tolist())
+        ]
+        yield non_tensor_infos, np.asarray(tensors).reshape((len(records), input_tensor_size))
+
+
+def tensor_ring_reader_from(args):
+    """
+    reader of the tensor ring of args.tensor_ring_fn for the shared_memory tensor format, None for other formats
+    """
+    if args.tensor_format != "shared_memory":
+        return None
+    return TensorRingReader(args.tensor_ring_fn, args.tensor_ring_slots)
+
+
+def tensor_generator_from(tensor_file_path, batch_size, tensor_format="text", tensor_ring=None):
+    """
+    (tensors, [contig, position, reference sequence] of tensors) in batches of at most batch_size,
+    from a text or binary tensor file (or standard input if tensor_file_path is PIPE),
+    or from the slots of tensor_ring (to be released in order after use) for the shared_memory format
+    """
+    is_binary = tensor_format != "text"
+    if tensor_file_path != "PIPE":
+        f = gzip_input_from(tensor_file_path, universal_newlines=not is_binary)
+        fo = f.stdout
+    else:
+        fo = sys.stdin.buffer if is_binary else sys.stdin
+
+    processed_tensors = 0
 
+    if tensor_format == "shared_memory":
+        tensor_batches = shared_memory_tensor_batches_from(fo, tensor_ring)
+    elif is_binary:
+        tensor_batches = binary_tensor_batches_from(fo, batch_size)
+    else:
+        tensor_batches = text_tensor_batches_from(fo, batch_size)
+    for batch_non_tensor_infos, batch_tensors in tensor_batches:
+        is_tensor_kept = [sequence[param.flankingBaseNum] in BASE2NUM for _, _, sequence in batch_non_tensor_infos]
+        non_tensor_infos = [
+            non_tensor_info for non_tensor_info, is_kept in zip(batch_non_tensor_infos, is_tensor_kept) if is_kept
+        ]
+
+        # tensors are used in place (e.g. in a tensor ring slot) unless some are dropped
         current_batch_size = len(non_tensor_infos)
-        X = np.reshape(tensors, (batch_size, no_of_positions, matrix_row, matrix_num))
+        X = np.reshape(
+            batch_tensors if all(is_tensor_kept) else batch_tensors[np.array(is_tensor_kept, dtype=bool)],
+            (current_batch_size, no_of_positions, matrix_row, matrix_num)
+        )
         for i in range(1, matrix_num):
-            X[:current_batch_size, :, :, i] -= X[:current_batch_size, :, :, 0]
+            X[:, :, :, i] -= X[:, :, :, 0]
 
         processed_tensors += current_batch_size
         print("Processed %d tensors" % processed_tensors, file=sys.stderr)
 
         if current_batch_size <= 0:
+            if tensor_ring is not None:
+                tensor_ring.release_latest_batch()
             continue
-        yield X[:current_batch_size], non_tensor_infos[:current_batch_size]
+        yield X, non_tensor_infos
 
     if tensor_file_path != "PIPE":
         fo.close()
@@ -114,12 +167,14 @@ def variant_map_from(var_fn, tree, is_tree_empty):
     if var_fn is None:
         return Y
 
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (var_fn)))
+    bed_sweeper = IntervalSweeper(tree)
+
+    f = gzip_input_from(var_fn)
     for row in f.stdout:
         columns = row.split()
         ctg_name, position_str = columns[0], columns[1]
 
-        if not (is_tree_empty or is_region_in(tree, ctg_name, int(position_str))):
+        if not (is_tree_empty or bed_sweeper.is_position_in(ctg_name, int(position_str))):
             continue
 
         key = ctg_name + ":" + position_str
@@ -130,28 +185,58 @@ def variant_map_from(var_fn, tree, is_tree_empty):
     return Y
 
 
-def get_training_array(tensor_fn, var_fn, bed_fn, shuffle=True, is_allow_duplicate_chr_pos=False):
+def is_text_tensor_format(tensor_format):
+    return tensor_format in ("text", "haplotype_text")
+
+
+def tensor_shape_from(tensor_format):
+    """
+    shape of a tensor, haplotype tensors (of CreateTensorHap) have the haplotype channels first
+    """
+    if tensor_format in ("haplotype_text", "haplotype_binary"):
+        return (NO_OF_HAPLOTYPE_CHANNELS, no_of_positions, matrix_row, matrix_num)
+    return (no_of_positions, matrix_row, matrix_num)
+
+
+def tensor_records_from(fo, tensor_format="text"):
+    """
+    (contig, position, reference sequence, tensor) of every tensor in a text or binary tensor stream
+    (of CreateTensor, or of CreateTensorHap for the haplotype formats)
+    """
+    if is_text_tensor_format(tensor_format):
+        for row in fo:
+            yield unpack_a_tensor_record(*(row.split()))
+        return
+
+    tensor_blocks = haplotype_tensor_blocks_from(fo) if tensor_format == "haplotype_binary" else tensor_blocks_from(fo)
+    for ctg_name, records in tensor_blocks:
+        tensors = records["tensor"].reshape((len(records), -1)).astype(np.float32)
+        for index, (position, sequence) in enumerate(zip(records["position"].tolist(), records["reference_sequence"].tolist())):
+            yield ctg_name, str(position), sequence.decode("ascii"), tensors[index]
+
+
+def get_training_array(tensor_fn, var_fn, bed_fn, shuffle=True, is_allow_duplicate_chr_pos=False, tensor_format="text"):
     tree = bed_tree_from(bed_file_path=bed_fn)
     is_tree_empty = len(tree.keys()) == 0
+    bed_sweeper = IntervalSweeper(tree)
 
     Y = variant_map_from(var_fn, tree, is_tree_empty)
 
     X = {}
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (tensor_fn)))
+    f = gzip_input_from(tensor_fn, universal_newlines=is_text_tensor_format(tensor_format))
     total = 0
-    mat = np.empty(input_tensor_size, dtype=np.float32)
-    for row in f.stdout:
-        chrom, coord, seq, mat = unpack_a_tensor_record(*(row.split()))
-        if not (is_tree_empty or is_region_in(tree, chrom, int(coord))):
+    tensor_shape = tensor_shape_from(tensor_format)
+    for chrom, coord, seq, mat in tensor_records_from(f.stdout, tensor_format):
+        if not (is_tree_empty or bed_sweeper.is_position_in(chrom, int(coord))):
             continue
         seq = seq.upper()
         if seq[param.flankingBaseNum] not in BASIC_BASES:
             continue
         key = chrom + ":" + coord
 
-        x = np.reshape(mat, (no_of_positions, matrix_row, matrix_num))
+        x = np.reshape(mat, tensor_shape)
         for i in range(1, matrix_num):
-            x[:, :, i] -= x[:, :, 0]
+            x[..., i] -= x[..., 0]
 
         if key not in X:
             X[key] = np.copy(x)
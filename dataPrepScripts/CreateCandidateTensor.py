@@ -0,0 +1,300 @@
+import sys
+from os.path import isfile
+from argparse import ArgumentParser
+from collections import Counter
+
+import shared.param as param
+from shared.utils import gzip_output_from, DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL
+from shared.tensor_ring import DEFAULT_NO_OF_TENSOR_RING_SLOTS
+from shared.interval_tree import bed_tree_from, IntervalSweeper
+from shared.bam_index import bam_index_from, is_region_covered_in
+from shared.alignment import is_too_many_soft_clipped_bases_for_a_read_from, reference_end_from
+from shared.pileup import PileupWindow, PILEUP_COLUMNS
+from dataPrepScripts.ExtractVariantCandidates import (
+    CandidateFilter,
+    region_from,
+    reference_sequence_from,
+    reads_from,
+    bam_file_paths_from,
+    candidates_in_pileup_from,
+    add_read_to_pileup,
+    print_statistics,
+)
+from dataPrepScripts.CreateTensor import TensorColumnWindow, TensorStdout, tensor_output_from, check_tensor_ring_args
+
+
+def candidate_filter_from(args):
+    tree = bed_tree_from(bed_file_path=args.bed_fn)
+    return CandidateFilter(
+        minimum_depth=args.minCoverage,
+        minimum_af=args.threshold,
+        is_building_training_dataset=False,
+        output_probability=0.0,
+        output_probability_near_variant=0.0,
+        output_probability_outside_variant=0.0,
+        tree=tree,
+        bed_sweeper=IntervalSweeper(tree),
+        variants_map=None,
+        non_variants_map={},
+    )
+
+
+def candidate_tensors_from(
+    candidate_filter,
+    reads,
+    minimum_mapping_quality,
+    ctg_name,
+    ctg_start,
+    ctg_end,
+    reference_sequence,
+    reference_start,
+    statistics,
+    maximum_depth=250,
+    minimum_coverage=0
+):
+    """
+    (1-based candidate position, tensor) of candidates in [ctg_start, ctg_end] (whole contig if not given),
+    in position order, from (sample index, read) of reads read once
+
+    Candidates are the same as ExtractVariantCandidates and the tensors the same as CreateTensor (left edge
+    considered) with those candidates: a read counts for tensors only if it overlaps [ctg_start, ctg_end],
+    and a read is skipped for tensors once maximum_depth reads started at its position already.
+    """
+    flanking_base_num = param.flankingBaseNum
+    is_ctg_range_given = ctg_start is not None and ctg_end is not None
+
+    pileup = PileupWindow(no_of_columns=len(PILEUP_COLUMNS))
+    tensor_column_window = TensorColumnWindow(
+        reference_sequence, 0 if reference_start is None else reference_start - 1, minimum_coverage
+    )
+
+    def add_candidates_flushed_before(position=None):
+        positions, counts = pileup.flush(position)
+        candidate_indices, _, _, _ = candidates_in_pileup_from(
+            candidate_filter=candidate_filter,
+            ctg_name=ctg_name,
+            ctg_start=ctg_start,
+            ctg_end=ctg_end,
+            positions=positions,
+            counts=counts,
+            reference_sequence=reference_sequence,
+            reference_start=reference_start,
+            statistics=statistics
+        )
+        for i in candidate_indices:
+            tensor_column_window.add_candidate(int(positions[i]) + 1)
+
+    previous_position = 0
+    depth_cap = 0
+    previous_read_position = None
+    for _, read in reads:
+        POS = read.position
+        cigartuples = read.cigartuples
+
+        if read.mapping_quality < minimum_mapping_quality:
+            continue
+
+        # positions before POS - 1 are complete in the pileup, a read starting at POS may still
+        # add an insertion or deletion at POS - 1
+        add_candidates_flushed_before(POS - 1)
+
+        # the tensors of candidates not decided yet (from POS - 1 on) need the columns of their windows
+        if previous_read_position != POS:
+            previous_read_position = POS
+            for center, tensor in tensor_column_window.tensors_before(POS - (flanking_base_num + 2)):
+                yield center, tensor
+
+        # as the reads of CreateTensor, from "samtools view" of [ctg_start, ctg_end] only
+        reference_end = POS + 1 if cigartuples is None else max(reference_end_from(POS, cigartuples), POS + 1)
+        if not is_ctg_range_given or (POS < ctg_end and reference_end > ctg_start - 1):
+            if previous_position != POS:
+                previous_position = POS
+                depth_cap = 0
+            else:
+                depth_cap += 1
+            if depth_cap < maximum_depth and cigartuples is not None:
+                tensor_column_window.add_read(read)
+
+        if cigartuples is None or is_too_many_soft_clipped_bases_for_a_read_from(read):
+            continue
+
+        statistics["reads"] += 1
+        add_read_to_pileup(pileup, read)
+
+    add_candidates_flushed_before()
+    for center, tensor in tensor_column_window.tensors_before():
+        yield center, tensor
+
+
+def tensor_file_from(args):
+    is_binary = args.tensor_format != "text"
+    if args.tensor_fn == "PIPE":
+        return TensorStdout(sys.stdout.buffer if is_binary else sys.stdout)
+    return gzip_output_from(
+        args.tensor_fn,
+        threads=args.compression_threads,
+        level=args.compression_level,
+        universal_newlines=not is_binary
+    )
+
+
+def close_tensor_output(tensor_fp, tensor_output_path):
+    if tensor_output_path == "PIPE":
+        return
+    tensor_fp.stdin.close()
+    tensor_fp.wait()
+
+
+def make_candidate_tensors(args):
+    fasta_file_path = args.ref_fn
+    ctg_name = args.ctgName
+    ctg_start = args.ctgStart
+    ctg_end = args.ctgEnd
+    is_ctg_range_given = ctg_start is not None and ctg_end is not None
+
+    if len(bam_file_paths_from(args.bam_fn)) != 1:
+        sys.exit("[ERROR] CreateCandidateTensor takes one BAM file only.")
+    if not isfile("{}.fai".format(fasta_file_path)):
+        print("Fasta index {}.fai doesn't exist.".format(fasta_file_path), file=sys.stderr)
+        sys.exit(1)
+
+    candidate_filter = candidate_filter_from(args)
+    if args.bed_fn is not None and ctg_name not in candidate_filter.tree:
+        print("[ERROR] ctg_name({}) not exists in bed file({}).".format(ctg_name, args.bed_fn), file=sys.stderr)
+        sys.exit(1)
+
+    # 1-based region [start, end] of the reference and the reads, as ExtractVariantCandidates
+    reference_start, reference_end = None, None
+    if is_ctg_range_given:
+        reference_start, reference_end = ctg_start - param.expandReferenceRegion, ctg_end + param.expandReferenceRegion
+        reference_start = 1 if reference_start < 1 else reference_start
+        regions = [region_from(ctg_name=ctg_name, ctg_start=reference_start, ctg_end=reference_end)]
+    else:
+        regions = [region_from(ctg_name=ctg_name)]
+
+    tensor_fp = tensor_file_from(args)
+    if not is_region_covered_in(
+        [bam_index_from(args.bam_fn)],
+        ctg_name,
+        ctg_start - 1 if is_ctg_range_given else None,
+        ctg_end if is_ctg_range_given else None
+    ):
+        print("[INFO] No reads in {} by the BAM index, skipped".format(
+            region_from(ctg_name, ctg_start, ctg_end) if is_ctg_range_given else ctg_name), file=sys.stderr)
+        close_tensor_output(tensor_fp, args.tensor_fn)
+        return
+
+    reference_sequence = reference_sequence_from(
+        samtools_execute_command=args.samtools,
+        fasta_file_path=fasta_file_path,
+        ctg_name=ctg_name,
+        ctg_start=reference_start,
+        ctg_end=reference_end
+    )
+    if reference_sequence is None or len(reference_sequence) == 0:
+        print("[ERROR] Failed to load reference seqeunce from file ({}).".format(fasta_file_path), file=sys.stderr)
+        sys.exit(1)
+
+    tensor_output = tensor_output_from(
+        args,
+        tensor_fp,
+        ctg_name,
+        reference_sequence,
+        0 if reference_start is None else reference_start - 1
+    )
+
+    statistics = Counter()
+    for center, tensor in candidate_tensors_from(
+        candidate_filter=candidate_filter,
+        reads=reads_from(args, ctg_name, regions),
+        minimum_mapping_quality=args.minMQ,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start if is_ctg_range_given else None,
+        ctg_end=ctg_end if is_ctg_range_given else None,
+        reference_sequence=reference_sequence,
+        reference_start=reference_start,
+        statistics=statistics,
+        maximum_depth=args.dcov,
+        minimum_coverage=args.tensor_minCoverage
+    ):
+        tensor_output.add(center, tensor)
+    tensor_output.flush()
+
+    close_tensor_output(tensor_fp, args.tensor_fn)
+
+    print_statistics(candidate_filter, statistics, args.bam_fn)
+
+
+def main():
+    parser = ArgumentParser(
+        description="Generate the tensors of variant candidates in one pass over the alignments, same as ExtractVariantCandidates piped to CreateTensor")
+
+    parser.add_argument('--bam_fn', type=str, default="input.bam",
+                        help="Sorted bam file input, default: %(default)s")
+
+    parser.add_argument('--ref_fn', type=str, default="ref.fa",
+                        help="Reference fasta file input, default: %(default)s")
+
+    parser.add_argument('--bed_fn', type=str, default=None,
+                        help="Call variant only in these regions, works in intersection with ctgName, ctgStart and ctgEnd, optional, default: as defined by ctgName, ctgStart and ctgEnd")
+
+    parser.add_argument('--tensor_fn', type=str, default="PIPE",
+                        help="Tensor output, use PIPE for standard output, default: %(default)s")
+
+    parser.add_argument('--tensor_format', type=str, default="text", choices=["text", "binary", "shared_memory"],
+                        help="Tensor output format, binary for blocks of fixed-width records (uint16 counts), shared_memory for tensors in the slots of --tensor_ring_fn with their metadata output as binary blocks, default: %(default)s")
+
+    parser.add_argument('--tensor_ring_fn', type=str, default=None,
+                        help="Tensor ring (shared memory file with a release FIFO, as created by callVarBam) for the shared_memory tensor format, optional")
+
+    parser.add_argument('--tensor_ring_slots', type=int, default=DEFAULT_NO_OF_TENSOR_RING_SLOTS,
+                        help="The number of slots in the tensor ring, default: %(default)s")
+
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
+    parser.add_argument('--threshold', type=float, default=0.125,
+                        help="Minimum allele frequence of the 1st non-reference allele for a site to be considered as a condidate site, default: %(default)f")
+
+    parser.add_argument('--minCoverage', type=float, default=4,
+                        help="Minimum coverage required to call a variant, default: %(default)f")
+
+    parser.add_argument('--tensor_minCoverage', type=int, default=0,
+                        help="Minimum coverage required to generate a tensor, default: %(default)d")
+
+    parser.add_argument('--minMQ', type=int, default=0,
+                        help="Minimum Mapping Quality. Mapping quality lower than the setting will be filtered, default: %(default)d")
+
+    parser.add_argument('--dcov', type=int, default=250,
+                        help="Cap depth per position at %(default)d for tensors")
+
+    parser.add_argument('--ctgName', type=str, default="chr17",
+                        help="The name of sequence to be processed, default: %(default)s")
+
+    parser.add_argument('--ctgStart', type=int, default=None,
+                        help="The 1-based starting position of the sequence to be processed")
+
+    parser.add_argument('--ctgEnd', type=int, default=None,
+                        help="The 1-based inclusive ending position of the sequence to be processed")
+
+    parser.add_argument('--samtools', type=str, default="samtools",
+                        help="Path to the 'samtools', default: %(default)s")
+
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam instead of parsing the output of 'samtools view', optional")
+
+    args = parser.parse_args()
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    check_tensor_ring_args(args)
+    make_candidate_tensors(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,30 @@ import sys
 import shlex
 import signal
 import gc
-from subprocess import PIPE
+import heapq
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import namedtuple, deque
+from itertools import chain
+from multiprocessing import Pool
+
+import numpy as np
 
 import shared.param as param
-from shared.utils import subprocess_popen, IUPAC_base_to_num_dict as BASE2NUM
+from shared.alignment import (
+    aligned_reads_from, pysam_reads_from, reference_end_from, BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CSOFT_CLIP, BAM_CEQUAL, BAM_CDIFF
+)
+from shared.pileup import PileupWindow
+from shared.utils import (
+    subprocess_popen, gzip_input_from, gzip_output_from,
+    DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL, IUPAC_base_to_num_dict as BASE2NUM
+)
+from shared.interval_tree import bed_tree_from, IntervalSweeper
+from shared.fasta import ReferenceSequence, fasta_file_from, is_fasta_memory_mappable
+from shared.bam_index import bam_index_from, is_region_covered_in
+from shared.binary_format import candidate_blocks_from, tensor_block_bytes_from
+from shared.tensor_ring import (
+    TensorRingWriter, tensor_slot_block_bytes_from, DEFAULT_NO_OF_TENSOR_RING_SLOTS, MINIMUM_NO_OF_TENSOR_RING_SLOTS
+)
 
 is_pypy = '__pypy__' in sys.builtin_module_names
 
@@ -25,79 +43,418 @@ no_of_positions = 2 * param.flankingBaseNum + 1
 matrix_row = param.matrixRow
 matrix_num = param.matrixNum
 
+# columns of a TensorColumnWindow row: the matrix_row x matrix_num counts of a tensor position,
+# the deletions (forward, reverse strand) among them, and the number of reads reaching the position
+TENSOR_CELL_COUNT = matrix_row * matrix_num
+DELETION_COLUMN_INDEX = TENSOR_CELL_COUNT
+READ_COLUMN_INDEX = TENSOR_CELL_COUNT + 2
+NO_OF_WINDOW_COLUMNS = TENSOR_CELL_COUNT + 3
+
+# tensor row of a base (as an ASCII code) on the forward strand, -1 for bases not counted
+TENSOR_ROW_LOOKUP = np.full(256, -1, dtype=np.int64)
+for base, num in BASE2NUM.items():
+    TENSOR_ROW_LOOKUP[ord(base)] = num
+
+
+def tensor_rows_from(sequence):
+    return TENSOR_ROW_LOOKUP[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+
+class CandidateTensorCounts(object):
+    """
+    Tensor counts of a candidate, each aligned base of a read is counted as soon as it is walked,
+    so no alignment of the reads is kept.
+    """
+
+    def __init__(self, center):
+        self.center = center
+        self.tensor = [[[0] * matrix_num for _ in range(matrix_row)] for _ in range(no_of_positions)]
+        self.depth = [0] * no_of_positions
+
+    def add(self, reference_position, queryAdv, reference_base, query_base, STRAND):
+        if reference_base not in BASES or query_base not in BASES:
+            return
+        position_index = reference_position - self.center + (param.flankingBaseNum + 1)
+        if not (0 <= position_index < no_of_positions):
+            return
+
+        tensor = self.tensor
+        strand_offset = 4 if STRAND else 0
+        if query_base != "-" and reference_base != "-":
+            self.depth[position_index] = self.depth[position_index] + 1
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][0] += 1
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][3] += 1
+        elif query_base != "-" and reference_base == "-":
+            position_index = min(position_index + queryAdv, no_of_positions - 1)
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
+        elif query_base == "-" and reference_base != "-":
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
+        else:
+            print("Should not reach here: %s, %s" % (reference_base, query_base), file=sys.stderr)
+
 
-def generate_tensor(ctg_name, alignments, center, reference_sequence, reference_start_0_based, minimum_coverage):
+def generate_tensor(tensor_counts, reference_start_0_based, minimum_coverage):
+    """
+    tensor of a candidate, None if its flanking bases start before the reference or the depth is less than minimum coverage
+    """
     flanking_base_num = param.flankingBaseNum
-    tensor = [[[0] * matrix_num for _ in range(matrix_row)] for _ in range(no_of_positions)]
-    depth = [0] * no_of_positions
+    new_reference_position = tensor_counts.center - reference_start_0_based
+    if new_reference_position - (flanking_base_num+1) < 0 or tensor_counts.depth[flanking_base_num] < minimum_coverage:
+        return None
+    return tensor_counts.tensor
 
-    for alignment in alignments:
-        for reference_position, queryAdv, reference_base, query_base, STRAND in alignment:
-            if str(reference_base) not in BASES or str(query_base) not in BASES:
-                continue
-            position_index = reference_position - center + (flanking_base_num + 1)
-            if not (0 <= position_index < no_of_positions):
-                continue
 
-            strand_offset = 4 if STRAND else 0
-            if query_base != "-" and reference_base != "-":
-                depth[position_index] = depth[position_index] + 1
-                tensor[position_index][BASE2NUM[reference_base] + strand_offset][0] += 1
-                tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
-                tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
-                tensor[position_index][BASE2NUM[query_base] + strand_offset][3] += 1
-            elif query_base != "-" and reference_base == "-":
-                position_index = min(position_index + queryAdv, no_of_positions - 1)
-                tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
-            elif query_base == "-" and reference_base != "-":
-                tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
-            else:
-                print("Should not reach here: %s, %s" % (reference_base, query_base), file=sys.stderr)
+class TensorOutput(object):
+    """
+    Tensors of a contig, written as text rows (contig, position, reference sequence, tensor counts)
+    or as binary blocks (made by block_bytes_from) of at most BLOCK_SIZE tensors.
+    """
 
-    new_reference_position = center - reference_start_0_based
-    if new_reference_position - (flanking_base_num+1) < 0 or depth[flanking_base_num] < minimum_coverage:
-        return None
-    return "%s %d %s %s" % (
+    BLOCK_SIZE = param.predictBatchSize
+
+    def __init__(
+        self,
+        write,
+        ctg_name,
+        reference_sequence,
+        reference_start_0_based,
+        tensor_format="text",
+        block_bytes_from=tensor_block_bytes_from
+    ):
+        self.write = write
+        self.block_bytes_from = block_bytes_from
+        self.ctg_name = ctg_name
+        self.reference_sequence = reference_sequence
+        self.reference_start_0_based = reference_start_0_based
+        self.is_binary = tensor_format == "binary"
+        self.positions = []
+        self.reference_sequences = []
+        self.tensors = []
+
+    def reference_sequence_of(self, center):
+        flanking_base_num = param.flankingBaseNum
+        new_reference_position = center - self.reference_start_0_based
+        return self.reference_sequence[new_reference_position-(flanking_base_num+1):new_reference_position + flanking_base_num]
+
+    def add(self, center, tensor):
+        """
+        add the tensor (e.g. no_of_positions x matrix_row x matrix_num, array or nested lists) of a 1-based position
+        """
+        if not self.is_binary:
+            self.write("%s %d %s %s\n" % (
+                self.ctg_name,
+                center,
+                self.reference_sequence_of(center),
+                " ".join(map(str, np.ravel(tensor).tolist()))
+            ))
+            return
+
+        self.positions.append(center)
+        self.reference_sequences.append(self.reference_sequence_of(center))
+        # a copy, the tensor may be a view into columns reused afterwards
+        self.tensors.append(np.array(tensor))
+        if len(self.positions) >= self.BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.positions) == 0:
+            return
+        self.write(self.block_bytes_from(
+            ctg_name=self.ctg_name,
+            positions=self.positions,
+            reference_sequences=self.reference_sequences,
+            tensors=np.array(self.tensors)
+        ))
+        self.positions, self.reference_sequences, self.tensors = [], [], []
+
+
+class TensorRingOutput(TensorOutput):
+    """
+    Tensors of a contig written straight into the slots of a tensor ring (as float32 counts) as they are added,
+    with a binary block of the metadata of a slot written once it is full (BLOCK_SIZE tensors) or flushed.
+    """
+
+    def __init__(self, write, tensor_ring_writer, ctg_name, reference_sequence, reference_start_0_based):
+        TensorOutput.__init__(self, write, ctg_name, reference_sequence, reference_start_0_based, "binary")
+        self.tensor_ring_writer = tensor_ring_writer
+        self.slot_index = None
+
+    def add(self, center, tensor):
+        if self.slot_index is None:
+            self.slot_index = self.tensor_ring_writer.free_slot_index()
+        slot = self.tensor_ring_writer.slots[self.slot_index]
+        slot[len(self.positions)] = np.reshape(tensor, slot.shape[1:])
+        self.positions.append(center)
+        self.reference_sequences.append(self.reference_sequence_of(center))
+        if len(self.positions) >= self.BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.positions) == 0:
+            return
+        self.write(tensor_slot_block_bytes_from(
+            ctg_name=self.ctg_name,
+            slot_index=self.slot_index,
+            positions=self.positions,
+            reference_sequences=self.reference_sequences
+        ))
+        self.positions, self.reference_sequences = [], []
+        self.slot_index = None
+
+
+def tensor_output_from(args, tensor_fp, ctg_name, reference_sequence, reference_start_0_based):
+    """
+    tensor output in args.tensor_format, written to tensor_fp
+    """
+    if args.tensor_format != "shared_memory":
+        return TensorOutput(
+            tensor_fp.stdin.write, ctg_name, reference_sequence, reference_start_0_based, args.tensor_format
+        )
+
+    # the metadata is flushed for every slot, as the next slot may only be freed after the consumer reads it
+    def write(block_bytes):
+        tensor_fp.stdin.write(block_bytes)
+        tensor_fp.stdin.flush()
+
+    return TensorRingOutput(
+        write,
+        TensorRingWriter(args.tensor_ring_fn, args.tensor_ring_slots),
         ctg_name,
-        center,
-        reference_sequence[new_reference_position-(flanking_base_num+1):new_reference_position + flanking_base_num],
-        " ".join((" ".join(" ".join("%d" % x for x in innerlist) for innerlist in outerlist)) for outerlist in tensor)
+        reference_sequence,
+        reference_start_0_based
     )
 
 
+def check_tensor_ring_args(args):
+    if args.tensor_format != "shared_memory":
+        return
+    if args.tensor_ring_fn is None or args.tensor_fn != "PIPE":
+        sys.exit("[ERROR] Shared memory tensor output needs --tensor_ring_fn and PIPE as --tensor_fn.")
+    if args.tensor_ring_slots < MINIMUM_NO_OF_TENSOR_RING_SLOTS:
+        sys.exit("[ERROR] A tensor ring needs at least %d slots." % (MINIMUM_NO_OF_TENSOR_RING_SLOTS))
+
+
+class TensorColumnWindow(object):
+    """
+    Tensor counts of every reference position in a window of reads, shared by all candidates in the window.
+    The tensor of a candidate is the slice of the columns of its flanking positions, instead of being
+    counted again from the reads of each candidate (as CandidateTensorCounts does).
+
+    Counts are the same as CandidateTensorCounts with the left edge considered: a read counts for a candidate
+    from its first base in the flanking window, so deletions at the window start and insertions before it
+    (or before the first aligned base of the read) are not counted, and the bases of an insertion spilling
+    over the window end are all counted in the last position.
+    Candidates are added in 1-based position order, with no read before the window start of the last one.
+    """
+
+    def __init__(self, reference_sequence, reference_start_0_based, minimum_coverage):
+        self.columns = PileupWindow(no_of_columns=NO_OF_WINDOW_COLUMNS)
+        # 0-based reference position -> [tensor rows (-1 if not counted) of the bases of an insertion before it, ...]
+        self.insertions = {}
+        self.insertion_positions = []
+        self.candidates = deque()
+        self.reference_sequence = reference_sequence
+        self.reference_start_0_based = reference_start_0_based
+        self.minimum_coverage = minimum_coverage
+
+    def add_candidate(self, position):
+        if self.candidates and self.candidates[-1] == position:
+            return
+        self.candidates.append(position)
+
+    def is_in_windows(self, start, end):
+        """
+        whether the 0-based region [start, end] overlaps the flanking window of any candidate
+        """
+        flanking_base_num = param.flankingBaseNum
+        for center in self.candidates:
+            if center + (flanking_base_num + 1) >= start:
+                return center - (flanking_base_num + 1) <= end
+        return False
+
+    def _reference_rows_of(self, start, end):
+        rows = np.full(end - start, -1, dtype=np.int64)
+        offset = start - self.reference_start_0_based
+        begin, stop = max(offset, 0), min(offset + (end - start), len(self.reference_sequence))
+        if begin < stop:
+            rows[begin - offset:stop - offset] = tensor_rows_from(self.reference_sequence[begin:stop])
+        return rows
+
+    def add_read(self, read):
+        strand_offset = 4 if read.is_reverse else 0
+        query_rows = tensor_rows_from(read.sequence)
+        query_rows = np.where(query_rows >= 0, query_rows + strand_offset, -1)
+
+        reference_position = read.position
+        query_position = 0
+        for operation, advance in read.cigartuples or []:
+            if operation == BAM_CSOFT_CLIP:
+                query_position += advance
+
+            elif operation == BAM_CMATCH or operation == BAM_CEQUAL or operation == BAM_CDIFF:
+                reference_rows = self._reference_rows_of(reference_position, reference_position + advance)
+                reference_rows = np.where(reference_rows >= 0, reference_rows + strand_offset, -1)
+                base_rows = query_rows[query_position:query_position + advance]
+                is_counted = (reference_rows >= 0) & (base_rows >= 0)
+
+                cells = np.empty((advance, 5), dtype=np.int64)
+                cells[:, 0] = np.where(is_counted, reference_rows * matrix_num, -1)
+                cells[:, 1] = np.where(is_counted, base_rows * matrix_num + 1, -1)
+                cells[:, 2] = np.where(is_counted, reference_rows * matrix_num + 2, -1)
+                cells[:, 3] = np.where(is_counted, base_rows * matrix_num + 3, -1)
+                cells[:, 4] = READ_COLUMN_INDEX
+                self.columns.add_bases(reference_position, cells)
+
+                reference_position += advance
+                query_position += advance
+
+            elif operation == BAM_CINS:
+                if reference_position != read.position and reference_position >= self.columns.start:
+                    if reference_position not in self.insertions:
+                        self.insertions[reference_position] = []
+                        heapq.heappush(self.insertion_positions, reference_position)
+                    self.insertions[reference_position].append(
+                        query_rows[query_position:query_position + advance].tolist()
+                    )
+                query_position += advance
+
+            elif operation == BAM_CDEL:
+                reference_rows = self._reference_rows_of(reference_position, reference_position + advance)
+                is_counted = reference_rows >= 0
+                if reference_position == read.position:
+                    is_counted[0] = False
+
+                cells = np.empty((advance, 3), dtype=np.int64)
+                cells[:, 0] = np.where(is_counted, (reference_rows + strand_offset) * matrix_num + 2, -1)
+                cells[:, 1] = np.where(is_counted, DELETION_COLUMN_INDEX + (1 if read.is_reverse else 0), -1)
+                cells[:, 2] = READ_COLUMN_INDEX
+                self.columns.add_bases(reference_position, cells)
+
+                reference_position += advance
+
+    def tensor_of(self, center):
+        """
+        tensor (no_of_positions x matrix_row x matrix_num) of a 1-based candidate position,
+        None if no read reaches its window or the depth is less than the minimum coverage
+        """
+        flanking_base_num = param.flankingBaseNum
+        start = center - (flanking_base_num + 1)
+        if start < self.reference_start_0_based:
+            return None
+
+        # as with CandidateTensorCounts, a read reaching only the position after the tensor still makes a tensor
+        columns = self.columns.columns_of(start, start + no_of_positions + 1)
+        if not columns[:, READ_COLUMN_INDEX].any():
+            return None
+
+        tensor = columns[:no_of_positions, :TENSOR_CELL_COUNT].reshape((no_of_positions, matrix_row, matrix_num))
+        if tensor[flanking_base_num, :, 0].sum() < self.minimum_coverage:
+            return None
+
+        insertion_tensor_positions = []
+        insertion_rows = []
+        for position in range(start + 1, start + no_of_positions):
+            for rows in self.insertions.get(position, ()):
+                for query_offset, row in enumerate(rows):
+                    if row >= 0:
+                        insertion_tensor_positions.append(min(position - start + query_offset, no_of_positions - 1))
+                        insertion_rows.append(row)
+
+        forward_deletions, reverse_deletions = columns[0, DELETION_COLUMN_INDEX:DELETION_COLUMN_INDEX + 2].tolist()
+        if len(insertion_rows) == 0 and forward_deletions == 0 and reverse_deletions == 0:
+            return tensor
+
+        tensor = tensor.copy()
+        if forward_deletions > 0 or reverse_deletions > 0:
+            reference_row = self._reference_rows_of(start, start + 1)[0]
+            tensor[0, reference_row, 2] -= forward_deletions
+            tensor[0, reference_row + 4, 2] -= reverse_deletions
+        np.add.at(tensor[:, :, 1], (insertion_tensor_positions, insertion_rows), 1)
+        return tensor
+
+    def tensors_before(self, position=None):
+        """
+        (candidate position, tensor) of candidates with the window ending before the 0-based position
+        (all candidates if not given), columns no longer needed are flushed
+        """
+        flanking_base_num = param.flankingBaseNum
+        while self.candidates and (position is None or self.candidates[0] + (flanking_base_num + 1) < position):
+            center = self.candidates.popleft()
+            tensor = self.tensor_of(center)
+            if tensor is not None:
+                yield center, tensor
+
+        if position is None:
+            return
+        if self.candidates:
+            position = min(position, self.candidates[0] - (flanking_base_num + 1))
+        self.columns.flush(position)
+        while self.insertion_positions and self.insertion_positions[0] < self.columns.start:
+            del self.insertions[heapq.heappop(self.insertion_positions)]
+
+
+class CandidateWindows(object):
+    """
+    Flanking windows of the candidates not counted yet, held as a sorted array of 0-based window starts
+    and queried with searchsorted. A window starts at center - (flankingBaseNum + 1) and ends
+    (inclusive) at center + (flankingBaseNum + 1).
+    Candidates are added in 1-based position order, windows starting before the current read are dropped.
+    """
+
+    def __init__(self):
+        self.starts = np.empty(0, dtype=np.int64)
+        self.added_starts = []
+
+    def add_candidate(self, position):
+        window_start = position - (param.flankingBaseNum + 1)
+        last_window_start = self.added_starts[-1] if self.added_starts else (
+            self.starts[-1] if len(self.starts) > 0 else None
+        )
+        if last_window_start == window_start:
+            return
+        self.added_starts.append(window_start)
+
+    def windows_starting_in(self, start, end):
+        """
+        (window starts, candidate positions) as lists, of the windows starting in the 0-based region [start, end]
+        """
+        if self.added_starts:
+            self.starts = np.concatenate([self.starts, np.array(self.added_starts, dtype=np.int64)])
+            self.added_starts = []
+
+        self.starts = self.starts[np.searchsorted(self.starts, start, side="left"):]
+        window_starts = self.starts[:np.searchsorted(self.starts, end, side="right")]
+        return window_starts.tolist(), (window_starts + (param.flankingBaseNum + 1)).tolist()
+
+
 def candidate_position_generator_from(
     candidate_file_path,
     ctg_start,
     ctg_end,
-    is_consider_left_edge,
-    flanking_base_num,
-    begin_to_end
+    bed_sweeper=None,
+    candidate_format="text"
 ):
+    is_binary = candidate_format == "binary"
     is_read_file_from_standard_input = candidate_file_path == "PIPE"
     if is_read_file_from_standard_input:
-        candidate_file_path_output = sys.stdin
+        candidate_file_path_output = sys.stdin.buffer if is_binary else sys.stdin
     else:
-        candidate_file_path_process = subprocess_popen(shlex.split("gzip -fdc %s" % (candidate_file_path)))
+        candidate_file_path_process = gzip_input_from(candidate_file_path, universal_newlines=not is_binary)
         candidate_file_path_output = candidate_file_path_process.stdout
 
     is_ctg_region_provided = ctg_start is not None and ctg_end is not None
 
-    for row in candidate_file_path_output:
-        row = row.split(maxsplit=2)
-        position = int(row[1])  # 1-based position
+    for ctg_name, position in candidate_ctg_positions_from(candidate_file_path_output, candidate_format):
+        # 1-based position
 
         if is_ctg_region_provided and not (ctg_start <= position <= ctg_end):
             continue
 
-        if is_consider_left_edge:
-            # i is 0-based
-            for i in range(position - (flanking_base_num + 1), position + (flanking_base_num + 1)):
-                if i not in begin_to_end:
-                    begin_to_end[i] = [(position + (flanking_base_num + 1), position)]
-                else:
-                    begin_to_end[i].append((position + (flanking_base_num + 1), position))
-        else:
-            begin_to_end[position - (flanking_base_num + 1)] = [(position + (flanking_base_num + 1), position)]
+        # bed regions are 0-based
+        if bed_sweeper is not None and not bed_sweeper.is_position_in(ctg_name, position - 1):
+            continue
 
         yield position
 
@@ -107,6 +464,21 @@ def candidate_position_generator_from(
     yield -1
 
 
+def candidate_ctg_positions_from(candidate_file, candidate_format):
+    """
+    (contig name, 1-based position) of candidates in a text or binary candidate stream
+    """
+    if candidate_format == "binary":
+        for ctg_name, records in candidate_blocks_from(candidate_file):
+            for position in records["position"].tolist():
+                yield ctg_name, position
+        return
+
+    for row in candidate_file:
+        row = row.split(maxsplit=2)
+        yield row[0], int(row[1])
+
+
 class TensorStdout(object):
     def __init__(self, handle):
         self.stdin = handle
@@ -133,6 +505,22 @@ def reference_result_from(
     else:
         region_str = ctg_name
 
+    if is_fasta_memory_mappable(reference_file_path):
+        fasta_file = fasta_file_from(reference_file_path)
+        is_ctg_in_fasta = ctg_name in fasta_file
+        return ReferenceResult(
+            name=region_str,
+            start=reference_start,
+            end=reference_end,
+            sequence=ReferenceSequence(
+                fasta_file=fasta_file,
+                ctg_name=ctg_name,
+                start=0 if reference_start is None else reference_start - 1,
+                end=reference_end
+            ) if is_ctg_in_fasta else "",
+            is_faidx_process_have_error=not is_ctg_in_fasta,
+        )
+
     faidx_process = subprocess_popen(shlex.split("%s faidx %s %s" % (samtools, reference_file_path, region_str)),)
     if faidx_process is None:
         return None
@@ -176,94 +564,54 @@ def samtools_view_process_from(
     )
 
 
-def OutputAlnTensor(args):
-    available_slots = 5000000
-    samtools = args.samtools
-    tensor_file_path = args.tensor_fn
-    bam_file_path = args.bam_fn
-    reference_file_path = args.ref_fn
-    candidate_file_path = args.can_fn
-    dcov = args.dcov
-    is_consider_left_edge = not args.stop_consider_left_edge
-    min_coverage = args.minCoverage
-    minimum_mapping_quality = args.minMQ
-    ctg_name = args.ctgName
-    ctg_start = args.ctgStart
-    ctg_end = args.ctgEnd
-
-    reference_result = reference_result_from(
-        ctg_name=ctg_name,
-        ctg_start=ctg_start,
-        ctg_end=ctg_end,
-        samtools=samtools,
-        reference_file_path=reference_file_path,
-        expand_reference_region=param.expandReferenceRegion,
-    )
-
-    reference_sequence = reference_result.sequence if reference_result is not None else ""
-    is_faidx_process_have_error = reference_result is None or reference_result.is_faidx_process_have_error
-    have_reference_sequence = reference_result is not None and len(reference_sequence) > 0
-
-    if reference_result is None or is_faidx_process_have_error or not have_reference_sequence:
-        print("Failed to load reference seqeunce. Please check if the provided reference fasta %s and the ctgName %s are correct." % (
-            reference_file_path,
-            ctg_name
-        ), file=sys.stderr)
-        sys.exit(1)
-
-    reference_start = reference_result.start
-    reference_start_0_based = 0 if reference_start is None else (reference_start - 1)
-    begin_to_end = {}
+def candidate_tensors_from(
+    reads,
+    candidate_positions,
+    reference_sequence,
+    reference_start_0_based,
+    is_consider_left_edge,
+    minimum_mapping_quality,
+    dcov,
+    min_coverage
+):
+    """
+    (1-based candidate position, tensor) of the candidates in candidate_positions (sorted, ending with -1)
+    counted from the sorted reads, in candidate order
+    """
+    # with the left edge considered, tensors are sliced from the columns shared by all candidates,
+    # otherwise counted for each candidate from the reads covering its window start
+    tensor_column_window = TensorColumnWindow(
+        reference_sequence, reference_start_0_based, min_coverage
+    ) if is_consider_left_edge else None
+    candidate_windows = CandidateWindows() if tensor_column_window is None else None
+    window_length = 2 * (param.flankingBaseNum + 1)
     candidate_position = 0
-    candidate_position_generator = candidate_position_generator_from(
-        candidate_file_path=candidate_file_path,
-        ctg_start=ctg_start,
-        ctg_end=ctg_end,
-        is_consider_left_edge=is_consider_left_edge,
-        flanking_base_num=param.flankingBaseNum,
-        begin_to_end=begin_to_end
-    )
-
-    samtools_view_process = samtools_view_process_from(
-        ctg_name=ctg_name,
-        ctg_start=ctg_start,
-        ctg_end=ctg_end,
-        samtools=samtools,
-        bam_file_path=bam_file_path
-    )
-
-    center_to_alignment = {}
-
-    if tensor_file_path != "PIPE":
-        tensor_fpo = open(tensor_file_path, "wb")
-        tensor_fp = subprocess_popen(shlex.split("gzip -c"), stdin=PIPE, stdout=tensor_fpo)
-    else:
-        tensor_fp = TensorStdout(sys.stdout)
+    candidate_position_generator = iter(candidate_positions)
+    center_to_tensor_counts = {}
 
     previous_position = 0
     depthCap = 0
-    for l in samtools_view_process.stdout:
-        l = l.split()
-        if l[0][0] == "@":
-            continue
-
-        FLAG = int(l[1])
-        POS = int(l[3]) - 1  # switch from 1-base to 0-base to match sequence index
-        MQ = int(l[4])
-        CIGAR = l[5]
-        SEQ = l[9].upper()   # uppercase for SEQ (regexp is \*|[A-Za-z=.]+)
+    for read in reads:
+        POS = read.position
+        MQ = read.mapping_quality
+        SEQ = read.sequence
         reference_position = POS
         query_position = 0
-        STRAND = (16 == (FLAG & 16))
+        STRAND = read.is_reverse
 
         if MQ < minimum_mapping_quality:
             continue
 
-        end_to_center = {}
-        active_set = set()
-
-        while candidate_position != -1 and candidate_position < (POS + len(SEQ) + 100000):
+        # candidates are read up to the first one with the window starting after the read
+        read_end = POS if read.cigartuples is None else reference_end_from(POS, read.cigartuples)
+        while candidate_position != -1 and candidate_position <= read_end + (param.flankingBaseNum + 1):
             candidate_position = next(candidate_position_generator)
+            if candidate_position == -1:
+                break
+            if tensor_column_window is not None:
+                tensor_column_window.add_candidate(candidate_position)
+            else:
+                candidate_windows.add_candidate(candidate_position)
 
         if previous_position != POS:
             previous_position = POS
@@ -274,124 +622,364 @@ def OutputAlnTensor(args):
                 #print >> sys.stderr, "Bypassing POS %d at depth %d\n" % (POS, depthCap)
                 continue
 
-        advance = 0
-        for c in str(CIGAR):
-            if available_slots <= 0:
-                break
+        if tensor_column_window is not None:
+            if read.cigartuples is not None and tensor_column_window.is_in_windows(POS, read_end):
+                tensor_column_window.add_read(read)
+            if depthCap == 0:
+                for center, tensor in tensor_column_window.tensors_before(POS):
+                    yield center, tensor
+            continue
 
-            if c.isdigit():
-                advance = advance * 10 + int(c)
-                continue
+        # windows are activated at their starts, only windows starting within the read can be counted
+        window_starts, window_centers = candidate_windows.windows_starting_in(POS, read_end)
+        no_of_windows = len(window_starts)
+        # windows of the same length end in the order they start,
+        # so the active windows are always window_centers[first_active_window:next_window]
+        next_window = 0
+        first_active_window = 0
 
+        for operation, advance in read.cigartuples or []:
             # soft clip
-            if c == "S":
+            if operation == BAM_CSOFT_CLIP:
                 query_position += advance
 
             # match / mismatch
-            if c == "M" or c == "=" or c == "X":
-                for _ in range(advance):
-                    if reference_position in begin_to_end:
-                        for rEnd, rCenter in begin_to_end[reference_position]:
-                            if rCenter in active_set:
-                                continue
-                            end_to_center[rEnd] = rCenter
-                            active_set.add(rCenter)
-                            center_to_alignment.setdefault(rCenter, [])
-                            center_to_alignment[rCenter].append([])
-                    for center in list(active_set):
-                        if available_slots <= 0:
+            if operation == BAM_CMATCH or operation == BAM_CEQUAL or operation == BAM_CDIFF:
+                run_end = reference_position + advance
+                while reference_position < run_end:
+                    if first_active_window == next_window:
+                        # nothing is counted until the next window start
+                        next_position = window_starts[next_window] if next_window < no_of_windows else run_end
+                        if next_position >= run_end:
+                            query_position += run_end - reference_position
+                            reference_position = run_end
                             break
-                        available_slots -= 1
-
-                        center_to_alignment[center][-1].append((
+                        query_position += next_position - reference_position
+                        reference_position = next_position
+
+                    if next_window < no_of_windows and window_starts[next_window] == reference_position:
+                        if window_centers[next_window] not in center_to_tensor_counts:
+                            center_to_tensor_counts[window_centers[next_window]] = CandidateTensorCounts(
+                                window_centers[next_window]
+                            )
+                        next_window += 1
+                    for center in window_centers[first_active_window:next_window]:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             0,
                             reference_sequence[reference_position - reference_start_0_based],
                             SEQ[query_position],
                             STRAND
-                        ))
-                    if reference_position in end_to_center:
-                        center = end_to_center[reference_position]
-                        active_set.remove(center)
+                        )
+                    if (
+                        first_active_window < next_window and
+                        window_starts[first_active_window] + window_length == reference_position
+                    ):
+                        first_active_window += 1
                     reference_position += 1
                     query_position += 1
 
             # insertion
-            if c == "I":
+            if operation == BAM_CINS:
+                if first_active_window == next_window:
+                    query_position += advance
+                    continue
                 for queryAdv in range(advance):
-                    for center in list(active_set):
-                        if available_slots <= 0:
-                            break
-                        available_slots -= 1
-
-                        center_to_alignment[center][-1].append((
+                    for center in window_centers[first_active_window:next_window]:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             queryAdv,
                             "-",
                             SEQ[query_position],
                             STRAND
-                        ))
+                        )
                     query_position += 1
 
             # deletion
-            if c == "D":
-                for _ in range(advance):
-                    for center in list(active_set):
-                        if available_slots <= 0:
+            if operation == BAM_CDEL:
+                run_end = reference_position + advance
+                while reference_position < run_end:
+                    if first_active_window == next_window:
+                        # nothing is counted until the next window start
+                        next_position = window_starts[next_window] if next_window < no_of_windows else run_end
+                        if next_position >= run_end:
+                            reference_position = run_end
                             break
-                        available_slots -= 1
+                        reference_position = next_position
 
-                        center_to_alignment[center][-1].append((
+                    for center in window_centers[first_active_window:next_window]:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             0,
                             reference_sequence[reference_position - reference_start_0_based],
                             "-",
                             STRAND
-                        ))
-                    if reference_position in begin_to_end:
-                        for rEnd, rCenter in begin_to_end[reference_position]:
-                            if rCenter in active_set:
-                                continue
-                            end_to_center[rEnd] = rCenter
-                            active_set.add(rCenter)
-                            center_to_alignment.setdefault(rCenter, [])
-                            center_to_alignment[rCenter].append([])
-                    if reference_position in end_to_center:
-                        center = end_to_center[reference_position]
-                        active_set.remove(center)
+                        )
+                    if next_window < no_of_windows and window_starts[next_window] == reference_position:
+                        if window_centers[next_window] not in center_to_tensor_counts:
+                            center_to_tensor_counts[window_centers[next_window]] = CandidateTensorCounts(
+                                window_centers[next_window]
+                            )
+                        next_window += 1
+                    if (
+                        first_active_window < next_window and
+                        window_starts[first_active_window] + window_length == reference_position
+                    ):
+                        first_active_window += 1
                     reference_position += 1
 
-            # reset advance
-            advance = 0
-
         if depthCap == 0:
-            for center in list(center_to_alignment.keys()):
+            for center in list(center_to_tensor_counts.keys()):
                 if center + (param.flankingBaseNum + 1) >= POS:
                     continue
-                l = generate_tensor(
-                    ctg_name, center_to_alignment[center], center, reference_sequence, reference_start_0_based, min_coverage
-                )
-                if l != None:
-                    tensor_fp.stdin.write(l)
-                    tensor_fp.stdin.write("\n")
-                available_slots += sum(len(i) for i in center_to_alignment[center])
-                #print >> sys.stderr, "POS %d: remaining slots %d" % (center, available_slots)
-                del center_to_alignment[center]
-
-    for center in center_to_alignment.keys():
-        l = generate_tensor(
-            ctg_name, center_to_alignment[center], center, reference_sequence, reference_start_0_based, min_coverage
-        )
-        if l != None:
-            tensor_fp.stdin.write(l)
-            tensor_fp.stdin.write("\n")
+                tensor = generate_tensor(center_to_tensor_counts[center], reference_start_0_based, min_coverage)
+                if tensor is not None:
+                    yield center, tensor
+                del center_to_tensor_counts[center]
+
+    for center in center_to_tensor_counts.keys():
+        tensor = generate_tensor(center_to_tensor_counts[center], reference_start_0_based, min_coverage)
+        if tensor is not None:
+            yield center, tensor
+
+    if tensor_column_window is not None:
+        for center, tensor in tensor_column_window.tensors_before():
+            yield center, tensor
+
+
+def reads_in_region_from(args, ctg_name, ctg_start=None, ctg_end=None):
+    """
+    reads overlapping the 1-based region [ctg_start, ctg_end] (whole contig if not given),
+    read with pysam or from "samtools view"
+    """
+    if args.pysam_for_reading_bam:
+        is_ctg_range_given = ctg_start is not None and ctg_end is not None
+        for read in pysam_reads_from(
+            bam_file_path=args.bam_fn,
+            ctg_name=ctg_name,
+            regions=["%s:%d-%d" % (ctg_name, ctg_start, ctg_end) if is_ctg_range_given else ctg_name]
+        ):
+            yield read
+        return
 
+    samtools_view_process = samtools_view_process_from(
+        ctg_name=ctg_name,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end,
+        samtools=args.samtools,
+        bam_file_path=args.bam_fn
+    )
+    for read in aligned_reads_from(samtools_view_process.stdout):
+        yield read
     samtools_view_process.stdout.close()
     samtools_view_process.wait()
+
+
+def candidate_partitions_from(positions, no_of_partitions):
+    """
+    sorted candidate positions split into at most no_of_partitions contiguous partitions of about the same size,
+    a position repeated is kept in one partition
+    """
+    partitions = []
+    begin = 0
+    for partition_index in range(no_of_partitions):
+        end = len(positions) * (partition_index + 1) // no_of_partitions
+        while 0 < end < len(positions) and positions[end] == positions[end - 1]:
+            end += 1
+        if end > begin:
+            partitions.append(positions[begin:end])
+            begin = end
+    return partitions
+
+
+def partition_reads_from(args, ctg_name, ctg_start, ctg_end, positions):
+    """
+    reads of [ctg_start, ctg_end] (whole contig if not given) for the tensors of a partition (sorted positions),
+    the same reads as for all candidates in one pass as far as the tensors of the partition are concerned
+
+    Reads are fetched for the flanking windows of the partition. For the depth cap (of reads starting at the
+    same position), reads starting before the first window are fetched again from the start of the first read,
+    so every read starting there is seen, in BAM order, as in one pass.
+    """
+    flanking_base_num = param.flankingBaseNum
+    is_ctg_range_given = ctg_start is not None and ctg_end is not None
+
+    # 1-based region [start, end] of the flanking windows of the partition, within [ctg_start, ctg_end]
+    start = max(positions[0] - flanking_base_num, 1)
+    end = positions[-1] + flanking_base_num + 2
+    if is_ctg_range_given:
+        start, end = max(start, ctg_start), min(end, ctg_end)
+    if start > end:
+        return
+
+    reads = reads_in_region_from(args, ctg_name, start, end)
+    first_read = next(reads, None)
+    if first_read is None:
+        return
+
+    # reads starting before the region overlap it or start where a read overlapping it starts,
+    # those also fetched again are taken from the lookback only
+    lookback_start = max(first_read.position + 1, ctg_start if is_ctg_range_given else 1)
+    is_looking_back = lookback_start < start
+    if is_looking_back:
+        for read in reads_in_region_from(args, ctg_name, lookback_start, start - 1):
+            yield read
+
+    for read in chain([first_read], reads):
+        if not is_looking_back or read.position >= start - 1:
+            yield read
+
+
+# arguments and reference of a partition worker process, set by initialize_partition_worker
+partition_worker_context = {}
+
+
+def initialize_partition_worker(args, reference_sequence, reference_start_0_based):
+    partition_worker_context["args"] = args
+    partition_worker_context["reference_sequence"] = reference_sequence
+    partition_worker_context["reference_start_0_based"] = reference_start_0_based
+
+
+def tensor_output_in_partition(positions):
+    """
+    tensor output (text rows, or binary blocks) of a partition of candidates (sorted 1-based positions),
+    or [(position, tensor), ...] for a tensor ring, only written by the main process
+    """
+    args = partition_worker_context["args"]
+    reference_sequence = partition_worker_context["reference_sequence"]
+    reference_start_0_based = partition_worker_context["reference_start_0_based"]
+
+    tensors = candidate_tensors_from(
+        reads=partition_reads_from(args, args.ctgName, args.ctgStart, args.ctgEnd, positions),
+        candidate_positions=positions + [-1],
+        reference_sequence=reference_sequence,
+        reference_start_0_based=reference_start_0_based,
+        is_consider_left_edge=not args.stop_consider_left_edge,
+        minimum_mapping_quality=args.minMQ,
+        dcov=args.dcov,
+        min_coverage=args.minCoverage
+    )
+    if args.tensor_format == "shared_memory":
+        # a copy, the tensor may be a view into columns reused afterwards
+        return [(center, np.array(tensor)) for center, tensor in tensors]
+
+    outputs = []
+    tensor_output = TensorOutput(
+        outputs.append, args.ctgName, reference_sequence, reference_start_0_based, args.tensor_format
+    )
+    for center, tensor in tensors:
+        tensor_output.add(center, tensor)
+    tensor_output.flush()
+    return (b"" if args.tensor_format == "binary" else "").join(outputs)
+
+
+def OutputAlnTensor(args):
+    samtools = args.samtools
+    tensor_file_path = args.tensor_fn
+    bam_file_path = args.bam_fn
+    reference_file_path = args.ref_fn
+    candidate_file_path = args.can_fn
+    dcov = args.dcov
+    is_consider_left_edge = not args.stop_consider_left_edge
+    min_coverage = args.minCoverage
+    minimum_mapping_quality = args.minMQ
+    ctg_name = args.ctgName
+    ctg_start = args.ctgStart
+    ctg_end = args.ctgEnd
+    bed_sweeper = IntervalSweeper(bed_tree_from(bed_file_path=args.bed_fn)) if args.bed_fn is not None else None
+
+    reference_result = reference_result_from(
+        ctg_name=ctg_name,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end,
+        samtools=samtools,
+        reference_file_path=reference_file_path,
+        expand_reference_region=param.expandReferenceRegion,
+    )
+
+    reference_sequence = reference_result.sequence if reference_result is not None else ""
+    is_faidx_process_have_error = reference_result is None or reference_result.is_faidx_process_have_error
+    have_reference_sequence = reference_result is not None and len(reference_sequence) > 0
+
+    if reference_result is None or is_faidx_process_have_error or not have_reference_sequence:
+        print("Failed to load reference seqeunce. Please check if the provided reference fasta %s and the ctgName %s are correct." % (
+            reference_file_path,
+            ctg_name
+        ), file=sys.stderr)
+        sys.exit(1)
+
+    reference_start = reference_result.start
+    reference_start_0_based = 0 if reference_start is None else (reference_start - 1)
+    candidate_position_generator = candidate_position_generator_from(
+        candidate_file_path=candidate_file_path,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end,
+        bed_sweeper=bed_sweeper,
+        candidate_format=args.can_format
+    )
+
+    # no samtools view if the index shows no reads in the range, candidates are still consumed from the input
+    is_ctg_range_given = ctg_start is not None and ctg_end is not None
+    is_region_with_reads = is_region_covered_in(
+        [bam_index_from(bam_file_path)],
+        ctg_name,
+        ctg_start - 1 if is_ctg_range_given else None,
+        ctg_end if is_ctg_range_given else None
+    )
+    if not is_region_with_reads:
+        print("[INFO] No reads in %s by the BAM index, skipped" % (
+            "%s:%d-%d" % (ctg_name, ctg_start, ctg_end) if is_ctg_range_given else ctg_name), file=sys.stderr)
+        for _ in candidate_position_generator:
+            pass
+
+    is_binary_output = args.tensor_format != "text"
+    if tensor_file_path != "PIPE":
+        tensor_fp = gzip_output_from(
+            tensor_file_path,
+            threads=args.compression_threads,
+            level=args.compression_level,
+            universal_newlines=not is_binary_output
+        )
+    else:
+        tensor_fp = TensorStdout(sys.stdout.buffer if is_binary_output else sys.stdout)
+    tensor_output = tensor_output_from(args, tensor_fp, ctg_name, reference_sequence, reference_start_0_based)
+
+    # candidates are read in full and split into contiguous partitions, the tensors are written in candidate order
+    if is_region_with_reads and args.workers > 1:
+        positions = [position for position in candidate_position_generator if position != -1]
+        partitions = candidate_partitions_from(positions, args.workers)
+        if len(partitions) > 0:
+            pool = Pool(
+                processes=len(partitions),
+                initializer=initialize_partition_worker,
+                initargs=(args, reference_sequence, reference_start_0_based)
+            )
+            for output in pool.imap(tensor_output_in_partition, partitions):
+                if not isinstance(tensor_output, TensorRingOutput):
+                    tensor_fp.stdin.write(output)
+                    continue
+                for center, tensor in output:
+                    tensor_output.add(center, tensor)
+            tensor_output.flush()
+            pool.close()
+            pool.join()
+    elif is_region_with_reads:
+        for center, tensor in candidate_tensors_from(
+            reads=reads_in_region_from(args, ctg_name, ctg_start, ctg_end),
+            candidate_positions=candidate_position_generator,
+            reference_sequence=reference_sequence,
+            reference_start_0_based=reference_start_0_based,
+            is_consider_left_edge=is_consider_left_edge,
+            minimum_mapping_quality=minimum_mapping_quality,
+            dcov=dcov,
+            min_coverage=min_coverage
+        ):
+            tensor_output.add(center, tensor)
+        tensor_output.flush()
+
     if tensor_file_path != "PIPE":
         tensor_fp.stdin.close()
         tensor_fp.wait()
-        tensor_fpo.close()
 
 
 def main():
@@ -407,9 +995,30 @@ def main():
     parser.add_argument('--can_fn', type=str, default="PIPE",
                         help="Variant candidate list generated by ExtractVariantCandidates.py or true variant list generated by GetTruth.py, use PIPE for standard input, default: %(default)s")
 
+    parser.add_argument('--can_format', type=str, default="text", choices=["text", "binary"],
+                        help="Candidate input format, binary for the fixed-width records of ExtractVariantCandidates, default: %(default)s")
+
+    parser.add_argument('--bed_fn', type=str, default=None,
+                        help="Generate tensors only for candidates in these regions, optional")
+
     parser.add_argument('--tensor_fn', type=str, default="PIPE",
                         help="Tensor output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--tensor_format', type=str, default="text", choices=["text", "binary", "shared_memory"],
+                        help="Tensor output format, binary for blocks of fixed-width records (uint16 counts), shared_memory for tensors in the slots of --tensor_ring_fn with their metadata output as binary blocks, default: %(default)s")
+
+    parser.add_argument('--tensor_ring_fn', type=str, default=None,
+                        help="Tensor ring (shared memory file with a release FIFO, as created by callVarBam) for the shared_memory tensor format, optional")
+
+    parser.add_argument('--tensor_ring_slots', type=int, default=DEFAULT_NO_OF_TENSOR_RING_SLOTS,
+                        help="The number of slots in the tensor ring, default: %(default)s")
+
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
     parser.add_argument('--minMQ', type=int, default=0,
                         help="Minimum Mapping Quality. Mapping quality lower than the setting will be filtered, default: %(default)d")
 
@@ -425,6 +1034,9 @@ def main():
     parser.add_argument('--samtools', type=str, default="samtools",
                         help="Path to the 'samtools', default: %(default)s")
 
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam instead of parsing the output of 'samtools view', optional")
+
     parser.add_argument('--stop_consider_left_edge', action='store_true',
                         help="If not set, would consider left edge only. That is, count the left-most base-pairs of a read for coverage even if the starting position of a read is after the starting position of a tensor")
 
@@ -434,12 +1046,16 @@ def main():
     parser.add_argument('--minCoverage', type=int, default=0,
                         help="Minimum coverage required to generate a tensor, default: %(default)d")
 
+    parser.add_argument('--workers', type=int, default=1,
+                        help="The number of worker processes, each creating the tensors of a contiguous partition of the candidates, default: %(default)d")
+
     args = parser.parse_args()
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         sys.exit(1)
 
+    check_tensor_ring_args(args)
     OutputAlnTensor(args)
 
 
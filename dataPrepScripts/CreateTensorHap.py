@@ -2,12 +2,17 @@ import sys
 import shlex
 import signal
 import gc
-from subprocess import PIPE
 from argparse import ArgumentParser
 from collections import namedtuple
 
 import shared.param as param
-from shared.utils import subprocess_popen, IUPAC_base_to_num_dict as BASE2NUM
+from shared.alignment import aligned_reads_from, pysam_reads_from, BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CSOFT_CLIP, BAM_CEQUAL, BAM_CDIFF
+from shared.utils import (
+    subprocess_popen, gzip_input_from, gzip_output_from,
+    DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL, IUPAC_base_to_num_dict as BASE2NUM
+)
+from shared.binary_format import NO_OF_HAPLOTYPE_CHANNELS, haplotype_tensor_block_bytes_from
+from dataPrepScripts.CreateTensor import TensorOutput
 
 is_pypy = '__pypy__' in sys.builtin_module_names
 
@@ -25,55 +30,59 @@ no_of_positions = 2 * param.flankingBaseNum + 1
 matrix_row = param.matrixRow
 matrix_num = param.matrixNum
 
+# tensor channel of the reads of a haplotype (HP tag), reads of other haplotypes or not tagged are unphased
+HAPLOTYPE_CHANNEL = {1: 0, 2: 1}
+UNPHASED_CHANNEL = 2
+
+
+class HaplotypeTensorCounts(object):
+    """
+    Tensor counts of a candidate in a channel for each haplotype (HP 1, HP 2, unphased),
+    each aligned base of a read is counted in the channel of the read as soon as it is walked.
+    """
+
+    def __init__(self, center):
+        self.center = center
+        self.tensor = [
+            [[[0] * matrix_num for _ in range(matrix_row)] for _ in range(no_of_positions)]
+            for _ in range(NO_OF_HAPLOTYPE_CHANNELS)
+        ]
+        # depth of reads of all haplotypes
+        self.depth = [0] * no_of_positions
+
+    def add(self, reference_position, queryAdv, reference_base, query_base, STRAND, channel):
+        if reference_base not in BASES or query_base not in BASES:
+            return
+        position_index = reference_position - self.center + (param.flankingBaseNum + 1)
+        if not (0 <= position_index < no_of_positions):
+            return
+
+        tensor = self.tensor[channel]
+        strand_offset = 4 if STRAND else 0
+        if query_base != "-" and reference_base != "-":
+            self.depth[position_index] = self.depth[position_index] + 1
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][0] += 1
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][3] += 1
+        elif query_base != "-" and reference_base == "-":
+            position_index = min(position_index + queryAdv, no_of_positions - 1)
+            tensor[position_index][BASE2NUM[query_base] + strand_offset][1] += 1
+        elif query_base == "-" and reference_base != "-":
+            tensor[position_index][BASE2NUM[reference_base] + strand_offset][2] += 1
+        else:
+            print("Should not reach here: %s, %s" % (reference_base, query_base), file=sys.stderr)
 
-def generate_tensor(ctg_name, alignments, center, reference_sequence, reference_start_0_based, minimum_coverage):
-    flanking_base_num = param.flankingBaseNum
-    tensor = [[[0] * matrix_num for _ in range(matrix_row)] for _ in range(no_of_positions)]
-    depth = [0] * no_of_positions
-
-
-    # =====================================
-    # MODIFIED TO COUNT BY HAPLOTYPE
-    # -------------------------------------
-    # HAPLOTYPE specific
-    h1_depth = [0] * no_of_positions
-    h2_depth = [0] * no_of_positions
 
-    for alignment in alignments:
-        for reference_position, queryAdv, reference_base, query_base, STRAND, haplotype in alignment:
-            if str(reference_base) not in BASES or str(query_base) not in BASES:
-                continue
-            position_index = reference_position - center + (flanking_base_num + 1)
-            if not (0 <= position_index < no_of_positions):
-                continue
-
-            # check the haplotype in alignment
-            HAP2NUM = {1: 0, 2:1, -9: 2}
-
-            strand_offset = 12 if STRAND else 0
-            if query_base != "-" and reference_base != "-":
-                depth[position_index] = depth[position_index] + 1
-                tensor[position_index][BASE2NUM[reference_base] + HAP2NUM[haplotype]*4 + strand_offset][0] += 1
-                tensor[position_index][BASE2NUM[query_base] + HAP2NUM[haplotype]*4 + strand_offset][1] += 1
-                tensor[position_index][BASE2NUM[reference_base] + HAP2NUM[haplotype]*4 + strand_offset][2] += 1
-                tensor[position_index][BASE2NUM[query_base] + HAP2NUM[haplotype]*4 + strand_offset][3] += 1
-            elif query_base != "-" and reference_base == "-":
-                position_index = min(position_index + queryAdv, no_of_positions - 1)
-                tensor[position_index][BASE2NUM[query_base] + HAP2NUM[haplotype]*4 + strand_offset][1] += 1
-            elif query_base == "-" and reference_base != "-":
-                tensor[position_index][BASE2NUM[reference_base] + HAP2NUM[haplotype]*4 + strand_offset][2] += 1
-            else:
-                print("Should not reach here: %s, %s" % (reference_base, query_base), file=sys.stderr)
-    # =====================================
-    new_reference_position = center - reference_start_0_based
-    if new_reference_position - (flanking_base_num+1) < 0 or depth[flanking_base_num] < minimum_coverage:
+def generate_tensor(tensor_counts, reference_start_0_based, minimum_coverage):
+    """
+    haplotype tensor of a candidate, None if its flanking bases start before the reference or the depth is less than minimum coverage
+    """
+    flanking_base_num = param.flankingBaseNum
+    new_reference_position = tensor_counts.center - reference_start_0_based
+    if new_reference_position - (flanking_base_num+1) < 0 or tensor_counts.depth[flanking_base_num] < minimum_coverage:
         return None
-    return "%s %d %s %s" % (
-        ctg_name,
-        center,
-        reference_sequence[new_reference_position-(flanking_base_num+1):new_reference_position + flanking_base_num],
-        " ".join((" ".join(" ".join("%d" % x for x in innerlist) for innerlist in outerlist)) for outerlist in tensor)
-    )
+    return tensor_counts.tensor
 
 
 def candidate_position_generator_from(
@@ -88,7 +97,7 @@ def candidate_position_generator_from(
     if is_read_file_from_standard_input:
         candidate_file_path_output = sys.stdin
     else:
-        candidate_file_path_process = subprocess_popen(shlex.split("gzip -fdc %s" % (candidate_file_path)))
+        candidate_file_path_process = gzip_input_from(candidate_file_path)
         candidate_file_path_output = candidate_file_path_process.stdout
 
     is_ctg_region_provided = ctg_start is not None and ctg_end is not None
@@ -192,7 +201,6 @@ def samtools_view_process_from(
 
 
 def OutputAlnTensor(args):
-    available_slots = 5000000
     samtools = args.samtools
     tensor_file_path = args.tensor_fn
     bam_file_path = args.bam_fn
@@ -242,47 +250,57 @@ def OutputAlnTensor(args):
         begin_to_end=begin_to_end
     )
 
-    # view the region in the bam file
-    samtools_view_process = samtools_view_process_from(
-        ctg_name=ctg_name,
-        ctg_start=ctg_start,
-        ctg_end=ctg_end,
-        samtools=samtools,
-        bam_file_path=bam_file_path
-    )
+    # view the region in the bam file, the haplotype (HP tag) of a read is taken with pysam directly
+    samtools_view_process = None
+    if args.pysam_for_reading_bam:
+        have_start_and_end_position = ctg_start != None and ctg_end != None
+        reads = pysam_reads_from(
+            bam_file_path=bam_file_path,
+            ctg_name=ctg_name,
+            regions=[("%s:%d-%d" % (ctg_name, ctg_start, ctg_end)) if have_start_and_end_position else ctg_name]
+        )
+    else:
+        samtools_view_process = samtools_view_process_from(
+            ctg_name=ctg_name,
+            ctg_start=ctg_start,
+            ctg_end=ctg_end,
+            samtools=samtools,
+            bam_file_path=bam_file_path
+        )
+        reads = aligned_reads_from(samtools_view_process.stdout)
 
-    center_to_alignment = {}
+    center_to_tensor_counts = {}
 
+    is_binary_output = args.tensor_format == "binary"
     if tensor_file_path != "PIPE":
-        tensor_fpo = open(tensor_file_path, "wb")
-        tensor_fp = subprocess_popen(shlex.split("gzip -c"), stdin=PIPE, stdout=tensor_fpo)
+        tensor_fp = gzip_output_from(
+            tensor_file_path,
+            threads=args.compression_threads,
+            level=args.compression_level,
+            universal_newlines=not is_binary_output
+        )
     else:
-        tensor_fp = TensorStdout(sys.stdout)
+        tensor_fp = TensorStdout(sys.stdout.buffer if is_binary_output else sys.stdout)
+    tensor_output = TensorOutput(
+        tensor_fp.stdin.write,
+        ctg_name,
+        reference_sequence,
+        reference_start_0_based,
+        args.tensor_format,
+        block_bytes_from=haplotype_tensor_block_bytes_from
+    )
 
     # go through the output of the samtools view
     previous_position = 0
     depthCap = 0
-    for l in samtools_view_process.stdout:
-        l = l.split()
-        if l[0][0] == "@": # skip if it's the read sequence???
-            continue
-
-        FLAG = int(l[1])
-        POS = int(l[3]) - 1  # switch from 1-base to 0-base to match sequence index
-        MQ = int(l[4])
-        CIGAR = l[5]
-        SEQ = l[9].upper()   # uppercase for SEQ (regexp is \*|[A-Za-z=.]+)
+    for read in reads:
+        POS = read.position
+        MQ = read.mapping_quality
+        SEQ = read.sequence
         reference_position = POS
         query_position = 0
-        STRAND = (16 == (FLAG & 16))
-        # =====================================
-        # MODIFIED TO GRAB HAPLOTYPE
-        # -------------------------------------
-        HAPLOTYPE = "".join([val for val in l if "HP:i:" in val and len(val) == 6])
-        if HAPLOTYPE != "":
-            HAPLOTYPE = int(HAPLOTYPE.split(":")[2])
-        HAPLOTYPE = -9 if HAPLOTYPE == "" else HAPLOTYPE
-        # =====================================
+        STRAND = read.is_reverse
+        channel = HAPLOTYPE_CHANNEL.get(read.haplotype, UNPHASED_CHANNEL)
         if MQ < minimum_mapping_quality:
             continue
 
@@ -301,21 +319,13 @@ def OutputAlnTensor(args):
                 #print >> sys.stderr, "Bypassing POS %d at depth %d\n" % (POS, depthCap)
                 continue
 
-        advance = 0
-        for c in str(CIGAR):
-            if available_slots <= 0:
-                break
-
-            if c.isdigit():
-                advance = advance * 10 + int(c)
-                continue
-
+        for operation, advance in read.cigartuples or []:
             # soft clip
-            if c == "S":
+            if operation == BAM_CSOFT_CLIP:
                 query_position += advance
 
             # match / mismatch
-            if c == "M" or c == "=" or c == "X":
+            if operation == BAM_CMATCH or operation == BAM_CEQUAL or operation == BAM_CDIFF:
                 for _ in range(advance):
                     if reference_position in begin_to_end:
                         for rEnd, rCenter in begin_to_end[reference_position]:
@@ -323,21 +333,17 @@ def OutputAlnTensor(args):
                                 continue
                             end_to_center[rEnd] = rCenter
                             active_set.add(rCenter)
-                            center_to_alignment.setdefault(rCenter, [])
-                            center_to_alignment[rCenter].append([])
-                    for center in list(active_set):
-                        if available_slots <= 0:
-                            break
-                        available_slots -= 1
-
-                        center_to_alignment[center][-1].append((
+                            if rCenter not in center_to_tensor_counts:
+                                center_to_tensor_counts[rCenter] = HaplotypeTensorCounts(rCenter)
+                    for center in active_set:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             0,
                             reference_sequence[reference_position - reference_start_0_based],
                             SEQ[query_position],
                             STRAND,
-                            HAPLOTYPE
-                        ))
+                            channel
+                        )
                     if reference_position in end_to_center:
                         center = end_to_center[reference_position]
                         active_set.remove(center)
@@ -345,83 +351,65 @@ def OutputAlnTensor(args):
                     query_position += 1
 
             # insertion
-            if c == "I":
+            if operation == BAM_CINS:
                 for queryAdv in range(advance):
-                    for center in list(active_set):
-                        if available_slots <= 0:
-                            break
-                        available_slots -= 1
-
-                        center_to_alignment[center][-1].append((
+                    for center in active_set:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             queryAdv,
                             "-",
                             SEQ[query_position],
                             STRAND,
-                            HAPLOTYPE
-                        ))
+                            channel
+                        )
                     query_position += 1
 
             # deletion
-            if c == "D":
+            if operation == BAM_CDEL:
                 for _ in range(advance):
-                    for center in list(active_set):
-                        if available_slots <= 0:
-                            break
-                        available_slots -= 1
-
-                        center_to_alignment[center][-1].append((
+                    for center in active_set:
+                        center_to_tensor_counts[center].add(
                             reference_position,
                             0,
                             reference_sequence[reference_position - reference_start_0_based],
                             "-",
                             STRAND,
-                            HAPLOTYPE
-                        ))
+                            channel
+                        )
                     if reference_position in begin_to_end:
                         for rEnd, rCenter in begin_to_end[reference_position]:
                             if rCenter in active_set:
                                 continue
                             end_to_center[rEnd] = rCenter
                             active_set.add(rCenter)
-                            center_to_alignment.setdefault(rCenter, [])
-                            center_to_alignment[rCenter].append([])
+                            if rCenter not in center_to_tensor_counts:
+                                center_to_tensor_counts[rCenter] = HaplotypeTensorCounts(rCenter)
                     if reference_position in end_to_center:
                         center = end_to_center[reference_position]
                         active_set.remove(center)
                     reference_position += 1
 
-            # reset advance
-            advance = 0
-
         if depthCap == 0:
-            for center in list(center_to_alignment.keys()):
+            for center in list(center_to_tensor_counts.keys()):
                 if center + (param.flankingBaseNum + 1) >= POS:
                     continue
-                l = generate_tensor(
-                    ctg_name, center_to_alignment[center], center, reference_sequence, reference_start_0_based, min_coverage
-                )
-                if l != None:
-                    tensor_fp.stdin.write(l)
-                    tensor_fp.stdin.write("\n")
-                available_slots += sum(len(i) for i in center_to_alignment[center])
-                #print >> sys.stderr, "POS %d: remaining slots %d" % (center, available_slots)
-                del center_to_alignment[center]
-
-    for center in center_to_alignment.keys():
-        l = generate_tensor(
-            ctg_name, center_to_alignment[center], center, reference_sequence, reference_start_0_based, min_coverage
-        )
-        if l != None:
-            tensor_fp.stdin.write(l)
-            tensor_fp.stdin.write("\n")
-
-    samtools_view_process.stdout.close()
-    samtools_view_process.wait()
+                tensor = generate_tensor(center_to_tensor_counts[center], reference_start_0_based, min_coverage)
+                if tensor is not None:
+                    tensor_output.add(center, tensor)
+                del center_to_tensor_counts[center]
+
+    for center in center_to_tensor_counts.keys():
+        tensor = generate_tensor(center_to_tensor_counts[center], reference_start_0_based, min_coverage)
+        if tensor is not None:
+            tensor_output.add(center, tensor)
+    tensor_output.flush()
+
+    if samtools_view_process is not None:
+        samtools_view_process.stdout.close()
+        samtools_view_process.wait()
     if tensor_file_path != "PIPE":
         tensor_fp.stdin.close()
         tensor_fp.wait()
-        tensor_fpo.close()
 
 
 def main():
@@ -440,6 +428,15 @@ def main():
     parser.add_argument('--tensor_fn', type=str, default="PIPE",
                         help="Tensor output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--tensor_format', type=str, default="text", choices=["text", "binary"],
+                        help="Tensor output format, binary for blocks of fixed-width records (haplotype channels x positions x rows x counts, uint16), default: %(default)s")
+
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
     parser.add_argument('--minMQ', type=int, default=0,
                         help="Minimum Mapping Quality. Mapping quality lower than the setting will be filtered, default: %(default)d")
 
@@ -455,6 +452,9 @@ def main():
     parser.add_argument('--samtools', type=str, default="samtools",
                         help="Path to the 'samtools', default: %(default)s")
 
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam instead of parsing the output of 'samtools view', optional")
+
     parser.add_argument('--stop_consider_left_edge', action='store_true',
                         help="If not set, would consider left edge only. That is, count the left-most base-pairs of a read for coverage even if the starting position of a read is after the starting position of a tensor")
 
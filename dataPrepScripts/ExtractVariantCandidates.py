@@ -3,20 +3,67 @@ import shlex
 import gc
 import signal
 import random
-from subprocess import PIPE
+import heapq
 from os.path import isfile
 from argparse import ArgumentParser
 from math import log
-from collections import defaultdict
+from collections import namedtuple, Counter
+from multiprocessing import Pool
+
+import numpy as np
 
 import shared.param as param
-from shared.utils import subprocess_popen, IUPAC_base_to_ACGT_base_dict as BASE2ACGT
-from shared.interval_tree import bed_tree_from, is_region_in
+from shared.utils import (
+    subprocess_popen, gzip_input_from, gzip_output_from,
+    DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL, IUPAC_base_to_ACGT_base_dict as BASE2ACGT
+)
+from shared.interval_tree import (
+    bed_tree_from, is_region_in, IntervalSweeper, merged_intervals_from, intersection_tree_from
+)
+from shared.fasta import ReferenceSequence, fasta_file_from, is_fasta_memory_mappable, faidx_records_from
+from shared.bam_index import bam_index_from, is_region_covered_in
+from shared.binary_format import candidate_block_bytes_from, pileup_block_bytes_from, pileup_blocks_from
+from shared.alignment import (
+    BAM_CMATCH,
+    BAM_CINS,
+    BAM_CDEL,
+    BAM_CSOFT_CLIP,
+    BAM_CEQUAL,
+    BAM_CDIFF,
+    aligned_reads_from,
+    pysam_reads_from,
+    is_too_many_soft_clipped_bases_for_a_read_from,
+    reference_end_from,
+)
+from shared.pileup import (
+    PileupWindow,
+    column_indices_from,
+    PILEUP_COLUMNS,
+    INSERTION_COLUMN_INDEX,
+    DELETION_COLUMN_INDEX,
+    DEPTH_COLUMN_INDICES,
+)
 
 is_pypy = '__pypy__' in sys.builtin_module_names
 
 RATIO_OF_NON_VARIANT_TO_VARIANT = 2.0
 
+# reads skipped by the depth cap are reported per window of this size
+DEPTH_CAP_REPORT_WINDOW_SIZE = 1000000
+
+CandidateFilter = namedtuple('CandidateFilter', [
+    'minimum_depth',
+    'minimum_af',
+    'is_building_training_dataset',
+    'output_probability',
+    'output_probability_near_variant',
+    'output_probability_outside_variant',
+    'tree',
+    'bed_sweeper',
+    'variants_map',
+    'non_variants_map',
+])
+
 
 def PypyGCCollect(signum, frame):
     gc.collect()
@@ -29,13 +76,13 @@ def evc_base_from(base):
 
 def variants_map_from(variant_file_path):
     """
-    variants map with 1-based position as key
+    variants map of sorted 1-based positions (numpy array) keyed by contig name
     """
     if variant_file_path == None:
         return {}
 
-    variants_map = {}
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (variant_file_path)))
+    positions_of_contigs = {}
+    f = gzip_input_from(variant_file_path)
 
     while True:
         row = f.stdout.readline()
@@ -46,14 +93,28 @@ def variants_map_from(variant_file_path):
         if row:
             columns = row.split(maxsplit=2)
             ctg_name, position_str = columns[0], columns[1]
-            key = ctg_name + ":" + position_str
-
-            variants_map[key] = True
+            positions_of_contigs.setdefault(ctg_name, []).append(int(position_str))
 
     f.stdout.close()
     f.wait()
 
-    return variants_map
+    return dict(
+        (ctg_name, np.unique(np.array(positions, dtype=np.int64)))
+        for ctg_name, positions in positions_of_contigs.items()
+    )
+
+
+def distances_to_nearest_from(sorted_positions, positions):
+    """
+    distance from each of the positions to its nearest position in sorted_positions (non-empty)
+    """
+    right_indices = np.searchsorted(sorted_positions, positions)
+    left_indices = np.maximum(right_indices - 1, 0)
+    right_indices = np.minimum(right_indices, len(sorted_positions) - 1)
+    return np.minimum(
+        np.abs(positions - sorted_positions[left_indices]),
+        np.abs(sorted_positions[right_indices] - positions)
+    )
 
 
 def non_variants_map_near_variants_from(
@@ -62,43 +123,36 @@ def non_variants_map_near_variants_from(
     upper_limit_to_non_variants=16
 ):
     """
-    non variants map with 1-based position as key
+    non variants map of sorted 1-based positions (numpy array) keyed by contig name,
+    positions with the nearest variant [lower_limit_to_non_variants, upper_limit_to_non_variants] bases away
     """
     non_variants_map = {}
-    non_variants_map_to_exclude = {}
+    offsets = np.arange(lower_limit_to_non_variants, upper_limit_to_non_variants + 1)
+    offsets = np.concatenate([-offsets, offsets])
 
-    for key in variants_map.keys():
-        ctg_name, position_str = key.split(':')
-        position = int(position_str)
+    for ctg_name, variant_positions in variants_map.items():
+        if len(variant_positions) == 0:
+            continue
+        positions = np.unique((variant_positions[:, np.newaxis] + offsets).ravel())
+        positions = positions[positions > 0]
+        # positions closer than lower_limit_to_non_variants to another variant (or being a variant) are excluded
+        non_variants_map[ctg_name] = positions[
+            distances_to_nearest_from(variant_positions, positions) >= lower_limit_to_non_variants
+        ]
 
-        for i in range(upper_limit_to_non_variants * 2 + 1):
-            position_offset = -upper_limit_to_non_variants + i
-            temp_position = position + position_offset
-            if temp_position <= 0:
-                continue
+    return non_variants_map
 
-            temp_key = ctg_name + ":" + str(temp_position)
-            can_add_to_non_variants_map = (
-                temp_key not in variants_map and
-                temp_key not in non_variants_map and
-                (
-                    -upper_limit_to_non_variants <= position_offset <= -lower_limit_to_non_variants or
-                    lower_limit_to_non_variants <= position_offset <= upper_limit_to_non_variants
-                )
-            )
-            can_add_to_non_variants_map_to_exclude = (
-                lower_limit_to_non_variants > position_offset > -lower_limit_to_non_variants
-            )
-            if can_add_to_non_variants_map:
-                non_variants_map[temp_key] = True
-            if can_add_to_non_variants_map_to_exclude:
-                non_variants_map_to_exclude[temp_key] = True
 
-    for key in non_variants_map_to_exclude.keys():
-        if key in non_variants_map:
-            del non_variants_map[key]
+def is_position_in_from(positions_map, ctg_name, positions):
+    """
+    membership mask of 1-based positions in a positions map (sorted positions keyed by contig name)
+    """
+    sorted_positions = positions_map.get(ctg_name)
+    if sorted_positions is None or len(sorted_positions) == 0:
+        return np.zeros(len(positions), dtype=bool)
 
-    return non_variants_map
+    indices = np.minimum(np.searchsorted(sorted_positions, positions), len(sorted_positions) - 1)
+    return sorted_positions[indices] == positions
 
 
 class CandidateStdout(object):
@@ -123,9 +177,24 @@ def region_from(ctg_name, ctg_start=None, ctg_end=None):
     return "{}:{}-{}".format(ctg_name, ctg_start, ctg_end)
 
 
-def reference_sequence_from(samtools_execute_command, fasta_file_path, regions):
+def reference_sequence_from(samtools_execute_command, fasta_file_path, ctg_name, ctg_start=None, ctg_end=None):
+    """
+    reference sequence of the 1-based region [ctg_start, ctg_end] (whole contig if not given),
+    sliced from the memory-mapped fasta if possible, otherwise read from samtools faidx
+    """
+    if is_fasta_memory_mappable(fasta_file_path):
+        fasta_file = fasta_file_from(fasta_file_path)
+        if ctg_name not in fasta_file:
+            return None
+        return ReferenceSequence(
+            fasta_file=fasta_file,
+            ctg_name=ctg_name,
+            start=0 if ctg_start is None else ctg_start - 1,
+            end=ctg_end
+        )
+
     refernce_sequences = []
-    region_value_for_faidx = " ".join(regions)
+    region_value_for_faidx = region_from(ctg_name=ctg_name, ctg_start=ctg_start, ctg_end=ctg_end)
 
     samtools_faidx_process = subprocess_popen(
         shlex.split("{} faidx {} {}".format(samtools_execute_command, fasta_file_path, region_value_for_faidx))
@@ -152,58 +221,38 @@ def reference_sequence_from(samtools_execute_command, fasta_file_path, regions):
     return reference_sequence
 
 
-def is_too_many_soft_clipped_bases_for_a_read_from(CIGAR):
-    soft_clipped_bases = 0
-    total_alignment_positions = 0
+def samtools_view_reads_from(samtools_execute_command, bam_file_path, ctg_name, regions):
+    """
+    aligned reads of ctg_name parsed from the text output of "samtools view",
+    reads of several (sorted) regions are output once, in order, using the multi-region iterator (-M)
+    """
+    samtools_view_process = subprocess_popen(
+        shlex.split("{} view -F {} {} {} {}".format(
+            samtools_execute_command,
+            param.SAMTOOLS_VIEW_FILTER_FLAG,
+            "-M" if len(regions) > 1 else "",
+            bam_file_path,
+            " ".join(regions)
+        ))
+    )
 
-    advance = 0
-    for c in str(CIGAR):
-        if c.isdigit():
-            advance = advance * 10 + int(c)
+    for read in aligned_reads_from(samtools_view_process.stdout):
+        if read.reference_name != ctg_name:
             continue
-        if c == "S":
-            soft_clipped_bases += advance
-        total_alignment_positions += advance
-        advance = 0
+        yield read
 
-    # skip a read less than 55% aligned
-    return 1.0 - float(soft_clipped_bases) / (total_alignment_positions + 1) < 0.55
+    samtools_view_process.stdout.close()
+    samtools_view_process.wait()
 
 
-def make_candidates(args):
-
-    gen4Training = args.gen4Training
-    variant_file_path = args.var_fn
-    bed_file_path = args.bed_fn
-    fasta_file_path = args.ref_fn
-    ctg_name = args.ctgName
-    ctg_start = args.ctgStart
-    ctg_end = args.ctgEnd
-    output_probability = args.outputProb
-    samtools_execute_command = args.samtools
-    minimum_depth_for_candidate = args.minCoverage
-    minimum_af_for_candidate = args.threshold
-    minimum_mapping_quality = args.minMQ
-    bam_file_path = args.bam_fn
-    candidate_output_path = args.can_fn
-    is_using_stdout_for_output_candidate = candidate_output_path == "PIPE"
-
-    is_building_training_dataset = gen4Training == True
-    is_variant_file_given = variant_file_path is not None
-    is_bed_file_given = bed_file_path is not None
-    is_ctg_name_given = ctg_name is not None
-    is_ctg_range_given = is_ctg_name_given and ctg_start is not None and ctg_end is not None
-
-    if is_building_training_dataset:
-        # minimum_depth_for_candidate = 0
-        minimum_af_for_candidate = 0
+def candidate_filter_from(args):
+    is_building_training_dataset = args.gen4Training == True
+    is_variant_file_given = args.var_fn is not None
 
     # preparation for candidates near variants
     need_consider_candidates_near_variant = is_building_training_dataset and is_variant_file_given
-    variants_map = variants_map_from(variant_file_path) if need_consider_candidates_near_variant else {}
+    variants_map = variants_map_from(args.var_fn) if need_consider_candidates_near_variant else {}
     non_variants_map = non_variants_map_near_variants_from(variants_map)
-    no_of_candidates_near_variant = 0
-    no_of_candidates_outside_variant = 0
 
     # update output probabilities for candidates near variants
     # original: (7000000.0 * 2.0 / 3000000000)
@@ -213,6 +262,452 @@ def make_candidates(args):
     )
     output_probability_outside_variant = 3500000.0 * RATIO_OF_NON_VARIANT_TO_VARIANT / (3000000000 - 14000000)
 
+    tree = bed_tree_from(bed_file_path=args.bed_fn)
+
+    return CandidateFilter(
+        minimum_depth=args.minCoverage,
+        # minimum_depth = 0 if is_building_training_dataset
+        minimum_af=0 if is_building_training_dataset else args.threshold,
+        is_building_training_dataset=is_building_training_dataset,
+        output_probability=args.outputProb,
+        output_probability_near_variant=output_probability_near_variant,
+        output_probability_outside_variant=output_probability_outside_variant,
+        tree=tree,
+        bed_sweeper=IntervalSweeper(tree),
+        variants_map=variants_map if need_consider_candidates_near_variant else None,
+        non_variants_map=non_variants_map,
+    )
+
+
+def bam_file_paths_from(bam_fn):
+    """
+    BAM file paths of a comma-separated --bam_fn, one per sample
+    """
+    return [bam_file_path for bam_file_path in bam_fn.split(",") if bam_file_path]
+
+
+def reads_from(args, ctg_name, regions):
+    """
+    (sample index, read) of the reads of all BAMs in --bam_fn, merged by position
+    """
+    def sample_reads_from(sample_index, bam_file_path):
+        if args.pysam_for_reading_bam:
+            reads = pysam_reads_from(bam_file_path=bam_file_path, ctg_name=ctg_name, regions=regions)
+        else:
+            reads = samtools_view_reads_from(
+                samtools_execute_command=args.samtools,
+                bam_file_path=bam_file_path,
+                ctg_name=ctg_name,
+                regions=regions
+            )
+        for read in reads:
+            yield sample_index, read
+
+    bam_file_paths = bam_file_paths_from(args.bam_fn)
+    if len(bam_file_paths) == 1:
+        return sample_reads_from(0, bam_file_paths[0])
+    return heapq.merge(
+        *[sample_reads_from(sample_index, bam_file_path) for sample_index, bam_file_path in enumerate(bam_file_paths)],
+        key=lambda sample_read: sample_read[1].position
+    )
+
+
+def candidates_in_pileup_from(
+    candidate_filter,
+    ctg_name,
+    ctg_start,
+    ctg_end,
+    positions,
+    counts,
+    reference_sequence,
+    reference_start,
+    statistics
+):
+    """
+    candidates among flushed pileup positions
+
+    Return:
+        indices of the candidate positions, their reference bases,
+        and the depths and the sorted count columns (descendingly) of all positions
+    """
+    is_ctg_range_given = ctg_start is not None and ctg_end is not None
+    is_bed_file_given = len(candidate_filter.tree) > 0
+    is_variant_file_given = candidate_filter.variants_map is not None
+    variants_map, non_variants_map = candidate_filter.variants_map, candidate_filter.non_variants_map
+
+    # ctg range, depth and af checking in bulk over the flushed positions
+    # (region [ctg_start, ctg_end] is 1-based, inclusive start and end positions)
+    depths = counts[:, DEPTH_COLUMN_INDICES].sum(axis=1)
+    is_candidate_checkable = depths >= candidate_filter.minimum_depth
+    if is_ctg_range_given:
+        is_candidate_checkable &= (positions + 1 >= ctg_start) & (positions + 1 <= ctg_end)
+    # sort count columns descendingly, tie in pileup column order
+    sorted_columns = np.argsort(-counts, axis=1, kind="stable")
+    if is_variant_file_given:
+        is_variant = is_position_in_from(variants_map, ctg_name, positions + 1)
+        is_near_variant = is_position_in_from(non_variants_map, ctg_name, positions + 1)
+
+    candidate_indices, candidate_reference_bases = [], []
+    for i in np.flatnonzero(is_candidate_checkable):
+        zero_based_position = int(positions[i])
+        reference_base = None
+
+        # bed checking
+        pass_bed = not is_bed_file_given or candidate_filter.bed_sweeper.is_position_in(ctg_name, zero_based_position)
+        if not pass_bed:
+            continue
+
+        # output probability checking
+        pass_output_probability = True
+        if candidate_filter.is_building_training_dataset and is_variant_file_given:
+            pass_output_probability = (
+                not is_variant[i] and (
+                    (
+                        is_near_variant[i] and
+                        random.uniform(0, 1) <= candidate_filter.output_probability_near_variant
+                    ) or
+                    (
+                        not is_near_variant[i] and
+                        random.uniform(0, 1) <= candidate_filter.output_probability_outside_variant
+                    )
+                )
+            )
+        elif candidate_filter.is_building_training_dataset:
+            pass_output_probability = random.uniform(0, 1) <= candidate_filter.output_probability
+        if not pass_output_probability:
+            continue
+
+        try:
+            reference_base = evc_base_from(reference_sequence[
+                zero_based_position - (0 if reference_start is None else (reference_start - 1))
+            ])
+        except:
+            continue
+
+        # af checking
+        depth = int(depths[i])
+        denominator = depth if depth > 0 else 1
+        position_counts = counts[i]
+        first_column, second_column = sorted_columns[i][0], sorted_columns[i][1]
+        pass_af = (
+            PILEUP_COLUMNS[first_column] != reference_base or
+            (float(position_counts[second_column]) / denominator) >= candidate_filter.minimum_af
+        )
+        if not pass_af:
+            continue
+
+        # output 1-based candidate
+        if is_variant_file_given and is_near_variant[i]:
+            statistics["candidates_near_variant"] += 1
+        elif is_variant_file_given:
+            statistics["candidates_outside_variant"] += 1
+
+        candidate_indices.append(i)
+        candidate_reference_bases.append(reference_base)
+
+    return candidate_indices, candidate_reference_bases, depths, sorted_columns
+
+
+def candidate_output_in_pileup_from(
+    candidate_filter,
+    ctg_name,
+    ctg_start,
+    ctg_end,
+    positions,
+    counts,
+    reference_sequence,
+    reference_start,
+    statistics,
+    candidate_format="text",
+    sample_counts=None
+):
+    """
+    output (text rows, or a binary block) of candidates among flushed pileup positions
+
+    sample_counts (positions x samples x columns) are appended to text rows as a depth:A:C:G:T:I:D:N field per sample
+    """
+    candidate_indices, candidate_reference_bases, depths, sorted_columns = candidates_in_pileup_from(
+        candidate_filter=candidate_filter,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end,
+        positions=positions,
+        counts=counts,
+        reference_sequence=reference_sequence,
+        reference_start=reference_start,
+        statistics=statistics
+    )
+
+    if candidate_format == "binary":
+        if len(candidate_indices) == 0:
+            return b""
+        return candidate_block_bytes_from(
+            ctg_name=ctg_name,
+            positions=positions[candidate_indices] + 1,
+            reference_bases=candidate_reference_bases,
+            depths=depths[candidate_indices],
+            counts=counts[candidate_indices]
+        )
+
+    rows = []
+    for i, reference_base in zip(candidate_indices, candidate_reference_bases):
+        depth = int(depths[i])
+        position_counts = counts[i]
+        output = [ctg_name, int(positions[i])+1, reference_base, depth]
+        output.extend(["%s %d" % (PILEUP_COLUMNS[j], position_counts[j]) for j in sorted_columns[i]])
+        if sample_counts is not None:
+            output.extend([
+                ":".join([str(sum(counts_of_sample[j] for j in DEPTH_COLUMN_INDICES))] + [str(x) for x in counts_of_sample])
+                for counts_of_sample in sample_counts[i].tolist()
+            ])
+        rows.append(" ".join([str(x) for x in output]) + "\n")
+    return "".join(rows)
+
+
+class PileupCacheWriter(object):
+    """
+    Pileup counts of flushed positions in [ctg_start, ctg_end] (1-based, whole contig if not given),
+    written out as binary blocks of at most BLOCK_SIZE positions.
+    """
+
+    BLOCK_SIZE = 65536
+
+    def __init__(self, write, ctg_name, ctg_start=None, ctg_end=None):
+        self.write = write
+        self.ctg_name = ctg_name
+        self.ctg_start = ctg_start
+        self.ctg_end = ctg_end
+        self.positions = []
+        self.counts = []
+        self.size = 0
+
+    def add(self, positions, counts):
+        if self.ctg_start is not None and self.ctg_end is not None:
+            is_in_range = (positions + 1 >= self.ctg_start) & (positions + 1 <= self.ctg_end)
+            positions, counts = positions[is_in_range], counts[is_in_range]
+        if len(positions) == 0:
+            return
+
+        self.positions.append(positions)
+        self.counts.append(counts)
+        self.size += len(positions)
+        if self.size >= self.BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+        self.write(pileup_block_bytes_from(
+            ctg_name=self.ctg_name,
+            positions=np.concatenate(self.positions) + 1,
+            counts=np.concatenate(self.counts)
+        ))
+        self.positions, self.counts, self.size = [], [], 0
+
+
+def add_read_to_pileup(pileup, read, column_offset=0):
+    """
+    add the bases, insertions and deletions of a read (with CIGAR) to the pileup window,
+    in the pileup columns from column_offset on (e.g. the columns of its sample)
+    """
+    read_column_indices = column_indices_from(read.sequence)
+    if column_offset > 0:
+        read_column_indices = np.where(
+            read_column_indices >= 0, read_column_indices.astype(np.int32) + column_offset, -1
+        )
+
+    reference_position = read.position
+    query_position = 0
+    # insertion and deletion (position, column) pairs of this read, added to the pileup window at once
+    indel_positions = []
+    indel_columns = []
+
+    for operation, advance in read.cigartuples:
+        if operation == BAM_CSOFT_CLIP:
+            query_position += advance
+
+        elif operation == BAM_CMATCH or operation == BAM_CEQUAL or operation == BAM_CDIFF:
+            pileup.add_bases(reference_position, read_column_indices[query_position:query_position + advance])
+
+            # those CIGAR operations consumes query and reference
+            reference_position += advance
+            query_position += advance
+
+        elif operation == BAM_CINS:
+            indel_positions.append(reference_position - 1)
+            indel_columns.append(INSERTION_COLUMN_INDEX + column_offset)
+
+            # insertion consumes query
+            query_position += advance
+
+        elif operation == BAM_CDEL:
+            indel_positions.append(reference_position - 1)
+            indel_columns.append(DELETION_COLUMN_INDEX + column_offset)
+
+            # deletion consumes reference
+            reference_position += advance
+
+    pileup.add(indel_positions, indel_columns)
+
+
+def candidate_outputs_from(
+    candidate_filter,
+    reads,
+    minimum_mapping_quality,
+    ctg_name,
+    ctg_start,
+    ctg_end,
+    reference_sequence,
+    reference_start,
+    statistics,
+    candidate_format="text",
+    maximum_depth=0,
+    pileup_cache=None,
+    no_of_samples=1
+):
+    """
+    outputs of candidates in [ctg_start, ctg_end] (1-based, whole contig if not given) counted from
+    (sample index, read) of reads, pileup counts (of all samples) are also added to pileup_cache
+    (a PileupCacheWriter) if given
+
+    with maximum_depth > 0, a read is skipped (before counting) if maximum_depth counted reads already cover
+    its first position, so no position is covered by more than maximum_depth counted reads
+    """
+    # with several samples, pileup rows hold the columns of every sample side by side
+    pileup = PileupWindow(no_of_columns=len(PILEUP_COLUMNS) * no_of_samples)
+    # reference end positions of the counted reads still covering the current read position
+    counted_read_ends = []
+
+    def candidate_output_flushed_before(position=None):
+        positions, counts = pileup.flush(position)
+        sample_counts = None
+        if no_of_samples > 1:
+            sample_counts = counts.reshape(len(positions), no_of_samples, len(PILEUP_COLUMNS))
+            counts = sample_counts.sum(axis=1)
+        if pileup_cache is not None:
+            pileup_cache.add(positions, counts)
+        return candidate_output_in_pileup_from(
+            candidate_filter=candidate_filter,
+            ctg_name=ctg_name,
+            ctg_start=ctg_start,
+            ctg_end=ctg_end,
+            positions=positions,
+            counts=counts,
+            reference_sequence=reference_sequence,
+            reference_start=reference_start,
+            statistics=statistics,
+            candidate_format=candidate_format,
+            sample_counts=sample_counts
+        )
+
+    for sample_index, read in reads:
+        POS = read.position
+        MAPQ = read.mapping_quality
+        cigartuples = read.cigartuples
+
+        if MAPQ < minimum_mapping_quality:
+            continue
+        if cigartuples is None or is_too_many_soft_clipped_bases_for_a_read_from(read):
+            continue
+
+        if maximum_depth > 0:
+            while counted_read_ends and counted_read_ends[0] <= POS:
+                heapq.heappop(counted_read_ends)
+            if len(counted_read_ends) >= maximum_depth:
+                # reads starting before ctg_start are reported with the region (shard) before
+                if ctg_start is None or POS >= ctg_start - 1:
+                    statistics["skipped_reads"] += 1
+                    statistics[("skipped_reads", ctg_name, POS // DEPTH_CAP_REPORT_WINDOW_SIZE)] += 1
+                continue
+            heapq.heappush(counted_read_ends, reference_end_from(POS, cigartuples))
+
+        statistics["reads"] += 1
+
+        # a read starting at POS may still add an insertion or deletion at POS - 1
+        output = candidate_output_flushed_before(POS - 1)
+        if output:
+            yield output
+
+        add_read_to_pileup(pileup, read, column_offset=sample_index * len(PILEUP_COLUMNS))
+
+    output = candidate_output_flushed_before()
+    if pileup_cache is not None:
+        pileup_cache.flush()
+    if output:
+        yield output
+
+
+def print_statistics(candidate_filter, statistics, bam_file_path=None):
+    if candidate_filter.is_building_training_dataset and candidate_filter.variants_map is not None:
+        print("# of candidates near variant: ", statistics["candidates_near_variant"], file=sys.stderr)
+        print("# of candidates outside variant: ", statistics["candidates_outside_variant"], file=sys.stderr)
+
+    if statistics["skipped_reads"] > 0:
+        for key, no_of_skipped_reads in statistics.items():
+            if not isinstance(key, tuple) or key[0] != "skipped_reads":
+                continue
+            _, ctg_name, window_index = key
+            print("[INFO] %d reads skipped by the depth cap in %s:%d-%d" % (
+                no_of_skipped_reads,
+                ctg_name,
+                window_index * DEPTH_CAP_REPORT_WINDOW_SIZE + 1,
+                (window_index + 1) * DEPTH_CAP_REPORT_WINDOW_SIZE
+            ), file=sys.stderr)
+        print("[INFO] %d reads skipped by the depth cap in total" % (statistics["skipped_reads"]), file=sys.stderr)
+
+    if statistics["regions_skipped_by_index"] > 0:
+        print("[INFO] %d regions skipped without reads by the BAM index" % (
+            statistics["regions_skipped_by_index"]), file=sys.stderr)
+
+    if bam_file_path is not None and statistics["reads"] == 0:
+        print("No read has been process, either the genome region you specified has no read cover, or please check the correctness of your BAM input (%s)." % (
+            bam_file_path), file=sys.stderr)
+
+
+def candidate_file_from(args):
+    is_binary = args.can_format == "binary"
+    if args.can_fn == "PIPE":
+        return CandidateStdout(sys.stdout.buffer if is_binary else sys.stdout)
+    return gzip_output_from(
+        args.can_fn,
+        threads=args.compression_threads,
+        level=args.compression_level,
+        universal_newlines=not is_binary
+    )
+
+
+def pileup_file_from(args):
+    if args.pileup_fn is None:
+        return None
+    return gzip_output_from(
+        args.pileup_fn, threads=args.compression_threads, level=args.compression_level, universal_newlines=False
+    )
+
+
+def close_candidate_output(can_fp, candidate_output_path):
+    if candidate_output_path == "PIPE":
+        return
+    can_fp.stdin.close()
+    can_fp.wait()
+
+
+def bam_indices_from(args):
+    return [bam_index_from(bam_file_path) for bam_file_path in bam_file_paths_from(args.bam_fn)]
+
+
+def make_candidates(args):
+    fasta_file_path = args.ref_fn
+    ctg_name = args.ctgName
+    ctg_start = args.ctgStart
+    ctg_end = args.ctgEnd
+    bed_file_path = args.bed_fn
+
+    is_bed_file_given = bed_file_path is not None
+    is_ctg_name_given = ctg_name is not None
+    is_ctg_range_given = is_ctg_name_given and ctg_start is not None and ctg_end is not None
+
+    candidate_filter = candidate_filter_from(args)
+
     if not isfile("{}.fai".format(fasta_file_path)):
         print("Fasta index {}.fai doesn't exist.".format(fasta_file_path), file=sys.stderr)
         sys.exit(1)
@@ -227,187 +722,329 @@ def make_candidates(args):
     elif is_ctg_name_given:
         regions.append(region_from(ctg_name=ctg_name))
 
+    # skip reading the BAM and the reference if the index shows no reads in the range
+    if is_ctg_name_given and not is_region_covered_in(
+        bam_indices_from(args),
+        ctg_name,
+        ctg_start - 1 if is_ctg_range_given else None,
+        ctg_end if is_ctg_range_given else None
+    ):
+        print("[INFO] No reads in {} by the BAM index, skipped".format(
+            region_from(ctg_name, ctg_start, ctg_end) if is_ctg_range_given else ctg_name), file=sys.stderr)
+        close_candidate_output(candidate_file_from(args), args.can_fn)
+        pileup_fp = pileup_file_from(args)
+        if pileup_fp is not None:
+            pileup_fp.stdin.close()
+            pileup_fp.wait()
+        return
+
     reference_sequence = reference_sequence_from(
-        samtools_execute_command=samtools_execute_command,
+        samtools_execute_command=args.samtools,
         fasta_file_path=fasta_file_path,
-        regions=regions
+        ctg_name=ctg_name,
+        ctg_start=reference_start,
+        ctg_end=reference_end
     )
     if reference_sequence is None or len(reference_sequence) == 0:
         print("[ERROR] Failed to load reference seqeunce from file ({}).".format(fasta_file_path), file=sys.stderr)
         sys.exit(1)
 
-    tree = bed_tree_from(bed_file_path=bed_file_path)
-    if is_bed_file_given and ctg_name not in tree:
+    if is_bed_file_given and ctg_name not in candidate_filter.tree:
         print("[ERROR] ctg_name({}) not exists in bed file({}).".format(ctg_name, bed_file_path), file=sys.stderr)
         sys.exit(1)
 
-    samtools_view_process = subprocess_popen(
-        shlex.split("{} view -F {} {} {}".format(samtools_execute_command, param.SAMTOOLS_VIEW_FILTER_FLAG, bam_file_path, " ".join(regions)))
+    can_fp = candidate_file_from(args)
+    pileup_fp = pileup_file_from(args)
+    pileup_cache = None if pileup_fp is None else PileupCacheWriter(
+        write=pileup_fp.stdin.write,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start if is_ctg_range_given else None,
+        ctg_end=ctg_end if is_ctg_range_given else None
     )
 
-    if is_using_stdout_for_output_candidate:
-        can_fp = CandidateStdout(sys.stdout)
-    else:
-        can_fpo = open(candidate_output_path, "wb")
-        can_fp = subprocess_popen(shlex.split("gzip -c"), stdin=PIPE, stdout=can_fpo)
+    statistics = Counter()
+    for output in candidate_outputs_from(
+        candidate_filter=candidate_filter,
+        reads=reads_from(args, ctg_name, regions),
+        minimum_mapping_quality=args.minMQ,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start if is_ctg_range_given else None,
+        ctg_end=ctg_end if is_ctg_range_given else None,
+        reference_sequence=reference_sequence,
+        reference_start=reference_start,
+        statistics=statistics,
+        candidate_format=args.can_format,
+        maximum_depth=args.dcov,
+        pileup_cache=pileup_cache,
+        no_of_samples=len(bam_file_paths_from(args.bam_fn))
+    ):
+        can_fp.stdin.write(output)
+
+    close_candidate_output(can_fp, args.can_fn)
+    if pileup_fp is not None:
+        pileup_fp.stdin.close()
+        pileup_fp.wait()
+
+    print_statistics(candidate_filter, statistics, args.bam_fn)
+
+
+def make_candidates_in_regions(args):
+    """
+    Candidates of many (small) regions in --regions_fn (bed format, e.g. amplicons or exome targets) in one process.
+    Contigs are processed in the order of the fasta index, the reads of all regions of a contig are read in
+    one sorted pass and counted in one pileup window, with the reference loaded once per contig.
+    """
+    fai_file_path = "{}.fai".format(args.ref_fn)
+    if not isfile(fai_file_path):
+        print("Fasta index {} doesn't exist.".format(fai_file_path), file=sys.stderr)
+        sys.exit(1)
 
-    pileup = defaultdict(lambda: {"A": 0, "C": 0, "G": 0, "T": 0, "I": 0, "D": 0, "N": 0})
-    POS = 0
-    number_of_reads_processed = 0
+    regions_tree = bed_tree_from(bed_file_path=args.regions_fn)
+    candidate_filter = candidate_filter_from(args)
+    # candidates are output only in the regions (and in the bed regions if given)
+    tree = regions_tree if len(candidate_filter.tree) == 0 else intersection_tree_from(candidate_filter.tree, regions_tree)
+    candidate_filter = candidate_filter._replace(tree=tree, bed_sweeper=IntervalSweeper(tree))
 
-    while True:
-        row = samtools_view_process.stdout.readline()
-        is_finish_reading_output = row == '' and samtools_view_process.poll() is not None
+    can_fp = candidate_file_from(args)
+    pileup_fp = pileup_file_from(args)
+    bam_indices = bam_indices_from(args)
 
-        if row:
-            columns = row.strip().split()
-            if columns[0][0] == "@":
-                continue
+    statistics = Counter()
+    for ctg_name in faidx_records_from(fai_file_path):
+        if ctg_name not in tree:
+            continue
 
-            RNAME = columns[2]
-            if RNAME != ctg_name:
+        # regions without reads by the BAM index are skipped
+        regions = []
+        for start, end in zip(*merged_intervals_from(regions_tree[ctg_name])):
+            if not is_region_covered_in(bam_indices, ctg_name, start, end):
+                statistics["regions_skipped_by_index"] += 1
                 continue
+            regions.append(region_from(ctg_name=ctg_name, ctg_start=start + 1, ctg_end=end))
+        if len(regions) == 0:
+            continue
 
-            POS = int(columns[3]) - 1  # switch from 1-base to 0-base to match sequence index
-            MAPQ = int(columns[4])
-            CIGAR = columns[5]
-            SEQ = columns[9].upper()   # uppercase for SEQ (regexp is \*|[A-Za-z=.]+)
-
-            reference_position = POS
-            query_position = 0
-
-            if MAPQ < minimum_mapping_quality:
-                continue
-            if CIGAR == "*" or is_too_many_soft_clipped_bases_for_a_read_from(CIGAR):
-                continue
+        reference_sequence = reference_sequence_from(
+            samtools_execute_command=args.samtools, fasta_file_path=args.ref_fn, ctg_name=ctg_name
+        )
+        if reference_sequence is None or len(reference_sequence) == 0:
+            print("[ERROR] Failed to load reference seqeunce of {} from file ({}).".format(
+                ctg_name, args.ref_fn), file=sys.stderr)
+            sys.exit(1)
+
+        pileup_cache = None if pileup_fp is None else PileupCacheWriter(
+            write=pileup_fp.stdin.write, ctg_name=ctg_name
+        )
+        for output in candidate_outputs_from(
+            candidate_filter=candidate_filter,
+            reads=reads_from(args, ctg_name, regions),
+            minimum_mapping_quality=args.minMQ,
+            ctg_name=ctg_name,
+            ctg_start=None,
+            ctg_end=None,
+            reference_sequence=reference_sequence,
+            reference_start=None,
+            statistics=statistics,
+            candidate_format=args.can_format,
+            maximum_depth=args.dcov,
+            pileup_cache=pileup_cache,
+            no_of_samples=len(bam_file_paths_from(args.bam_fn))
+        ):
+            can_fp.stdin.write(output)
 
-            number_of_reads_processed += 1
+    close_candidate_output(can_fp, args.can_fn)
+    if pileup_fp is not None:
+        pileup_fp.stdin.close()
+        pileup_fp.wait()
 
-            advance = 0
-            for c in str(CIGAR):
-                if c.isdigit():
-                    advance = advance * 10 + int(c)
-                    continue
+    print_statistics(candidate_filter, statistics, args.bam_fn)
 
-                if c == "S":
-                    query_position += advance
 
-                elif c == "M" or c == "=" or c == "X":
-                    for _ in range(advance):
-                        base = evc_base_from(SEQ[query_position])
-                        pileup[reference_position][base] += 1
+def shards_from(fai_file_path, shard_size, tree):
+    """
+    1-based genome windows (ctg_name, start, end), start and end inclusive, in the order of the fasta index.
+    Only windows overlapping the bed regions are kept if a bed tree is given.
+    """
+    is_tree_empty = len(tree) == 0
+    with open(fai_file_path) as fai_fp:
+        for row in fai_fp:
+            columns = row.strip().split("\t")
+            ctg_name, ctg_length = columns[0], int(columns[1])
+            if not is_tree_empty and ctg_name not in tree:
+                continue
 
-                        # those CIGAR operations consumes query and reference
-                        reference_position += 1
-                        query_position += 1
+            for ctg_start in range(1, ctg_length + 1, shard_size):
+                ctg_end = min(ctg_start + shard_size - 1, ctg_length)
+                if not is_tree_empty and not is_region_in(tree, ctg_name, ctg_start - 1, ctg_end):
+                    continue
+                yield ctg_name, ctg_start, ctg_end
 
-                elif c == "I":
-                    pileup[reference_position - 1]["I"] += 1
 
-                    # insertion consumes query
-                    query_position += advance
+# arguments and candidate filter of a shard worker process, set by initialize_shard_worker
+shard_worker_context = {}
 
-                elif c == "D":
-                    pileup[reference_position - 1]["D"] += 1
 
-                    # deletion consumes reference
-                    reference_position += advance
+def initialize_shard_worker(args, candidate_filter):
+    shard_worker_context["args"] = args
+    shard_worker_context["candidate_filter"] = candidate_filter
 
-                # reset advance
-                advance = 0
+    # forked workers share the random state of the parent, re-seed for independent output probability draws
+    random.seed()
 
-        positions = [x for x in pileup.keys() if x < POS] if not is_finish_reading_output else list(pileup.keys())
-        positions.sort()
-        for zero_based_position in positions:
-            base_count = depth = reference_base = temp_key = None
 
-            # ctg and bed checking (region [ctg_start, ctg_end] is 1-based, inclusive start and end positions)
-            pass_ctg = not is_ctg_range_given or ctg_start <= zero_based_position+1 <= ctg_end
-            pass_bed = not is_bed_file_given or is_region_in(tree, ctg_name, zero_based_position)
-            if not pass_bed or not pass_ctg:
-                continue
+def candidate_rows_in_shard(shard):
+    """
+    outputs, pileup count blocks (if saving pileup counts) and statistics of candidates in a shard (ctg_name, start, end)
+    """
+    args, candidate_filter = shard_worker_context["args"], shard_worker_context["candidate_filter"]
+    ctg_name, ctg_start, ctg_end = shard
+    regions = [region_from(ctg_name=ctg_name, ctg_start=ctg_start, ctg_end=ctg_end)]
 
-            # output probability checking
-            pass_output_probability = True
-            if is_building_training_dataset and is_variant_file_given:
-                temp_key = ctg_name + ":" + str(zero_based_position+1)
-                pass_output_probability = (
-                    temp_key not in variants_map and (
-                        (temp_key in non_variants_map and random.uniform(0, 1) <= output_probability_near_variant) or
-                        (temp_key not in non_variants_map and random.uniform(0, 1) <= output_probability_outside_variant)
-                    )
-                )
-            elif is_building_training_dataset:
-                pass_output_probability = random.uniform(0, 1) <= output_probability
-            if not pass_output_probability:
-                continue
+    reference_sequence = reference_sequence_from(
+        samtools_execute_command=args.samtools,
+        fasta_file_path=args.ref_fn,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end
+    )
+    if reference_sequence is None or len(reference_sequence) == 0:
+        raise RuntimeError("Failed to load reference sequence {} from file ({}).".format(regions[0], args.ref_fn))
 
-            # for depth checking and af checking
-            try:
-                reference_base = evc_base_from(reference_sequence[
-                    zero_based_position - (0 if reference_start is None else (reference_start - 1))
-                ])
-                position_dict = pileup[zero_based_position]
-            except:
-                continue
+    pileup_blocks = []
+    pileup_cache = None if args.pileup_fn is None else PileupCacheWriter(
+        write=pileup_blocks.append, ctg_name=ctg_name, ctg_start=ctg_start, ctg_end=ctg_end
+    )
 
-            # depth checking
-            base_count = list(position_dict.items())
-            depth = sum(x[1] for x in base_count) - position_dict["I"] - position_dict["D"]
-            if depth < minimum_depth_for_candidate:
-                continue
+    statistics = Counter()
+    outputs = list(candidate_outputs_from(
+        candidate_filter=candidate_filter,
+        reads=reads_from(args, ctg_name, regions),
+        minimum_mapping_quality=args.minMQ,
+        ctg_name=ctg_name,
+        ctg_start=ctg_start,
+        ctg_end=ctg_end,
+        reference_sequence=reference_sequence,
+        reference_start=ctg_start,
+        statistics=statistics,
+        candidate_format=args.can_format,
+        maximum_depth=args.dcov,
+        pileup_cache=pileup_cache,
+        no_of_samples=len(bam_file_paths_from(args.bam_fn))
+    ))
+    return outputs, pileup_blocks, statistics
+
+
+def make_candidates_in_shards(args):
+    """
+    Candidates of the whole genome (or the bed regions), sharded into windows processed by a pool of workers,
+    output in genomic order.
+    """
+    fai_file_path = "{}.fai".format(args.ref_fn)
+    if not isfile(fai_file_path):
+        print("Fasta index {} doesn't exist.".format(fai_file_path), file=sys.stderr)
+        sys.exit(1)
 
-            # af checking
-            denominator = depth if depth > 0 else 1
-            base_count.sort(key=lambda x: -x[1])  # sort base_count descendingly
-            pass_af = (
-                base_count[0][0] != reference_base or
-                (float(base_count[1][1]) / denominator) >= minimum_af_for_candidate
-            )
-            if not pass_af:
-                continue
+    candidate_filter = candidate_filter_from(args)
+    shards = list(shards_from(fai_file_path, args.shard_size, candidate_filter.tree))
+
+    # shards without reads by the BAM index are skipped
+    bam_indices = bam_indices_from(args)
+    no_of_shards = len(shards)
+    shards = [
+        shard for shard in shards
+        if is_region_covered_in(bam_indices, shard[0], shard[1] - 1, shard[2])
+    ]
+    if len(shards) < no_of_shards:
+        print("[INFO] {} of {} shards skipped without reads by the BAM index".format(
+            no_of_shards - len(shards), no_of_shards), file=sys.stderr)
+
+    can_fp = candidate_file_from(args)
+    empty_output = b"" if args.can_format == "binary" else ""
+    pileup_fp = pileup_file_from(args)
+
+    statistics = Counter()
+    if args.workers > 1:
+        pool = Pool(processes=args.workers, initializer=initialize_shard_worker, initargs=(args, candidate_filter))
+        results = pool.imap(candidate_rows_in_shard, shards)
+    else:
+        pool = None
+        initialize_shard_worker(args, candidate_filter)
+        results = (candidate_rows_in_shard(shard) for shard in shards)
 
-            # output 1-based candidate
-            if temp_key is not None and temp_key in non_variants_map:
-                no_of_candidates_near_variant += 1
-            elif temp_key is not None and temp_key not in non_variants_map:
-                no_of_candidates_outside_variant += 1
+    for outputs, pileup_blocks, shard_statistics in results:
+        can_fp.stdin.write(empty_output.join(outputs))
+        if pileup_fp is not None:
+            pileup_fp.stdin.write(b"".join(pileup_blocks))
+        statistics.update(shard_statistics)
 
-            output = [ctg_name, zero_based_position+1, reference_base, depth]
-            output.extend(["%s %d" % x for x in base_count])
-            output = " ".join([str(x) for x in output]) + "\n"
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-            can_fp.stdin.write(output)
+    close_candidate_output(can_fp, args.can_fn)
+    if pileup_fp is not None:
+        pileup_fp.stdin.close()
+        pileup_fp.wait()
 
-        for zero_based_position in positions:
-            del pileup[zero_based_position]
+    print_statistics(candidate_filter, statistics, args.bam_fn)
 
-        if is_finish_reading_output:
-            break
 
-    if need_consider_candidates_near_variant:
-        print("# of candidates near variant: ", no_of_candidates_near_variant)
-        print("# of candidates outside variant: ", no_of_candidates_outside_variant)
+def make_candidates_from_pileup(args):
+    """
+    Candidates re-thresholded from the pileup counts saved by an earlier run (--pileup_fn), without reading the BAM.
+    All saved contigs are output in whole genome mode, otherwise only the given contig (and range).
+    """
+    ctg_name_to_output = None if args.whole_genome else args.ctgName
+    ctg_start, ctg_end = args.ctgStart, args.ctgEnd
+    is_ctg_range_given = ctg_name_to_output is not None and ctg_start is not None and ctg_end is not None
+
+    candidate_filter = candidate_filter_from(args)
+    can_fp = candidate_file_from(args)
+
+    pileup_fp = gzip_input_from(args.pileup_fn, universal_newlines=False)
+    statistics = Counter()
+    reference_ctg_name, reference_sequence = None, None
+    for ctg_name, records in pileup_blocks_from(pileup_fp.stdout):
+        if ctg_name_to_output is not None and ctg_name != ctg_name_to_output:
+            continue
 
-    samtools_view_process.stdout.close()
-    samtools_view_process.wait()
+        if ctg_name != reference_ctg_name:
+            reference_ctg_name = ctg_name
+            reference_sequence = reference_sequence_from(
+                samtools_execute_command=args.samtools, fasta_file_path=args.ref_fn, ctg_name=ctg_name
+            )
+            if reference_sequence is None or len(reference_sequence) == 0:
+                print("[ERROR] Failed to load reference seqeunce of {} from file ({}).".format(
+                    ctg_name, args.ref_fn), file=sys.stderr)
+                sys.exit(1)
+
+        output = candidate_output_in_pileup_from(
+            candidate_filter=candidate_filter,
+            ctg_name=ctg_name,
+            ctg_start=ctg_start if is_ctg_range_given else None,
+            ctg_end=ctg_end if is_ctg_range_given else None,
+            positions=records["position"].astype(np.int64) - 1,
+            counts=records["counts"].astype(np.int64),
+            reference_sequence=reference_sequence,
+            reference_start=None,
+            statistics=statistics,
+            candidate_format=args.can_format
+        )
+        if output:
+            can_fp.stdin.write(output)
 
-    if not is_using_stdout_for_output_candidate:
-        can_fp.stdin.close()
-        can_fp.wait()
-        can_fpo.close()
+    pileup_fp.stdout.close()
+    pileup_fp.wait()
+    close_candidate_output(can_fp, args.can_fn)
 
-    if number_of_reads_processed == 0:
-        print("No read has been process, either the genome region you specified has no read cover, or please check the correctness of your BAM input (%s)." % (
-            bam_file_path), file=sys.stderr)
-        sys.exit(0)
+    print_statistics(candidate_filter, statistics)
 
 
 def main():
     parser = ArgumentParser(description="Generate 1-based variant candidates using alignments")
 
     parser.add_argument('--bam_fn', type=str, default="input.bam",
-                        help="Sorted bam file input, default: %(default)s")
+                        help="Sorted bam file input, or comma-separated bam files of several samples counted jointly (text output then appends the counts of each sample), default: %(default)s")
 
     parser.add_argument('--ref_fn', type=str, default="ref.fa",
                         help="Reference fasta file input, default: %(default)s")
@@ -418,6 +1055,15 @@ def main():
     parser.add_argument('--can_fn', type=str, default="PIPE",
                         help="Pile-up count output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
+    parser.add_argument('--can_format', type=str, default="text", choices=["text", "binary"],
+                        help="Candidate output format, binary for fixed-width records read by CreateTensor, default: %(default)s")
+
     parser.add_argument('--var_fn', type=str, default=None,
                         help="Candidate sites VCF file input, if provided, will choose candidate +/- 1 or +/- 2. Use together with gen4Training. default: %(default)s")
 
@@ -430,6 +1076,9 @@ def main():
     parser.add_argument('--minMQ', type=int, default=0,
                         help="Minimum Mapping Quality. Mapping quality lower than the setting will be filtered, default: %(default)d")
 
+    parser.add_argument('--dcov', type=int, default=0,
+                        help="Cap the depth of reads counted at any position, later reads starting where the cap is reached are skipped, 0 for no cap, default: %(default)d")
+
     parser.add_argument('--gen4Training', action='store_true',
                         help="Output all genome positions as candidate for model training (Set --threshold to 0), default: %(default)s")
 
@@ -454,13 +1103,44 @@ def main():
     parser.add_argument('--samtools', type=str, default="samtools",
                         help="Path to the 'samtools', default: %(default)s")
 
+    parser.add_argument('--pysam_for_reading_bam', action='store_true',
+                        help="Read the BAM in-process with pysam instead of parsing the output of 'samtools view', optional")
+
+    parser.add_argument('--whole_genome', action='store_true',
+                        help="Extract candidates of all contigs in the fasta index (or in the bed file if given) in shards, ctgName, ctgStart and ctgEnd are ignored, optional")
+
+    parser.add_argument('--shard_size', type=int, default=10000000,
+                        help="The size of a genome shard in whole genome mode, default: %(default)d")
+
+    parser.add_argument('--workers', type=int, default=1,
+                        help="The number of worker processes extracting shards in whole genome mode, default: %(default)d")
+
+    parser.add_argument('--regions_fn', type=str, default=None,
+                        help="Extract candidates of all regions in this bed file (e.g. amplicons or exome targets) in one process, ctgName, ctgStart and ctgEnd are ignored, optional")
+
+    parser.add_argument('--pileup_fn', type=str, default=None,
+                        help="Save the pileup counts to this file (binary, BGZF compressed) for re-thresholding, or read them from it with --rethreshold, optional")
+
+    parser.add_argument('--rethreshold', action='store_true',
+                        help="Output candidates from the pileup counts saved in --pileup_fn instead of reading the BAM. The counts keep the minMQ and dcov of the run saving them, optional")
+
     args = parser.parse_args()
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         sys.exit(1)
 
-    make_candidates(args)
+    if args.rethreshold and args.pileup_fn is None:
+        sys.exit("[ERROR] --pileup_fn must be given with --rethreshold")
+
+    if args.rethreshold:
+        make_candidates_from_pileup(args)
+    elif args.whole_genome:
+        make_candidates_in_shards(args)
+    elif args.regions_fn is not None:
+        make_candidates_in_regions(args)
+    else:
+        make_candidates(args)
 
 
 if __name__ == "__main__":
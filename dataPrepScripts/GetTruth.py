@@ -1,10 +1,12 @@
 import sys
 import shlex
-from subprocess import PIPE
 from argparse import ArgumentParser
 from collections import namedtuple
 
-from shared.utils import file_path_from, executable_command_string_from, subprocess_popen
+from shared.utils import (
+    file_path_from, executable_command_string_from, subprocess_popen, gzip_input_from, gzip_output_from,
+    DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL
+)
 
 VariantInfo = namedtuple('VariantInfo', ['chromosome', 'position', 'reference', 'alternate', 'genotype_1', 'genotype_2'])
 
@@ -79,8 +81,7 @@ def OutputVariant(args):
     ctg_end = args.ctgEnd
 
     if args.var_fn != "PIPE":
-        var_fpo = open(var_fn, "wb")
-        var_fp = subprocess_popen(shlex.split("gzip -c"), stdin=PIPE, stdout=var_fpo)
+        var_fp = gzip_output_from(var_fn, threads=args.compression_threads, level=args.compression_level)
     else:
         var_fp = TruthStdout(sys.stdout)
 
@@ -92,7 +93,7 @@ def OutputVariant(args):
     ):
         vcf_fp = subprocess_popen(shlex.split("tabix -f -p vcf %s %s:%s-%s" % (vcf_fn, ctg_name, ctg_start, ctg_end)))
     else:
-        vcf_fp = subprocess_popen(shlex.split("gzip -fdc %s" % (vcf_fn)))
+        vcf_fp = gzip_input_from(vcf_fn)
 
     buffer_line = None
     buffer_line_pos = -1
@@ -141,7 +142,6 @@ def OutputVariant(args):
     if args.var_fn != "PIPE":
         var_fp.stdin.close()
         var_fp.wait()
-        var_fpo.close()
 
 
 def main():
@@ -153,6 +153,12 @@ def main():
     parser.add_argument('--var_fn', type=str, default="PIPE",
                         help="Truth variants output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
     parser.add_argument('--ref_fn', type=str, default=None,
                         help="Reference file input, must be provided if the vcf contains '*' in ALT field.")
 
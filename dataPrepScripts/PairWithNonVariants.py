@@ -1,23 +1,22 @@
 import sys
 import logging
-import shlex
-from subprocess import PIPE
 from argparse import ArgumentParser
 from random import random
 
-from shared.utils import subprocess_popen
-from shared.interval_tree import bed_tree_from, is_region_in
+from shared.utils import gzip_input_from, gzip_output_from, DEFAULT_COMPRESSION_THREADS, DEFAULT_COMPRESSION_LEVEL
+from shared.interval_tree import bed_tree_from, IntervalSweeper
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
 
 def Run(args):
     tree = bed_tree_from(bed_file_path=args.bed_fn)
+    bed_sweeper = IntervalSweeper(tree)
 
     logging.info("Counting the number of Truth Variants in %s ..." % args.tensor_var_fn)
     v = 0
     d = {}
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (args.tensor_var_fn)))
+    f = gzip_input_from(args.tensor_var_fn)
     for row in f.stdout:
         row = row.strip().split()
         ctgName = row[0]
@@ -34,13 +33,13 @@ def Run(args):
 
     logging.info("Counting the number of usable non-variants in %s ..." % args.tensor_can_fn)
     c = 0
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (args.tensor_can_fn)))
+    f = gzip_input_from(args.tensor_can_fn)
     for row in f.stdout:
         row = row.strip().split()
         ctgName = row[0]
         pos = int(row[1])
         if args.bed_fn != None:
-            if not is_region_in(tree, ctgName, pos):
+            if not bed_sweeper.is_position_in(ctgName, pos):
                 continue
         key = "-".join([ctgName, str(pos)])
         if key in d:
@@ -56,9 +55,8 @@ def Run(args):
 
     o1 = 0
     o2 = 0
-    output_fpo = open(args.output_fn, "wb")
-    output_fh = subprocess_popen(shlex.split("gzip -c"), stdin=PIPE, stdout=output_fpo)
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (args.tensor_var_fn)))
+    output_fh = gzip_output_from(args.output_fn, threads=args.compression_threads, level=args.compression_level)
+    f = gzip_input_from(args.tensor_var_fn)
     for row in f.stdout:
         row = row.strip()
         output_fh.stdin.write(row)
@@ -66,14 +64,14 @@ def Run(args):
         o1 += 1
     f.stdout.close()
     f.wait()
-    f = subprocess_popen(shlex.split("gzip -fdc %s" % (args.tensor_can_fn)))
+    f = gzip_input_from(args.tensor_can_fn)
     for row in f.stdout:
         rawRow = row.strip()
         row = rawRow.split()
         ctgName = row[0]
         pos = int(row[1])
         if args.bed_fn != None:
-            if not is_region_in(tree, ctgName, pos):
+            if not bed_sweeper.is_position_in(ctgName, pos):
                 continue
         key = "-".join([ctgName, str(pos)])
         if key in d:
@@ -86,7 +84,6 @@ def Run(args):
     f.wait()
     output_fh.stdin.close()
     output_fh.wait()
-    output_fpo.close()
     logging.info("%.2f/%.2f Truth Variants/Non-variants outputed" % (o1, o2))
 
 
@@ -105,6 +102,12 @@ def main():
     parser.add_argument('--output_fn', type=str, default=None,
                         help="Tensors output filename")
 
+    parser.add_argument('--compression_threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help="Threads for compressing the gzip (BGZF) output, 0 to use a 'gzip -c' subprocess instead, default: %(default)s")
+
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="Compression level of the gzip output, default: %(default)s")
+
     parser.add_argument('--amp', type=float, default=2,
                         help="Pick ((# of the Truth Variants)*amp) non-variants to pair with the Truth Variants, default: 2")
 
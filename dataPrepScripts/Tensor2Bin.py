@@ -22,7 +22,8 @@ def Run(args):
             var_fn=args.var_fn,
             bed_fn=args.bed_fn,
             shuffle=args.shuffle,
-            is_allow_duplicate_chr_pos=args.allow_duplicate_chr_pos
+            is_allow_duplicate_chr_pos=args.allow_duplicate_chr_pos,
+            tensor_format=args.tensor_format
         )
 
     logging.info("Writing to binary ...")
@@ -39,6 +40,10 @@ def main():
     parser.add_argument('--tensor_fn', type=str, default="vartensors",
                         help="Tensor input")
 
+    parser.add_argument('--tensor_format', type=str, default="text",
+                        choices=["text", "binary", "haplotype_text", "haplotype_binary"],
+                        help="Tensor input format, binary for the fixed-width records of CreateTensor, haplotype_text and haplotype_binary for the haplotype tensors of CreateTensorHap (binned with the haplotype channels first), default: %(default)s")
+
     parser.add_argument('--var_fn', type=str, default="truthvars",
                         help="Truth variants list input")
 
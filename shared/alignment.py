@@ -0,0 +1,162 @@
+import sys
+from collections import namedtuple
+
+import shared.param as param
+
+# CIGAR operation codes, same as in BAM (and pysam cigartuples)
+BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CREF_SKIP, BAM_CSOFT_CLIP, BAM_CHARD_CLIP, BAM_CPAD, BAM_CEQUAL, BAM_CDIFF = range(9)
+CIGAR_OPERATION_CODE = dict(zip("MIDNSHP=X", range(9)))
+REFERENCE_CONSUMING_OPERATIONS = frozenset([BAM_CMATCH, BAM_CDEL, BAM_CREF_SKIP, BAM_CEQUAL, BAM_CDIFF])
+
+BAM_FREVERSE = 16
+HAPLOTYPE_TAG = "HP"
+PHASE_SET_TAG = "PS"
+HAPLOTYPE_TAG_PREFIX = HAPLOTYPE_TAG + ":i:"
+PHASE_SET_TAG_PREFIX = PHASE_SET_TAG + ":i:"
+# haplotype of a read without HP tag
+NO_HAPLOTYPE = -9
+
+# A read decoded once, for all the data preparation stages.
+# position is 0-based, cigartuples is None for CIGAR "*",
+# clipped_fraction is the soft-clipped bases over all CIGAR bases (+1),
+# phase_set is None for a read without PS tag.
+AlignedRead = namedtuple('AlignedRead', [
+    'reference_name',
+    'position',
+    'mapping_quality',
+    'is_reverse',
+    'cigartuples',
+    'sequence',
+    'haplotype',
+    'phase_set',
+    'clipped_fraction',
+])
+
+
+def cigartuples_from(CIGAR):
+    """
+    [(operation code, length), ...] from a CIGAR string, None for "*"
+    """
+    if CIGAR == "*":
+        return None
+
+    cigartuples = []
+    advance = 0
+    for c in CIGAR:
+        if c.isdigit():
+            advance = advance * 10 + int(c)
+            continue
+        cigartuples.append((CIGAR_OPERATION_CODE[c], advance))
+        advance = 0
+    return cigartuples
+
+
+def clipped_fraction_from(cigartuples):
+    if cigartuples is None:
+        return 0.0
+
+    soft_clipped_bases = 0
+    total_alignment_positions = 0
+    for operation, length in cigartuples:
+        if operation == BAM_CSOFT_CLIP:
+            soft_clipped_bases += length
+        total_alignment_positions += length
+    return float(soft_clipped_bases) / (total_alignment_positions + 1)
+
+
+def is_too_many_soft_clipped_bases_for_a_read_from(read):
+    # skip a read less than 55% aligned
+    return 1.0 - read.clipped_fraction < 0.55
+
+
+def reference_end_from(position, cigartuples):
+    return position + sum(advance for operation, advance in cigartuples if operation in REFERENCE_CONSUMING_OPERATIONS)
+
+
+def haplotype_and_phase_set_from(tags):
+    """
+    haplotype (HP tag) and phase set (PS tag) in SAM optional fields, NO_HAPLOTYPE and None if not tagged
+    """
+    haplotype, phase_set = NO_HAPLOTYPE, None
+    for tag in tags:
+        if tag.startswith(HAPLOTYPE_TAG_PREFIX):
+            haplotype = int(tag[len(HAPLOTYPE_TAG_PREFIX):])
+        elif tag.startswith(PHASE_SET_TAG_PREFIX):
+            phase_set = int(tag[len(PHASE_SET_TAG_PREFIX):])
+    return haplotype, phase_set
+
+
+def aligned_read_from(columns):
+    """
+    read decoded from the (split) columns of a SAM row
+    """
+    cigartuples = cigartuples_from(columns[5])
+    haplotype, phase_set = haplotype_and_phase_set_from(columns[11:])
+    return AlignedRead(
+        reference_name=columns[2],
+        position=int(columns[3]) - 1,  # switch from 1-base to 0-base to match sequence index
+        mapping_quality=int(columns[4]),
+        is_reverse=int(columns[1]) & BAM_FREVERSE == BAM_FREVERSE,
+        cigartuples=cigartuples,
+        sequence=columns[9].upper(),  # uppercase for SEQ (regexp is \*|[A-Za-z=.]+)
+        haplotype=haplotype,
+        phase_set=phase_set,
+        clipped_fraction=clipped_fraction_from(cigartuples),
+    )
+
+
+def aligned_reads_from(sam_rows):
+    """
+    reads decoded from SAM rows (e.g. the output of "samtools view"), header rows are skipped
+    """
+    for row in sam_rows:
+        columns = row.split()
+        if columns[0][0] == "@":
+            continue
+        yield aligned_read_from(columns)
+
+
+def aligned_read_from_pysam(read):
+    """
+    read decoded from a pysam AlignedSegment
+    """
+    cigartuples = read.cigartuples
+    return AlignedRead(
+        reference_name=read.reference_name,
+        position=read.reference_start,
+        mapping_quality=read.mapping_quality,
+        is_reverse=read.is_reverse,
+        cigartuples=cigartuples,
+        sequence=read.query_sequence.upper() if read.query_sequence is not None else "*",
+        haplotype=read.get_tag(HAPLOTYPE_TAG) if read.has_tag(HAPLOTYPE_TAG) else NO_HAPLOTYPE,
+        phase_set=read.get_tag(PHASE_SET_TAG) if read.has_tag(PHASE_SET_TAG) else None,
+        clipped_fraction=clipped_fraction_from(cigartuples),
+    )
+
+
+def pysam_reads_from(bam_file_path, ctg_name, regions):
+    """
+    aligned reads of ctg_name read in-process with pysam, using the BAM index for the regions,
+    reads of several (sorted, non-overlapping) regions are output once, in order
+    """
+    try:
+        import pysam
+    except ImportError:
+        sys.exit("[ERROR] pysam is required for reading BAM in-process, please install pysam or use samtools instead.")
+
+    with pysam.AlignmentFile(bam_file_path, mode="rb") as bam_file:
+        fetch_iterators = [bam_file.fetch(region=region) for region in regions] if regions else [bam_file.fetch()]
+        previous_region_end = None
+        for region_index, fetch_iterator in enumerate(fetch_iterators):
+            for read in fetch_iterator:
+                if read.flag & param.SAMTOOLS_VIEW_FILTER_FLAG or read.reference_name != ctg_name:
+                    continue
+                # a read starting before the end of the region before overlaps it, and is output already
+                if previous_region_end is not None and read.reference_start < previous_region_end:
+                    continue
+
+                yield aligned_read_from_pysam(read)
+
+            if len(regions) > 1:
+                # 1-based inclusive end, i.e. 0-based exclusive end
+                previous_region_end = int(regions[region_index].rsplit("-", 1)[1])
@@ -0,0 +1,138 @@
+import gzip
+import struct
+from os.path import isfile, splitext
+
+# BAI index, see the SAM/BAM format specification (section 5.2)
+BAI_MAGIC = b"BAI\x01"
+BAM_MAGIC = b"BAM\x01"
+# pseudo-bin holding the mapped / unmapped read counts of a reference (what samtools idxstats reports)
+BAI_PSEUDO_BIN = 37450
+# (shift, first bin id) of the bin levels, from 512 Mbp bins down to 16 kbp bins
+BAI_BIN_LEVELS = ((29, 0), (26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))
+
+INT32_STRUCT = struct.Struct("<i")
+BIN_STRUCT = struct.Struct("<Ii")
+CHUNK_SIZE = 16
+INTERVAL_SIZE = 8
+
+
+def bam_index_file_path_from(bam_file_path):
+    for index_file_path in [bam_file_path + ".bai", splitext(bam_file_path)[0] + ".bai"]:
+        if isfile(index_file_path):
+            return index_file_path
+    return None
+
+
+def bam_reference_names_from(bam_file_path):
+    """
+    reference names in the BAM header, in the order of reference ids
+    """
+    with gzip.open(bam_file_path, "rb") as bam_fp:
+        if bam_fp.read(4) != BAM_MAGIC:
+            raise ValueError("Not a BAM file: %s" % (bam_file_path))
+        l_text, = INT32_STRUCT.unpack(bam_fp.read(4))
+        bam_fp.read(l_text)
+        n_ref, = INT32_STRUCT.unpack(bam_fp.read(4))
+
+        reference_names = []
+        for _ in range(n_ref):
+            l_name, = INT32_STRUCT.unpack(bam_fp.read(4))
+            reference_names.append(bam_fp.read(l_name)[:-1].decode("ascii"))
+            bam_fp.read(4)
+    return reference_names
+
+
+def bins_overlapping_from(start, end):
+    """
+    ids of all bins which may hold reads overlapping the 0-based region [start, end)
+    """
+    end -= 1
+    bins = []
+    for shift, first_bin in BAI_BIN_LEVELS:
+        bins.extend(range(first_bin + (start >> shift), first_bin + (end >> shift) + 1))
+    return bins
+
+
+class BamIndex(object):
+    """
+    Non-empty bins and mapped read counts (as samtools idxstats) of each reference of a BAM, from its .bai index.
+    Queries are conservative: a region may be reported to have reads when it has none, never the other way round.
+    """
+
+    def __init__(self, bam_file_path, index_file_path):
+        reference_names = bam_reference_names_from(bam_file_path)
+        self.bins = {}
+        self.mapped_reads = {}
+
+        with open(index_file_path, "rb") as index_fp:
+            data = index_fp.read()
+        if data[:4] != BAI_MAGIC:
+            raise ValueError("Not a BAI index: %s" % (index_file_path))
+
+        n_ref, = INT32_STRUCT.unpack_from(data, 4)
+        offset = 8
+        for reference_id in range(n_ref):
+            ctg_name = reference_names[reference_id]
+            bins = set()
+            mapped_reads = None
+
+            n_bin, = INT32_STRUCT.unpack_from(data, offset)
+            offset += 4
+            for _ in range(n_bin):
+                bin_id, n_chunk = BIN_STRUCT.unpack_from(data, offset)
+                offset += BIN_STRUCT.size
+                if bin_id == BAI_PSEUDO_BIN and n_chunk == 2:
+                    mapped_reads, = struct.unpack_from("<Q", data, offset + CHUNK_SIZE)
+                elif n_chunk > 0:
+                    bins.add(bin_id)
+                offset += n_chunk * CHUNK_SIZE
+
+            n_intv, = INT32_STRUCT.unpack_from(data, offset)
+            offset += 4 + n_intv * INTERVAL_SIZE
+
+            self.bins[ctg_name] = bins
+            # a reference without any read has no bins at all (and no pseudo-bin either)
+            self.mapped_reads[ctg_name] = 0 if mapped_reads is None and len(bins) == 0 else mapped_reads
+
+    def mapped_reads_of(self, ctg_name):
+        """
+        number of mapped reads of a reference, None if not recorded in the index
+        """
+        return self.mapped_reads.get(ctg_name, 0)
+
+    def has_reads_in(self, ctg_name, start=None, end=None):
+        """
+        whether any read may overlap the 0-based region [start, end) (whole reference if not given)
+        """
+        if ctg_name not in self.bins:
+            return False
+        if self.mapped_reads[ctg_name] == 0 or len(self.bins[ctg_name]) == 0:
+            return False
+        if start is None or end is None:
+            return True
+
+        bins = self.bins[ctg_name]
+        return any(bin_id in bins for bin_id in bins_overlapping_from(max(start, 0), max(end, start + 1)))
+
+
+def bam_index_from(bam_file_path):
+    """
+    BamIndex of a BAM file, None if the BAM has no .bai index or it cannot be read
+    """
+    index_file_path = bam_index_file_path_from(bam_file_path)
+    if index_file_path is None:
+        return None
+    try:
+        return BamIndex(bam_file_path, index_file_path)
+    except (IOError, OSError, ValueError, struct.error, IndexError, UnicodeDecodeError):
+        return None
+
+
+def is_region_covered_in(bam_indices, ctg_name, start=None, end=None):
+    """
+    whether any read of the BAMs may overlap the 0-based region [start, end), True if any BAM has no index
+    """
+    return any(
+        bam_index is None or bam_index.has_reads_in(ctg_name, start, end)
+        for bam_index in bam_indices
+    )
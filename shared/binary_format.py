@@ -0,0 +1,168 @@
+import struct
+
+import numpy as np
+
+import shared.param as param
+from shared.pileup import PILEUP_COLUMNS
+
+# Fixed-width binary record streams.
+# A stream is a sequence of blocks, each block holds the records of one contig:
+#     magic (4 bytes), contig name length (uint16), contig name, number of records (uint32), packed records
+# All integers are little-endian, records are read back with np.frombuffer.
+
+CANDIDATE_BLOCK_MAGIC = b"CLCB"
+
+# 1-based position, reference base (ASCII code), depth and pileup counts in PILEUP_COLUMNS order
+CANDIDATE_RECORD_DTYPE = np.dtype([
+    ("position", "<u4"),
+    ("reference_base", "u1"),
+    ("depth", "<u4"),
+    ("counts", "<u4", (len(PILEUP_COLUMNS),)),
+])
+
+BLOCK_NAME_LENGTH_STRUCT = struct.Struct("<H")
+BLOCK_RECORD_COUNT_STRUCT = struct.Struct("<I")
+
+
+def block_bytes_from(magic, ctg_name, records):
+    ctg_name_bytes = ctg_name.encode("ascii")
+    return b"".join([
+        magic,
+        BLOCK_NAME_LENGTH_STRUCT.pack(len(ctg_name_bytes)),
+        ctg_name_bytes,
+        BLOCK_RECORD_COUNT_STRUCT.pack(len(records)),
+        records.tobytes(),
+    ])
+
+
+def read_exactly(fp, size):
+    """
+    read size bytes from a binary stream (possibly a pipe), fewer only at the end of the stream
+    """
+    chunks = []
+    while size > 0:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def blocks_from(fp, magic, record_dtype):
+    """
+    (contig name, records) of every block in a binary stream
+    """
+    while True:
+        block_magic = read_exactly(fp, len(magic))
+        if len(block_magic) == 0:
+            return
+        if block_magic != magic:
+            raise ValueError("Unexpected binary block magic %r, expected %r" % (block_magic, magic))
+
+        ctg_name_length, = BLOCK_NAME_LENGTH_STRUCT.unpack(read_exactly(fp, BLOCK_NAME_LENGTH_STRUCT.size))
+        ctg_name = read_exactly(fp, ctg_name_length).decode("ascii")
+        no_of_records, = BLOCK_RECORD_COUNT_STRUCT.unpack(read_exactly(fp, BLOCK_RECORD_COUNT_STRUCT.size))
+
+        records_bytes = read_exactly(fp, no_of_records * record_dtype.itemsize)
+        if len(records_bytes) != no_of_records * record_dtype.itemsize:
+            raise ValueError("Truncated binary block of contig %s" % (ctg_name))
+        yield ctg_name, np.frombuffer(records_bytes, dtype=record_dtype)
+
+
+def candidate_block_bytes_from(ctg_name, positions, reference_bases, depths, counts):
+    """
+    binary block of candidates, positions are 1-based
+    """
+    records = np.empty(len(positions), dtype=CANDIDATE_RECORD_DTYPE)
+    records["position"] = positions
+    records["reference_base"] = [ord(reference_base) for reference_base in reference_bases]
+    records["depth"] = depths
+    records["counts"] = counts
+    return block_bytes_from(CANDIDATE_BLOCK_MAGIC, ctg_name, records)
+
+
+def candidate_blocks_from(fp):
+    return blocks_from(fp, CANDIDATE_BLOCK_MAGIC, CANDIDATE_RECORD_DTYPE)
+
+
+PILEUP_BLOCK_MAGIC = b"CLPC"
+
+# 1-based position and pileup counts in PILEUP_COLUMNS order
+PILEUP_RECORD_DTYPE = np.dtype([
+    ("position", "<u4"),
+    ("counts", "<u4", (len(PILEUP_COLUMNS),)),
+])
+
+
+def pileup_block_bytes_from(ctg_name, positions, counts):
+    """
+    binary block of pileup counts, positions are 1-based
+    """
+    records = np.empty(len(positions), dtype=PILEUP_RECORD_DTYPE)
+    records["position"] = positions
+    records["counts"] = counts
+    return block_bytes_from(PILEUP_BLOCK_MAGIC, ctg_name, records)
+
+
+def pileup_blocks_from(fp):
+    return blocks_from(fp, PILEUP_BLOCK_MAGIC, PILEUP_RECORD_DTYPE)
+
+
+TENSOR_BLOCK_MAGIC = b"CLTB"
+
+# 1-based position, reference sequence of the tensor positions and the tensor counts (saturated at 65535)
+TENSOR_RECORD_DTYPE = np.dtype([
+    ("position", "<u4"),
+    ("reference_sequence", "S%d" % (2 * param.flankingBaseNum + 1)),
+    ("tensor", "<u2", (2 * param.flankingBaseNum + 1, param.matrixRow, param.matrixNum)),
+])
+TENSOR_COUNT_MAXIMUM = np.iinfo(np.uint16).max
+
+
+def tensor_block_bytes_from(
+    ctg_name, positions, reference_sequences, tensors, magic=TENSOR_BLOCK_MAGIC, record_dtype=TENSOR_RECORD_DTYPE
+):
+    """
+    binary block of tensors, positions are 1-based
+    """
+    records = np.empty(len(positions), dtype=record_dtype)
+    records["position"] = positions
+    records["reference_sequence"] = [reference_sequence.encode("ascii") for reference_sequence in reference_sequences]
+    records["tensor"] = np.minimum(tensors, TENSOR_COUNT_MAXIMUM)
+    return block_bytes_from(magic, ctg_name, records)
+
+
+def tensor_blocks_from(fp):
+    return blocks_from(fp, TENSOR_BLOCK_MAGIC, TENSOR_RECORD_DTYPE)
+
+
+HAPLOTYPE_TENSOR_BLOCK_MAGIC = b"CLHT"
+
+# tensor channels of reads of haplotype 1, haplotype 2 (HP tag) and of unphased reads
+NO_OF_HAPLOTYPE_CHANNELS = 3
+
+# as TENSOR_RECORD_DTYPE, with the tensor counts of each haplotype channel
+HAPLOTYPE_TENSOR_RECORD_DTYPE = np.dtype([
+    ("position", "<u4"),
+    ("reference_sequence", "S%d" % (2 * param.flankingBaseNum + 1)),
+    ("tensor", "<u2", (NO_OF_HAPLOTYPE_CHANNELS, 2 * param.flankingBaseNum + 1, param.matrixRow, param.matrixNum)),
+])
+
+
+def haplotype_tensor_block_bytes_from(ctg_name, positions, reference_sequences, tensors):
+    """
+    binary block of haplotype tensors, positions are 1-based
+    """
+    return tensor_block_bytes_from(
+        ctg_name,
+        positions,
+        reference_sequences,
+        tensors,
+        magic=HAPLOTYPE_TENSOR_BLOCK_MAGIC,
+        record_dtype=HAPLOTYPE_TENSOR_RECORD_DTYPE
+    )
+
+
+def haplotype_tensor_blocks_from(fp):
+    return blocks_from(fp, HAPLOTYPE_TENSOR_BLOCK_MAGIC, HAPLOTYPE_TENSOR_RECORD_DTYPE)
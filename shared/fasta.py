@@ -0,0 +1,136 @@
+import mmap
+from collections import namedtuple, OrderedDict
+
+from shared.utils import is_file_exists
+
+FaidxRecord = namedtuple('FaidxRecord', ['length', 'offset', 'line_bases', 'line_width'])
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def faidx_records_from(fai_file_path):
+    """
+    samtools faidx index records keyed by contig name
+    """
+    records = OrderedDict()
+    with open(fai_file_path) as fai_fp:
+        for row in fai_fp:
+            columns = row.rstrip("\n").split("\t")
+            if len(columns) < 5:
+                continue
+            records[columns[0]] = FaidxRecord(
+                length=int(columns[1]),
+                offset=int(columns[2]),
+                line_bases=int(columns[3]),
+                line_width=int(columns[4]),
+            )
+    return records
+
+
+def is_fasta_memory_mappable(fasta_file_path):
+    """
+    plain (not compressed) fasta with a .fai index
+    """
+    if not is_file_exists(fasta_file_path) or not is_file_exists(fasta_file_path, ".fai"):
+        return False
+    with open(fasta_file_path, "rb") as fasta_fp:
+        return fasta_fp.read(2) != GZIP_MAGIC
+
+
+class FastaFile(object):
+    """
+    Memory-mapped fasta file, sequences are sliced using the line offsets in its .fai index.
+    """
+
+    def __init__(self, fasta_file_path):
+        self.records = faidx_records_from(fasta_file_path + ".fai")
+        self.fasta_fp = open(fasta_file_path, "rb")
+        self.mmap = mmap.mmap(self.fasta_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, ctg_name):
+        return ctg_name in self.records
+
+    def length_of(self, ctg_name):
+        return self.records[ctg_name].length
+
+    def _file_offset_from(self, record, position):
+        return record.offset + (position // record.line_bases) * record.line_width + position % record.line_bases
+
+    def fetch(self, ctg_name, start, end):
+        """
+        upper-cased sequence of the 0-based region [start, end), clipped to the contig
+        """
+        record = self.records[ctg_name]
+        start, end = max(start, 0), min(end, record.length)
+        if start >= end:
+            return ""
+
+        sequence = self.mmap[self._file_offset_from(record, start):self._file_offset_from(record, end)]
+        if record.line_width != record.line_bases:
+            sequence = sequence.replace(b"\n", b"").replace(b"\r", b"")
+        return sequence.decode("ascii").upper()
+
+    def close(self):
+        self.mmap.close()
+        self.fasta_fp.close()
+
+
+# FastaFile of each fasta file opened in this process, shared by the reference sequences of all regions,
+# instead of a file descriptor and a mapping per region left to the garbage collector (e.g. in pypy)
+opened_fasta_files = {}
+
+
+def fasta_file_from(fasta_file_path):
+    """
+    FastaFile of fasta_file_path, opened once per process
+    """
+    fasta_file = opened_fasta_files.get(fasta_file_path)
+    if fasta_file is None:
+        fasta_file = FastaFile(fasta_file_path)
+        opened_fasta_files[fasta_file_path] = fasta_file
+    return fasta_file
+
+
+class ReferenceSequence(object):
+    """
+    Upper-cased reference sequence of a region, indexed like the string returned by samtools faidx
+    (index 0 is the 0-based region start), fetched from a FastaFile on demand in blocks.
+    """
+
+    BLOCK_SIZE = 65536
+    MAX_NO_OF_CACHED_BLOCKS = 4
+
+    def __init__(self, fasta_file, ctg_name, start=0, end=None):
+        ctg_length = fasta_file.length_of(ctg_name)
+        self.fasta_file = fasta_file
+        self.ctg_name = ctg_name
+        self.start = max(start, 0)
+        self.length = max((ctg_length if end is None else min(end, ctg_length)) - self.start, 0)
+        self.blocks = OrderedDict()
+
+    def __len__(self):
+        return self.length
+
+    def _block_from(self, block_index):
+        block = self.blocks.get(block_index)
+        if block is None:
+            block_start = self.start + block_index * self.BLOCK_SIZE
+            block = self.fasta_file.fetch(
+                self.ctg_name, block_start, min(block_start + self.BLOCK_SIZE, self.start + self.length)
+            )
+            self.blocks[block_index] = block
+            if len(self.blocks) > self.MAX_NO_OF_CACHED_BLOCKS:
+                self.blocks.popitem(last=False)
+        return block
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if start >= stop:
+                return ""
+            sequence = self.fasta_file.fetch(self.ctg_name, self.start + start, self.start + stop)
+            return sequence if step == 1 else sequence[::step]
+
+        if key < 0 or key >= self.length:
+            raise IndexError("reference sequence index out of range")
+        return self._block_from(key // self.BLOCK_SIZE)[key % self.BLOCK_SIZE]
@@ -1,7 +1,7 @@
-import shlex
+from bisect import bisect_right
 from intervaltree import IntervalTree
 
-from shared.utils import subprocess_popen
+from shared.utils import gzip_input_from
 
 
 def bed_tree_from(bed_file_path):
@@ -13,7 +13,7 @@ def bed_tree_from(bed_file_path):
     if bed_file_path is None:
         return tree
 
-    unzip_process = subprocess_popen(shlex.split("gzip -fdc %s" % (bed_file_path)))
+    unzip_process = gzip_input_from(bed_file_path)
     while True:
         row = unzip_process.stdout.readline()
         is_finish_reading_output = row == '' and unzip_process.poll() is not None
@@ -54,3 +54,73 @@ def is_region_in(tree, contig_name, region_start=None, region_end=None):
 
     # interval tree version 2
     return len(interval_tree.search(begin=region_start, end=region_end, strict=False)) > 0
+
+
+def merged_intervals_from(interval_tree):
+    """
+    sorted start and end lists of the merged (overlapping or adjacent) intervals of an interval tree
+    """
+    starts, ends = [], []
+    for interval in sorted(interval_tree):
+        if len(ends) > 0 and interval.begin <= ends[-1]:
+            ends[-1] = max(ends[-1], interval.end)
+            continue
+        starts.append(interval.begin)
+        ends.append(interval.end)
+    return starts, ends
+
+
+def intersection_tree_from(tree, other_tree):
+    """
+    0-based interval tree [start, end) of the regions in both trees
+    """
+    intersection_tree = {}
+    for ctg_name, interval_tree in tree.items():
+        if ctg_name not in other_tree:
+            continue
+        other_starts, other_ends = merged_intervals_from(other_tree[ctg_name])
+        for start, end in zip(*merged_intervals_from(interval_tree)):
+            index = bisect_right(other_ends, start)
+            while index < len(other_starts) and other_starts[index] < end:
+                intersection_start, intersection_end = max(start, other_starts[index]), min(end, other_ends[index])
+                if intersection_start < intersection_end:
+                    intersection_tree.setdefault(ctg_name, IntervalTree()).addi(intersection_start, intersection_end)
+                index += 1
+    return intersection_tree
+
+
+class IntervalSweeper(object):
+    """
+    Position membership in bed regions for positions queried in sorted order.
+
+    Intervals of each contig are sorted and merged into start / end lists ([start, end), 0-based as the bed tree),
+    a cursor moves forward along them, so sorted queries take O(1) amortized time.
+    A query going backward (or to another contig) re-positions the cursor by binary search.
+    """
+
+    def __init__(self, tree):
+        self.intervals = {}
+        for ctg_name, interval_tree in tree.items():
+            self.intervals[ctg_name] = merged_intervals_from(interval_tree)
+
+        self.ctg_name = None
+        self.position = None
+        self.index = 0
+
+    def is_position_in(self, ctg_name, position):
+        if ctg_name not in self.intervals:
+            return False
+
+        starts, ends = self.intervals[ctg_name]
+        if ctg_name != self.ctg_name or position < self.position:
+            self.ctg_name = ctg_name
+            self.index = bisect_right(ends, position)
+
+        index = self.index
+        no_of_intervals = len(ends)
+        while index < no_of_intervals and ends[index] <= position:
+            index += 1
+        self.index = index
+        self.position = position
+
+        return index < no_of_intervals and starts[index] <= position
@@ -0,0 +1,144 @@
+import numpy as np
+
+from shared.utils import IUPAC_base_to_ACGT_base_dict as BASE2ACGT
+
+# columns of a pileup count row
+PILEUP_COLUMNS = "ACGTIDN"
+PILEUP_COLUMN_INDEX = dict((column, index) for index, column in enumerate(PILEUP_COLUMNS))
+INSERTION_COLUMN_INDEX = PILEUP_COLUMN_INDEX["I"]
+DELETION_COLUMN_INDEX = PILEUP_COLUMN_INDEX["D"]
+# columns counted for depth (all but I and D)
+DEPTH_COLUMN_INDICES = [PILEUP_COLUMN_INDEX[column] for column in "ACGTN"]
+
+DEFAULT_PILEUP_WINDOW_SIZE = 65536
+
+# pileup column index of a read base (as an ASCII code), IUPAC bases are counted as ACGT, -1 for other symbols
+BASE_COLUMN_INDEX_LOOKUP = np.full(256, -1, dtype=np.int8)
+for base, ACGT_base in BASE2ACGT.items():
+    BASE_COLUMN_INDEX_LOOKUP[ord(base)] = BASE_COLUMN_INDEX_LOOKUP[ord(base.lower())] = PILEUP_COLUMN_INDEX[ACGT_base]
+BASE_COLUMN_INDEX_LOOKUP[ord("N")] = BASE_COLUMN_INDEX_LOOKUP[ord("n")] = PILEUP_COLUMN_INDEX["N"]
+
+
+def column_indices_from(sequence):
+    """
+    pileup column index of every base in a read sequence
+    """
+    return BASE_COLUMN_INDEX_LOOKUP[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+
+class PileupWindow(object):
+    """
+    Ring buffer of pileup counts, one row (A, C, G, T, I, D, N) per 0-based reference position
+    (or no_of_columns columns per row, e.g. the columns of several samples side by side).
+
+    Positions in [start, end) are still open for counting, positions before start are flushed,
+    flush() to the first position of interest before counting.
+    The buffer grows if a single read spans more positions than it can hold.
+    """
+
+    def __init__(self, size=DEFAULT_PILEUP_WINDOW_SIZE, no_of_columns=len(PILEUP_COLUMNS)):
+        self.size = size
+        self.no_of_columns = no_of_columns
+        self.counts = np.zeros((size, no_of_columns), dtype=np.int32)
+        self.start = 0
+        self.end = 0
+
+    def _reserve(self, end):
+        if end - self.start <= self.size:
+            return
+
+        new_size = self.size
+        while end - self.start > new_size:
+            new_size *= 2
+
+        new_counts = np.zeros((new_size, self.no_of_columns), dtype=np.int32)
+        if self.end > self.start:
+            positions = np.arange(self.start, self.end)
+            new_counts[positions % new_size] = self.counts[positions % self.size]
+        self.counts = new_counts
+        self.size = new_size
+
+    def add(self, positions, column_indices):
+        """
+        Increase counts at (positions[i], column_indices[i]), positions before start are ignored.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        column_indices = np.asarray(column_indices, dtype=np.int64)
+        if len(positions) == 0:
+            return
+
+        is_in_window = positions >= self.start
+        if not is_in_window.all():
+            positions, column_indices = positions[is_in_window], column_indices[is_in_window]
+            if len(positions) == 0:
+                return
+
+        end = int(positions.max()) + 1
+        self._reserve(end)
+        self.end = max(self.end, end)
+
+        np.add.at(self.counts, (positions % self.size, column_indices), 1)
+
+    def add_bases(self, position, column_indices):
+        """
+        Increase counts of an aligned block, column_indices[i] at position + i, negative column indices are skipped.
+        column_indices may also be 2-dimensional, to increase several (distinct) columns column_indices[i, :] at position + i.
+        """
+        column_indices = np.asarray(column_indices)
+        if len(column_indices) == 0:
+            return
+
+        offset = max(self.start - position, 0)
+        if offset > 0:
+            column_indices = column_indices[offset:]
+            if len(column_indices) == 0:
+                return
+            position += offset
+
+        end = position + len(column_indices)
+        self._reserve(end)
+        self.end = max(self.end, end)
+
+        indices = np.arange(position, end) % self.size
+        if column_indices.ndim == 2:
+            indices = np.repeat(indices, column_indices.shape[1])
+            column_indices = column_indices.ravel()
+        is_counted = column_indices >= 0
+        # (position, column) pairs in a block are distinct, no need for np.add.at
+        self.counts[indices[is_counted], column_indices[is_counted]] += 1
+
+    def columns_of(self, start, end):
+        """
+        Count rows of the positions in [start, end) (not flushed yet),
+        a view into the buffer unless the range wraps around the end of the ring.
+        """
+        self._reserve(end)
+        begin = start % self.size
+        if begin + (end - start) <= self.size:
+            return self.counts[begin:begin + (end - start)]
+        return self.counts[np.arange(start, end) % self.size]
+
+    def flush(self, position=None):
+        """
+        Flush all positions before the given 0-based position (all positions if not given).
+
+        Return:
+            positions (sorted) and their count rows, only for positions having any count
+        """
+        stop = self.end if position is None else min(position, self.end)
+        if stop <= self.start:
+            if position is not None and position > self.start:
+                self.start = position
+                self.end = max(self.end, self.start)
+            return np.empty(0, dtype=np.int64), np.empty((0, self.no_of_columns), dtype=np.int32)
+
+        positions = np.arange(self.start, stop)
+        indices = positions % self.size
+        counts = self.counts[indices]
+        self.counts[indices] = 0
+
+        self.start = stop if position is None else max(stop, position)
+        self.end = max(self.end, self.start)
+
+        is_touched = counts.any(axis=1)
+        return positions[is_touched], counts[is_touched]
@@ -0,0 +1,126 @@
+import os
+import sys
+import struct
+import tempfile
+from collections import deque
+
+import numpy as np
+
+import shared.param as param
+from shared.binary_format import block_bytes_from, blocks_from, read_exactly
+
+# A ring of tensor batches in shared memory, from CreateTensor (producer) to call_var (consumer).
+# The ring is a memory-mapped file (e.g. in /dev/shm) of no_of_slots slots of predictBatchSize float32 tensors,
+# the producer writes the tensor counts of a batch into a free slot and then the metadata of the batch
+# (a binary block of slot index, position and reference sequence records) to the tensor stream.
+# The consumer uses the slot in place and writes the slot index back to the release FIFO once done with it.
+
+TENSOR_SLOT_BLOCK_MAGIC = b"CLTS"
+
+# slot index (same for all records of a block), 1-based position and reference sequence of the tensor positions
+TENSOR_SLOT_RECORD_DTYPE = np.dtype([
+    ("slot", "<u2"),
+    ("position", "<u4"),
+    ("reference_sequence", "S%d" % (2 * param.flankingBaseNum + 1)),
+])
+TENSOR_SLOT_SHAPE = (param.predictBatchSize, 2 * param.flankingBaseNum + 1, param.matrixRow, param.matrixNum)
+SLOT_INDEX_STRUCT = struct.Struct("<H")
+
+DEFAULT_NO_OF_TENSOR_RING_SLOTS = 8
+# call_var holds up to 3 batches (outputting, predicting and loading), one more slot for the producer to fill
+MINIMUM_NO_OF_TENSOR_RING_SLOTS = 4
+
+
+def release_fifo_path_from(ring_file_path):
+    return ring_file_path + ".release"
+
+
+def create_tensor_ring(no_of_slots):
+    """
+    path of a new tensor ring, the ring file (sparse, zero-filled) and its release FIFO in a temporary directory
+    (in /dev/shm if available), to be created before starting the producer and the consumer
+    """
+    directory_path = tempfile.mkdtemp(prefix="clair_tensor_ring.", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    ring_file_path = os.path.join(directory_path, "tensors")
+    with open(ring_file_path, "wb") as ring_file:
+        ring_file.truncate(no_of_slots * int(np.prod(TENSOR_SLOT_SHAPE)) * np.dtype(np.float32).itemsize)
+    os.mkfifo(release_fifo_path_from(ring_file_path))
+    return ring_file_path
+
+
+def remove_tensor_ring(ring_file_path):
+    for file_path in [ring_file_path, release_fifo_path_from(ring_file_path)]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    os.rmdir(os.path.dirname(ring_file_path))
+
+
+def tensor_ring_slots_from(ring_file_path, no_of_slots):
+    return np.memmap(ring_file_path, dtype=np.float32, mode="r+", shape=(no_of_slots,) + TENSOR_SLOT_SHAPE)
+
+
+class TensorRingWriter(object):
+    """
+    Producer side of a tensor ring, taking a free slot (waiting for the consumer to release one if none)
+    for each batch of tensors.
+    """
+
+    def __init__(self, ring_file_path, no_of_slots):
+        self.slots = tensor_ring_slots_from(ring_file_path, no_of_slots)
+        # read only, waits for the consumer to open the FIFO and ends once the consumer exits
+        self.release_fifo = open(release_fifo_path_from(ring_file_path), "rb", buffering=0)
+        self.free_slot_indices = deque(range(no_of_slots))
+
+    def free_slot_index(self):
+        if len(self.free_slot_indices) == 0:
+            slot_index_bytes = read_exactly(self.release_fifo, SLOT_INDEX_STRUCT.size)
+            if len(slot_index_bytes) != SLOT_INDEX_STRUCT.size:
+                sys.exit("[ERROR] The tensor ring consumer exited before releasing a slot.")
+            self.free_slot_indices.append(SLOT_INDEX_STRUCT.unpack(slot_index_bytes)[0])
+        return self.free_slot_indices.popleft()
+
+
+class TensorRingReader(object):
+    """
+    Consumer side of a tensor ring, batches are used in place and released after use,
+    the earliest batch not released yet first (or the latest, e.g. for a batch dropped right away).
+    """
+
+    def __init__(self, ring_file_path, no_of_slots):
+        self.slots = tensor_ring_slots_from(ring_file_path, no_of_slots)
+        # read and write, never waits for the producer to open the FIFO (or fails after it exits)
+        self.release_fifo = os.fdopen(os.open(release_fifo_path_from(ring_file_path), os.O_RDWR), "wb", buffering=0)
+        self.slot_indices_in_use = deque()
+
+    def batches_from(self, fo):
+        """
+        (contig name, metadata records, tensors in the slot) of every batch (never empty) in the tensor stream
+        """
+        for ctg_name, records in blocks_from(fo, TENSOR_SLOT_BLOCK_MAGIC, TENSOR_SLOT_RECORD_DTYPE):
+            slot_index = int(records["slot"][0])
+            self.slot_indices_in_use.append(slot_index)
+            yield ctg_name, records, self.slots[slot_index][:len(records)]
+
+    def release(self, slot_index):
+        self.release_fifo.write(SLOT_INDEX_STRUCT.pack(slot_index))
+
+    def release_earliest_batch(self):
+        self.release(self.slot_indices_in_use.popleft())
+
+    def release_latest_batch(self):
+        self.release(self.slot_indices_in_use.pop())
+
+    def close(self):
+        self.release_fifo.close()
+        del self.slots
+
+
+def tensor_slot_block_bytes_from(ctg_name, slot_index, positions, reference_sequences):
+    """
+    binary block of the metadata of a batch of tensors in a slot, positions are 1-based
+    """
+    records = np.empty(len(positions), dtype=TENSOR_SLOT_RECORD_DTYPE)
+    records["slot"] = slot_index
+    records["position"] = positions
+    records["reference_sequence"] = [reference_sequence.encode("ascii") for reference_sequence in reference_sequences]
+    return block_bytes_from(TENSOR_SLOT_BLOCK_MAGIC, ctg_name, records)
@@ -1,3 +1,10 @@
+import io
+import gzip
+import shlex
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile, abspath
 from sys import exit, stderr
 from subprocess import check_output, PIPE, Popen
@@ -61,5 +68,223 @@ def executable_command_string_from(command_to_execute, exit_on_not_found=False):
     return None
 
 
-def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608):
-    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=True)
+def subprocess_popen(args, stdin=None, stdout=PIPE, stderr=stderr, bufsize=8388608, universal_newlines=True):
+    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, bufsize=bufsize, universal_newlines=universal_newlines)
+
+
+# BGZF (blocked gzip, as written by bgzip / htslib) compression.
+# Every block is a gzip member of at most BGZF_BLOCK_SIZE uncompressed bytes with its compressed size stored
+# in the "BC" extra field, so blocks can be compressed and decompressed independently by a pool of threads.
+# The output is still a valid gzip file.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER_STRUCT = struct.Struct("<4BI2BH2BHH")
+BGZF_FOOTER_STRUCT = struct.Struct("<II")
+BGZF_EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+GZIP_MAGIC = b"\x1f\x8b"
+
+# no. of threads for in-process gzip compression (0 for a 'gzip' subprocess, the former behaviour)
+DEFAULT_COMPRESSION_THREADS = 4
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+def bgzf_block_from(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    return b"".join([
+        BGZF_HEADER_STRUCT.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed_data) + 25),
+        compressed_data,
+        BGZF_FOOTER_STRUCT.pack(zlib.crc32(data) & 0xffffffff, len(data)),
+    ])
+
+
+def bgzf_data_from(block):
+    data = zlib.decompress(block[BGZF_HEADER_STRUCT.size:-BGZF_FOOTER_STRUCT.size], -15)
+    crc, size = BGZF_FOOTER_STRUCT.unpack(block[-BGZF_FOOTER_STRUCT.size:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise IOError("Corrupted BGZF block")
+    return data
+
+
+class BgzfWriter(io.BufferedIOBase):
+    """
+    Binary file writer compressing BGZF blocks with a pool of threads, blocks are written in order.
+    """
+
+    def __init__(self, fp, threads=DEFAULT_COMPRESSION_THREADS, level=DEFAULT_COMPRESSION_LEVEL):
+        self.fp = fp
+        self.level = level
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.max_no_of_pending_blocks = 4 * threads
+        self.pending_blocks = deque()
+
+    def writable(self):
+        return True
+
+    def _write_block(self, data):
+        if self.executor is None:
+            self.fp.write(bgzf_block_from(data, self.level))
+            return
+
+        self.pending_blocks.append(self.executor.submit(bgzf_block_from, data, self.level))
+        while len(self.pending_blocks) > self.max_no_of_pending_blocks:
+            self.fp.write(self.pending_blocks.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE:
+            no_of_full_blocks = len(self.buffer) // BGZF_BLOCK_SIZE
+            for i in range(no_of_full_blocks):
+                self._write_block(bytes(self.buffer[i * BGZF_BLOCK_SIZE:(i + 1) * BGZF_BLOCK_SIZE]))
+            del self.buffer[:no_of_full_blocks * BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buffer) > 0:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(self.pending_blocks) > 0:
+            self.fp.write(self.pending_blocks.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.fp.write(BGZF_EOF_BLOCK)
+        self.fp.close()
+        super(BgzfWriter, self).close()
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Binary file reader decompressing BGZF blocks ahead with a pool of threads.
+    """
+
+    def __init__(self, fp, threads=DEFAULT_COMPRESSION_THREADS):
+        self.fp = fp
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.max_no_of_pending_blocks = 4 * threads
+        self.pending_blocks = deque()
+        self.is_end_of_file = False
+        self.data = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        header = self.fp.read(BGZF_HEADER_STRUCT.size)
+        if len(header) == 0:
+            return None
+        if len(header) < BGZF_HEADER_STRUCT.size:
+            raise IOError("Truncated BGZF block")
+        fields = BGZF_HEADER_STRUCT.unpack(header)
+        if fields[:4] != (31, 139, 8, 4) or fields[7:11] != (6, 66, 67, 2):
+            raise IOError("Not a BGZF block")
+        block = header + self.fp.read(fields[11] + 1 - BGZF_HEADER_STRUCT.size)
+        if len(block) != fields[11] + 1:
+            raise IOError("Truncated BGZF block")
+        return block
+
+    def _fill_pending_blocks(self):
+        while not self.is_end_of_file and len(self.pending_blocks) < max(self.max_no_of_pending_blocks, 1):
+            block = self._next_block()
+            if block is None:
+                self.is_end_of_file = True
+            elif self.executor is None:
+                self.pending_blocks.append(bgzf_data_from(block))
+            else:
+                self.pending_blocks.append(self.executor.submit(bgzf_data_from, block))
+
+    def readinto(self, b):
+        while self.offset >= len(self.data):
+            self._fill_pending_blocks()
+            if len(self.pending_blocks) == 0:
+                return 0
+            pending_block = self.pending_blocks.popleft()
+            self.data = pending_block if self.executor is None else pending_block.result()
+            self.offset = 0
+
+        size = min(len(b), len(self.data) - self.offset)
+        b[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        if self.executor is not None:
+            for pending_block in self.pending_blocks:
+                pending_block.cancel()
+            self.executor.shutdown()
+        self.fp.close()
+        super(BgzfReader, self).close()
+
+
+def is_bgzf_file(file_path):
+    with open(file_path, "rb") as fp:
+        header = fp.read(BGZF_HEADER_STRUCT.size)
+    if len(header) < BGZF_HEADER_STRUCT.size:
+        return False
+    fields = BGZF_HEADER_STRUCT.unpack(header)
+    return fields[:4] == (31, 139, 8, 4) and fields[7:11] == (6, 66, 67, 2)
+
+
+class FileProcess(object):
+    """
+    Popen-like handle (stdin / stdout, poll() and wait()) of an in-process file reader or writer,
+    or of a 'gzip' subprocess writing to a file.
+    """
+
+    def __init__(self, stdin=None, stdout=None, process=None, fp=None):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.process = process
+        self.fp = fp
+
+    def poll(self):
+        return 0 if self.process is None else self.process.poll()
+
+    def wait(self):
+        return_code = 0 if self.process is None else self.process.wait()
+        if self.fp is not None:
+            self.fp.close()
+        return return_code
+
+
+def gzip_output_from(
+    file_path,
+    threads=DEFAULT_COMPRESSION_THREADS,
+    level=DEFAULT_COMPRESSION_LEVEL,
+    universal_newlines=True
+):
+    """
+    Popen-like gzip compressed output to a file, write to .stdin, then .stdin.close() and .wait().
+    Compressed in-process as BGZF, or by a 'gzip -c' subprocess if threads is 0.
+    """
+    fp = open(file_path, "wb")
+    if threads <= 0:
+        process = subprocess_popen(
+            shlex.split("gzip -c -%d" % (level)), stdin=PIPE, stdout=fp, universal_newlines=universal_newlines
+        )
+        return FileProcess(stdin=process.stdin, process=process, fp=fp)
+
+    writer = BgzfWriter(fp, threads=threads, level=level)
+    return FileProcess(stdin=io.TextIOWrapper(writer) if universal_newlines else writer)
+
+
+def gzip_input_from(file_path, threads=DEFAULT_COMPRESSION_THREADS, universal_newlines=True):
+    """
+    Popen-like input of a (gzip compressed or not) file, read from .stdout, then .stdout.close() and .wait().
+    BGZF files are decompressed with a pool of threads, other files are read in-process like 'gzip -fdc',
+    or by a 'gzip -fdc' subprocess if threads is 0.
+    """
+    if threads <= 0 or not is_file_exists(file_path):
+        return subprocess_popen(shlex.split("gzip -fdc %s" % (file_path)), universal_newlines=universal_newlines)
+
+    if is_bgzf_file(file_path):
+        fp = io.BufferedReader(BgzfReader(open(file_path, "rb"), threads=threads), buffer_size=BGZF_BLOCK_SIZE)
+    else:
+        with open(file_path, "rb") as magic_fp:
+            is_gzip_file = magic_fp.read(2) == GZIP_MAGIC
+        fp = gzip.open(file_path, "rb") if is_gzip_file else open(file_path, "rb")
+    return FileProcess(stdout=io.TextIOWrapper(fp) if universal_newlines else fp)